@@ -0,0 +1,129 @@
+# Benchmark for the transform function's CDC table parsers
+#
+# Generates a synthetic corpus of CDC weekly table files (same layout as the files downloaded by extract-txt),
+# parses it with the line-by-line parser and the vectorized parser from functions/transform/main.py,
+# checks that both produce the same rows and prints rows/sec for each.
+#
+# Usage (from ./main-pipeline, with the transform function's requirements installed):
+#   python benchmarks/benchmark_transform_parser.py --tables 10 --weeks 95
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+# Regions as they appear in the CDC tables, including the aggregate rows that the transform step excludes
+regions = [
+    'U.S. Residents, excluding U.S. Territories', 'New England', 'Connecticut', 'Maine', 'Massachusetts',
+    'New Hampshire', 'Rhode Island', 'Vermont', 'Middle Atlantic', 'New Jersey', 'New York (excluding New York City)',
+    'New York City', 'Pennsylvania', 'East North Central', 'Illinois', 'Indiana', 'Michigan', 'Ohio', 'Wisconsin',
+    'West North Central', 'Iowa', 'Kansas', 'Minnesota', 'Missouri', 'Nebraska', 'North Dakota', 'South Dakota',
+    'South Atlantic', 'Delaware', 'District of Columbia', 'Florida', 'Georgia', 'Maryland', 'North Carolina',
+    'South Carolina', 'Virginia', 'West Virginia', 'East South Central', 'Alabama', 'Kentucky', 'Mississippi',
+    'Tennessee', 'West South Central', 'Arkansas', 'Louisiana', 'Oklahoma', 'Texas', 'Mountain', 'Arizona',
+    'Colorado', 'Idaho', 'Montana', 'Nevada', 'New Mexico', 'Utah', 'Wyoming', 'Pacific', 'Alaska', 'California',
+    'Hawaii', 'Oregon', 'Washington', 'U.S. Territories', 'American Samoa', 'Guam', 'Northern Mariana Islands',
+    'Puerto Rico', 'U.S. Virgin Islands', 'Non-U.S. Residents', 'Total',
+]
+disease_tables = [250, 350, 354, 370, 392, 550, 560, 1122, 1130, 1140]
+
+# Load functions/transform/main.py as a module (the folder name is not a valid package name).
+# The function folder goes on sys.path so its sibling modules import the same way as in Cloud Functions, followed
+# by pipeline_utils for the shared modules the deploy script copies into it.
+def load_transform_module():
+    function_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'transform')
+    sys.path[:0] = [function_dir, os.path.join(function_dir, '..', '..', '..', 'pipeline_utils')]
+    path = os.path.join(function_dir, 'main.py')
+    spec = importlib.util.spec_from_file_location('transform_main', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# One synthetic weekly table file, with some empty count cells, rows without counts, counts that only int() reads
+# ('1_000', non-ASCII digits), and the other line endings str.splitlines() knows (CRLF, CR, '\x0b', '\x0c', '\x85')
+def make_file(week_ending, rng):
+    header = [
+        f"Weekly cases* of selected infrequently reported notifiable diseases, Non-U.S. Residents week ending {week_ending:%B} {week_ending.day}, {week_ending.year}",
+        "Reporting Area\tCurrent week\tPrevious 52 weeks Max\tCum 2024\tCum 2023",
+        "", "", "", "", "",
+    ]
+    rows = []
+    for region in regions:
+        count = rng.choice(['-', 'N', 'U', str(rng.randint(0, 500)), str(rng.randint(0, 20))])
+        if rng.random() < 0.05:
+            count = rng.choice(['', ' '])  # empty cell: a row with a count of 0
+        elif rng.random() < 0.01:
+            count = rng.choice(['1_000', '\u0663\u0661'])
+        if rng.random() < 0.02:
+            rows.append(f"{region}\t\t \t")  # no values at all: not a data row
+        else:
+            rows.append(f"{region}\t{count}\t{rng.randint(0, 900)}\t{rng.randint(0, 9000)}\t{rng.randint(0, 9000)}")
+    footer = ["", "* Case counts for reporting years 2023 and 2024 are provisional."]
+    line_end = "\r\n" if rng.random() < 0.25 else "\r" if rng.random() < 0.05 else "\n"
+    lines = header + rows + footer
+    if rng.random() < 0.05:
+        lines = [line + rng.choice(['\x0b', '\x0c', '\x85']) if rng.random() < 0.05 else line for line in lines]
+    return line_end.join(lines) + line_end
+
+def make_corpus(n_tables, n_weeks, seed=0):
+    rng = random.Random(seed)
+    corpus = []
+    for disease_table in disease_tables[:n_tables]:
+        for week in range(n_weeks):
+            week_ending = date(2023, 1, 7) + timedelta(weeks=week)
+            name = f"{week_ending.year}_week{week % 52 + 1:02d}_table{disease_table:02d}.txt"
+            corpus.append((name, make_file(week_ending, rng)))
+    return corpus
+
+def run_loop(transform, corpus):
+    builder = transform.ColumnarRecordBuilder()
+    for name, content in corpus:
+        transform.parse_txt_file(name, content, builder)
+    return builder.to_table().to_pandas()
+
+def run_vectorized(transform, corpus):
+    batch_size = transform.parse_batch_size
+    builder = transform.ColumnarRecordBuilder()
+    for i in range(0, len(corpus), batch_size):
+        transform.parse_txt_batch(corpus[i:i + batch_size], builder)
+    return builder.to_table().to_pandas()
+
+def timed(fn, *args, repeat=3):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # the parsers log every file
+            result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tables', type=int, default=10)
+    parser.add_argument('--weeks', type=int, default=95)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    transform = load_transform_module()
+    corpus = make_corpus(args.tables, args.weeks)
+    print(f"Synthetic corpus: {len(corpus)} files")
+
+    loop_seconds, loop_df = timed(run_loop, transform, corpus, repeat=args.repeat)
+    vector_seconds, vector_df = timed(run_vectorized, transform, corpus, repeat=args.repeat)
+
+    # Both parsers must produce the same rows
+    transform.pd.testing.assert_frame_equal(loop_df.reset_index(drop=True), vector_df.reset_index(drop=True), check_dtype=False)
+
+    rows = len(loop_df)
+    print(f"loop parser:       {rows} rows in {loop_seconds:.3f}s ({rows / loop_seconds:,.0f} rows/sec)")
+    print(f"vectorized parser: {rows} rows in {vector_seconds:.3f}s ({rows / vector_seconds:,.0f} rows/sec)")
+    print(f"speedup: {loop_seconds / vector_seconds:.1f}x")
+
+if __name__ == '__main__':
+    main()
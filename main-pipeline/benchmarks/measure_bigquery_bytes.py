@@ -0,0 +1,74 @@
+# Bytes scanned by the pipeline's BigQuery queries
+#
+# Runs the queries that read cdc_occurrences_raw / cdc_occurrences_staging (the staging anti-join, the per-disease
+# view of create-cdc-views, a recent-weeks filter and the Streamlit join) and prints the bytes each one scans.
+# Run it before and after the schema-setup migration to compare the string-dated tables with the Date-partitioned,
+# clustered ones.
+#
+# By default the queries are dry runs (free). A dry run can't see clustering, so for clustered tables it reports an
+# upper bound; --run executes the queries (as SELECTs) and prints the bytes actually processed and billed.
+#
+# Usage (from ./main-pipeline, with application default credentials):
+#   python benchmarks/measure_bigquery_bytes.py --disease 370 --weeks 4 [--run]
+
+import argparse
+
+from google.cloud import bigquery
+
+project_id = 'ba882-group-10'
+dataset_id = f'{project_id}.cdc_data'
+
+# Helper function - recent-weeks filter for a STRING Date column ('YYYY-MM-DD' strings sort like dates)
+def date_filter(weeks):
+    return f"CAST(Date AS STRING) >= CAST(DATE_SUB(CURRENT_DATE(), INTERVAL {weeks} WEEK) AS STRING)"
+
+def pipeline_queries(disease, weeks):
+    return {
+        "staging anti-join (load-into-stage)": f"""
+            SELECT r.Disease, r.Region, r.Current_Week_Occurrence_Count, r.Date
+            FROM `{dataset_id}.cdc_occurrences_raw` r
+            LEFT JOIN `{dataset_id}.cdc_occurrences_staging` s
+            ON r.Disease = s.Disease AND r.Region = s.Region AND r.Date = s.Date
+            WHERE s.Disease IS NULL""",
+        f"disease {disease} view (create-cdc-views)": f"""
+            SELECT Date, SUM(Current_Week_Occurrence_Count) AS Total_Occurrences
+            FROM `{dataset_id}.cdc_occurrences_staging`
+            WHERE Disease = '{disease}'
+            GROUP BY Date""",
+        f"disease {disease}, last {weeks} weeks": f"""
+            SELECT Region, Date, Current_Week_Occurrence_Count
+            FROM `{dataset_id}.cdc_occurrences_staging`
+            WHERE Disease = '{disease}' AND Date >= DATE_SUB(CURRENT_DATE(), INTERVAL {weeks} WEEK)""",
+        "streamlit join": f"""
+            SELECT COUNT(*)
+            FROM `{dataset_id}.cdc_occurrences_staging` AS o
+            JOIN `{dataset_id}.disease_dic` AS d
+            ON o.Disease = CAST(d.disease_code AS STRING)""",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes scanned by the pipeline queries')
+    parser.add_argument('--disease', default='370')
+    parser.add_argument('--weeks', type=int, default=4)
+    parser.add_argument('--run', action='store_true', help='execute the queries instead of dry runs')
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=project_id)
+
+    # The recent-weeks query compares Date with a DATE, which a STRING column (before the migration) can't do
+    staging = client.get_table(f"{dataset_id}.cdc_occurrences_staging")
+    string_dates = any(field.name == "Date" and field.field_type == "STRING" for field in staging.schema)
+
+    for name, query in pipeline_queries(args.disease, args.weeks).items():
+        if string_dates:
+            query = query.replace(f"Date >= DATE_SUB(CURRENT_DATE(), INTERVAL {args.weeks} WEEK)", date_filter(args.weeks))
+
+        job = client.query(query, job_config=bigquery.QueryJobConfig(dry_run=not args.run, use_query_cache=False))
+        if args.run:
+            job.result()
+            print(f"{name:45s} processed {job.total_bytes_processed or 0:>14,d} B   billed {job.total_bytes_billed or 0:>14,d} B")
+        else:
+            print(f"{name:45s} estimate  {job.total_bytes_processed or 0:>14,d} B")
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,16 @@
 # Setup the project
 gcloud config set project ba882-group-10
 
+# Telemetry wrapper of the function entry points, shared with other functions from pipeline_utils
+for function_dir in extract-txt schema-setup transform load-into-raw load-into-stage compact-lake; do
+    cp ../pipeline_utils/telemetry.py ./functions/$function_dir/telemetry.py
+done
+
+# Content-keyed cache of stage results, shared with other functions from pipeline_utils
+for function_dir in transform load-into-raw; do
+    cp ../pipeline_utils/stage_cache.py ./functions/$function_dir/stage_cache.py
+done
+
 # CDC data extraction function deployment
 echo "======================================================"
 echo "Deploying the CDC data extraction function"
@@ -45,6 +55,14 @@ echo "======================================================"
 echo "Deploying the Transform Function"
 echo "======================================================"
 
+# Asynchronous job handles, shared with other functions from pipeline_utils
+cp ../pipeline_utils/job_handles.py ./functions/transform/job_handles.py
+
+# Queue delivering the worker requests of asynchronous jobs (a worker request runs exactly once)
+# The tasks carry an identity token of etl-pipeline@, which needs the invoker role on the function (and actAs on itself)
+gcloud tasks queues describe function-jobs --location us-central1 > /dev/null 2>&1 || \
+    gcloud tasks queues create function-jobs --location us-central1 --max-attempts 1
+
 gcloud functions deploy transform_txt_to_dataframe \
     --gen2 \
     --runtime python311 \
@@ -56,7 +74,8 @@ gcloud functions deploy transform_txt_to_dataframe \
     --region us-central1 \
     --allow-unauthenticated \
     --memory 1024MB \
-    --timeout 300s
+    --timeout 300s \
+    --set-env-vars JOB_TIMEOUT_SECONDS=300,JOB_DISPATCH_QUEUE=projects/ba882-group-10/locations/us-central1/queues/function-jobs,JOB_DISPATCH_SERVICE_ACCOUNT=etl-pipeline@ba882-group-10.iam.gserviceaccount.com
 
 
 # Load Parquet data into BigQuery function deployment
@@ -93,3 +112,21 @@ gcloud functions deploy load_to_stage \
     --allow-unauthenticated \
     --memory 512MB
 
+
+# Compact the Hive-partitioned Parquet data lake written by the transform function
+echo "======================================================"
+echo "Deploying the Data Lake Compaction Function"
+echo "======================================================"
+
+gcloud functions deploy compact-lake \
+    --gen2 \
+    --runtime python311 \
+    --trigger-http \
+    --entry-point compact_lake \
+    --source ./functions/compact-lake \
+    --stage-bucket ba882-cloud-functions-stage \
+    --service-account etl-pipeline@ba882-group-10.iam.gserviceaccount.com \
+    --region us-central1 \
+    --allow-unauthenticated \
+    --memory 512MB \
+    --timeout 540s
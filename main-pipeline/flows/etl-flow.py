@@ -1,67 +1,400 @@
-from prefect import flow, task
-import requests
+from prefect import flow, task, unmapped
+from prefect.concurrency.sync import concurrency
+from prefect.task_runners import ThreadPoolTaskRunner
 import json
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
 
-# Helper function - Generic GCF invoker
-def invoke_gcf(url: str, payload: dict = None):
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    return response.json()
+# The shared Cloud Function invoker lives in pipeline_utils at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from pipeline_utils.gcf_invoker import collect_telemetry, invoke_gcf, latency_report, run_gcf_job
+from pipeline_utils.pipeline_metrics import save_pipeline_metrics
 
-# Task to call the CDC data extraction cloud function
+# Dependency graph of the pipeline: stage -> stages it waits for.
+# Only real dependencies are listed, so everything else runs concurrently: the schema is created while the CDC
+# files are extracted and transformed (the transform only reads GCS), and the lake is compacted while the data is
+# loaded into BigQuery.
+pipeline_dependencies = {
+    "extract": [],
+    "verify_extraction": ["extract"],
+    "create_schema": [],
+    "transform": ["verify_extraction"],
+    "load_to_raw": ["transform", "create_schema"],
+    "load_to_stage": ["load_to_raw"],
+    "commit_manifest": ["load_to_stage"],
+    "compact_lake": ["transform"],
+}
+
+# Start and end time of every stage of the current flow run; mapped tasks are recorded as "<stage>[<key>]"
+stage_timings = {}
+stage_timings_lock = Lock()
+
+# Helper function - record the wall-clock time of a stage (a retried stage keeps the start of its first attempt)
+@contextmanager
+def stage_timer(stage: str):
+    start = time.time()
+    try:
+        yield
+    finally:
+        with stage_timings_lock:
+            stage_timings[stage] = (stage_timings.get(stage, (start, None))[0], time.time())
+
+# Cache status reported by every stage's response ("hit", "miss" or "bypass"); mapped tasks as "<stage>[<key>]"
+cache_status = {}
+
+# Helper function - name under which a stage is timed and reported; the stages of a backfill chunk are "<stage>[<chunk>]"
+def stage_key(stage: str, chunk: str = None):
+    return f"{stage}[{chunk}]" if chunk else stage
+
+# Helper function - record the cache status of a stage's response
+def record_cache(stage: str, resp: dict):
+    if isinstance(resp, dict) and resp.get("cache"):
+        with stage_timings_lock:
+            cache_status[stage] = resp["cache"]["status"]
+
+# Print how many stages were served from their cache; a rerun of a job whose inputs didn't change is all hits
+def cache_report():
+    report = {}
+    for key, status in sorted(cache_status.items()):
+        counts = report.setdefault(key.split('[')[0], {"hit": 0, "miss": 0, "bypass": 0})
+        counts[status] = counts.get(status, 0) + 1
+    print("Stage cache:")
+    for stage, counts in report.items():
+        print(f"   {stage:20s} hits {counts['hit']:4d}  misses {counts['miss']:4d}  bypassed {counts['bypass']:4d}")
+    return report
+
+# Helper function - submit a stage once the stages it depends on have finished
+def submit_stage(futures: dict, stage: str, stage_task, *args):
+    wait_for = []
+    for dependency in pipeline_dependencies[stage]:
+        dependency_futures = futures.get(dependency, [])
+        wait_for += dependency_futures if isinstance(dependency_futures, list) else [dependency_futures]
+    futures[stage] = stage_task.submit(*args, wait_for=wait_for)
+    return futures[stage]
+
+# Print when each stage ran and the chain of dependencies that determined the flow's duration
+def critical_path_report(flow_start: float):
+    # Mapped tasks count as one stage, from the first start to the last end
+    stages = {}
+    for key, (start, end) in stage_timings.items():
+        stage = key.split('[')[0]
+        first, last = stages.get(stage, (start, end))
+        stages[stage] = (min(first, start), max(last, end))
+
+    # Walk back from the stage that finished last, each time to the dependency that finished last
+    path = []
+    stage = max(stages, key=lambda name: stages[name][1], default=None)
+    while stage is not None:
+        path.insert(0, stage)
+        dependencies = [dependency for dependency in pipeline_dependencies[stage] if dependency in stages]
+        stage = max(dependencies, key=lambda name: stages[name][1], default=None)
+
+    total = max((end for _, end in stages.values()), default=flow_start) - flow_start
+    print("Stage timings (seconds from flow start):")
+    for stage, (start, end) in sorted(stages.items(), key=lambda item: item[1][0]):
+        marker = "*" if stage in path else " "
+        print(f" {marker} {stage:20s} start {start - flow_start:8.1f}  duration {end - start:8.1f}")
+    print(f"Critical path ({total:.1f}s): {' -> '.join(path)}")
+    return {
+        "total_seconds": round(total, 3),
+        "critical_path": path,
+        "stages": {stage: {"start": round(start - flow_start, 3), "seconds": round(end - start, 3)} for stage, (start, end) in stages.items()},
+    }
+
+# Helper function - job IDs use the same format as the extraction function
+def new_job_id():
+    return datetime.now().strftime('%Y%m%d_%H%M%S') + '_' + str(uuid.uuid4())
+
+# Task to read the extraction function's configuration: its disease tables and its request budget against the CDC
+@task(retries=2, retry_delay_seconds=60)
+def describe_extract():
+    cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/download-cdc-data"
+    return invoke_gcf(cloud_function_url, payload={"describe": True})
+
+# Helper function - share of the CDC request budget for each of `parallel` extractions running at the same time
+# Each extraction runs in its own function instance with its own rate limiter, so together they must stay within one budget
+def rate_share(extract_config: dict, parallel: int):
+    parallel = max(1, parallel)
+    return {"rate_limit": extract_config["rate_limit"] / parallel, "rate_burst": max(1, extract_config["rate_burst"] // parallel)}
+
+# Helper function - split the extraction into shards ("table": one per disease table, "year": one per year, "none": a single shard)
+def plan_extract_shards(extract_config: dict, shard_by: str = "table", start_year: int = None, end_year: int = None, concurrency: int = 4):
+    if shard_by == "table":
+        shards = [{"shard": f"table-{table}", "disease_tables": [table]} for table in extract_config["disease_tables"]]
+    elif shard_by == "year":
+        start_year = start_year or extract_config["start_year"]
+        end_year = end_year or datetime.now().year
+        shards = [{"shard": f"year-{year}", "start_year": year, "end_year": year} for year in range(start_year, end_year + 1)]
+    elif shard_by == "none":
+        return [{"shard": "all"}]
+    else:
+        raise ValueError(f"Unknown shard_by '{shard_by}', expected 'table', 'year' or 'none'")
+
+    # Every shard runs in its own function instance, so each one gets a smaller worker pool and a share of the rate
+    for shard in shards:
+        shard.update(concurrency=concurrency, **rate_share(extract_config, len(shards)))
+    return shards
+
+# Task to call the CDC data extraction cloud function for one shard
+# The job_id is created by the flow, so a retry resumes the same shard from its checkpoint
 @task(retries=2, retry_delay_seconds=60)
-def extract():
+def extract(job_id, shard: dict):
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/download-cdc-data"
-    resp = invoke_gcf(cloud_function_url, payload={})
-    job_id = resp.get("job_id")
-    if not job_id:
+    with stage_timer(f"extract[{shard['shard']}]"):
+        resp = invoke_gcf(cloud_function_url, payload={"job_id": job_id, **shard})
+    record_cache(f"extract[{shard['shard']}]", resp)
+    if resp.get("job_id") != job_id:
         raise ValueError("Failed to obtain job_id from extraction function")
-    return job_id
+    failed = resp.get("stats", {}).get("files_failed", 0)
+    if failed:
+        print(f"Warning: {failed} files failed to download for job {job_id} shard {shard['shard']}; calling extraction again with this job_id resumes them.")
+    print(f"Extraction job {job_id} shard {shard['shard']} wrote {len(resp.get('changed_files', []))} new or changed files.")
+    return resp
+
+# Barrier after the fan-out: every shard must have returned a result for this job before the pipeline continues
+@task
+def verify_extraction(job_id, shards: list, results: list):
+    with stage_timer("verify_extraction"):
+        return check_extraction_results(job_id, shards, results)
+
+# Helper function - every shard must have returned a result for this job; returns the new or changed files
+def check_extraction_results(job_id, shards: list, results: list):
+    missing = [shard["shard"] for shard, result in zip(shards, results) if result.get("job_id") != job_id]
+    if missing:
+        raise RuntimeError(f"Extraction job {job_id} is missing shards: {missing}")
+
+    incomplete = [result["shard"] for result in results if not result.get("complete", True)]
+    if incomplete:
+        print(f"Warning: shards {incomplete} finished with failed downloads; their remaining files can be resumed with job {job_id}.")
+
+    changed_files = [changed for result in results for changed in result.get("changed_files", [])]
+    print(f"Extraction job {job_id}: {len(results)} shards completed, {len(changed_files)} new or changed files.")
+    return changed_files
 
 # Task to call the BigQuery schema creation cloud function
 @task(retries=2, retry_delay_seconds=60)
 def create_schema():
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/create-schema"
-    invoke_gcf(cloud_function_url, payload={})
+    with stage_timer("create_schema"):
+        invoke_gcf(cloud_function_url, payload={})
     print("Schema creation cloud function executed successfully.")
 
 # Task to call the transformation and saves the dataframe as a parquet file
+# The function returns a job handle right away and the task polls it, so no request is held open during the transform
+# Returns the Parquet file to load, which is an earlier job's file when the same source files were transformed before,
+# or None when the files held no rows (e.g. only "Total" rows), in which case there is nothing to load
 @task(retries=2, retry_delay_seconds=60)
-def transform_txt_to_dataframe(job_id):
+def transform_txt_to_dataframe(job_id, chunk: str = None):
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/transform_txt_to_dataframe"
-    invoke_gcf(cloud_function_url, payload={"job_id": job_id})
+    with stage_timer(stage_key("transform", chunk)):
+        resp = run_gcf_job(cloud_function_url, payload={"job_id": job_id})
+    record_cache(stage_key("transform", chunk), resp)
     print("Transformation cloud function executed successfully.")
+    return (resp or {}).get("output_uri")
 
 # Task to call the new function that loads Parquet data into BigQuery in the raw table version
+# source_uri is the file returned by the transform, which may belong to an earlier job, so it is always passed
 @task(retries=2, retry_delay_seconds=60)
-def load_to_raw(job_id):
+def load_to_raw(job_id, source_uri: str, chunk: str = None):
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/load-to-raw"
-    invoke_gcf(cloud_function_url, payload={"job_id": job_id})
+    with stage_timer(stage_key("load_to_raw", chunk)):
+        resp = invoke_gcf(cloud_function_url, payload={"job_id": job_id, "source_uri": source_uri})
+    record_cache(stage_key("load_to_raw", chunk), resp)
     print("Data loaded to BigQuery successfully.")
 
 @task(retries=2, retry_delay_seconds=60)
-def load_to_stage():
+def load_to_stage(job_id, chunk: str = None):
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/load_to_stage"
-    invoke_gcf(cloud_function_url, payload={})
-    print("Upsert from raw to staging table completed successfully!")
+    with stage_timer(stage_key("load_to_stage", chunk)):
+        resp = invoke_gcf(cloud_function_url, payload={"job_id": job_id})
+    record_cache(stage_key("load_to_stage", chunk), resp)
+    stats = resp.get("stats", {})
+    print(f"Upsert from raw to staging table completed successfully! Inserted {stats.get('rows_inserted', 0)} rows, revised {stats.get('rows_revised', 0)} rows.")
+    return stats
+
+# Task to record the job's files in the extract manifest, once they are in staging
+# Until then the next run still sees them as new or changed, so a failed load is picked up again by the next run
+@task(retries=2, retry_delay_seconds=60)
+def commit_manifest(job_id, chunk: str = None):
+    cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/download-cdc-data"
+    with stage_timer(stage_key("commit_manifest", chunk)):
+        resp = invoke_gcf(cloud_function_url, payload={"job_id": job_id, "commit_manifest": True})
+    print(f"Extraction job {job_id}: {resp.get('manifest_entries', 0)} entries committed to the download manifest.")
+
+# Task to compact the data lake partitions of the diseases written by this run
+@task(retries=2, retry_delay_seconds=60)
+def compact_lake(diseases: list):
+    cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/compact-lake"
+    with stage_timer("compact_lake"):
+        resp = invoke_gcf(cloud_function_url, payload={"diseases": diseases})
+    print(f"Data lake compaction completed: {resp.get('stats')}")
+
+# The raw table holds a single load (load-into-raw replaces it), so loading raw and merging it into staging must not
+# interleave with another load: not between the chunks of a backfill, nor with a scheduled combined_pipeline_flow
+# running in another process or worker. Both flows hold this Prefect global concurrency limit around the two loads.
+# It must exist with a limit of 1 (`prefect gcl create warehouse --limit 1`); with strict=True a run fails instead
+# of loading without it.
+warehouse_limit = "warehouse"
 
 # Define the combined flow
-@flow
-def combined_pipeline_flow():
-    # Step 1: Extract CDC data
-    job_id = extract()
+# Tasks are submitted to a thread pool and wait only for the stages listed in pipeline_dependencies
+# Passing the job_id of an earlier run reruns that job: the stages whose inputs didn't change return their cached results
+@flow(task_runner=ThreadPoolTaskRunner(max_workers=16))
+def combined_pipeline_flow(shard_by: str = "table", shard_concurrency: int = 4, job_id: str = None):
+    flow_start = time.time()
+    stage_timings.clear()
+    cache_status.clear()
+    collect_telemetry()  # drop the telemetry of an earlier run in this process
+    futures = {}
+
+    # Schema creation doesn't depend on the extraction, so it starts right away
+    submit_stage(futures, "create_schema", create_schema)
+
+    # Step 1: Extract CDC data (only new or changed files are written for the job)
+    # The shards run concurrently as mapped tasks under one job_id, then the barrier checks that all of them completed
+    job_id = job_id or new_job_id()
+    shards = plan_extract_shards(describe_extract(), shard_by, concurrency=shard_concurrency)
+    futures["extract"] = list(extract.map(unmapped(job_id), shards))
+    results = []
+    for future in futures["extract"]:
+        result = future.result(raise_on_failure=False)
+        results.append(result if isinstance(result, dict) else {"error": str(result)})
+    changed_files = submit_stage(futures, "verify_extraction", verify_extraction, job_id, shards, results).result()
+
+    # Nothing changed at the CDC since the last run, so there is nothing to transform or load
+    if not changed_files:
+        futures["create_schema"].result()
+        print("No new or changed CDC files, skipping transform and load steps.")
+        save_pipeline_metrics("combined_pipeline_flow", job_id, collect_telemetry())
+        latency_report()
+        return {**critical_path_report(flow_start), "cache": cache_report()}
+
+    # Step 2: Transform and upload text data to GCS (runs while the schema is still being created)
+    submit_stage(futures, "transform", transform_txt_to_dataframe, job_id)
+
+    # Step 3: Merge and expire the lake files of the diseases that changed in this run, alongside the BigQuery loads
+    submit_stage(futures, "compact_lake", compact_lake, sorted({changed["table"] for changed in changed_files}))
+
+    # Step 4: Load Parquet data into BigQuery, once both the Parquet file and the schema are ready, then upsert it
+    # from raw to the staging table. The transform's result is the Parquet file to load; without one (the changed
+    # files held no rows) raw and staging are left as they are. Both loads hold the warehouse limit, so a backfill
+    # running at the same time can't replace raw in between.
+    output_uri = futures["transform"].result()
+    if output_uri:
+        with concurrency(warehouse_limit, occupy=1, strict=True):
+            submit_stage(futures, "load_to_raw", load_to_raw, job_id, output_uri)
+            submit_stage(futures, "load_to_stage", load_to_stage, job_id).wait()
+    else:
+        futures["create_schema"].result()
+        print(f"Transform of job {job_id} produced no rows, skipping the load steps.")
+
+    # Step 5: Only now are the job's files marked as loaded in the extract manifest
+    submit_stage(futures, "commit_manifest", commit_manifest, job_id)
+
+    # Wait for the two branches; a failed stage fails the flow
+    futures["commit_manifest"].result()
+    futures["compact_lake"].result()
+    save_pipeline_metrics("combined_pipeline_flow", job_id, collect_telemetry())
+    latency_report()
+    return {**critical_path_report(flow_start), "cache": cache_report()}
+
+######
+## Historical backfill
+######
+
+# Chunks of a backfill being extracted and transformed at the same time: backfill_id -> semaphore of max_concurrent_chunks
+chunk_slots = {}
+
+# Helper function - split a date range into chunks of whole MMWR weeks (Sunday to Saturday), so no week is in two chunks
+def plan_backfill_chunks(start_date: str, end_date: str = None, chunk_weeks: int = 4):
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date) if end_date else date.today()
+    if end < start:
+        raise ValueError(f"end_date {end} is before start_date {start}")
+    start -= timedelta(days=(start.weekday() + 1) % 7)
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + timedelta(weeks=max(1, chunk_weeks), days=-1), end)
+        chunks.append({"chunk": f"{start:%Y%m%d}", "start_date": start.isoformat(), "end_date": chunk_end.isoformat()})
+        start = chunk_end + timedelta(days=1)
+    return chunks
+
+# One backfill chunk: extract and transform its weeks, then upsert them into staging
+# The job_id is derived from the backfill and the chunk, so rerunning a backfill resumes its chunks: completed extracts,
+# transforms and loads return their cached results and the staging MERGE is idempotent
+@task
+def backfill_chunk(backfill_id: str, chunk: dict, shard_concurrency: int, rate: dict, full_refresh: bool):
+    job_id = f"backfill_{backfill_id}_{chunk['chunk']}"
+    shard = {"shard": f"chunk-{chunk['chunk']}", "start_date": chunk["start_date"], "end_date": chunk["end_date"],
+             "concurrency": shard_concurrency, "full_refresh": full_refresh, **rate}
+    with chunk_slots[backfill_id]:
+        changed_files = check_extraction_results(job_id, [shard], [extract(job_id, shard)])
+        if not changed_files:
+            print(f"Chunk {chunk['start_date']} - {chunk['end_date']}: no new or changed CDC files.")
+            return {**chunk, "job_id": job_id, "changed_files": 0, "diseases": []}
+        output_uri = transform_txt_to_dataframe(job_id, chunk["chunk"])
+
+    # Loading into raw and merging into staging take seconds; the chunk's slot is free for the next extract meanwhile
+    stats = {}
+    if output_uri:
+        with concurrency(warehouse_limit, occupy=1, strict=True):
+            load_to_raw(job_id, output_uri, chunk["chunk"])
+            stats = load_to_stage(job_id, chunk["chunk"])
+    else:
+        print(f"Chunk {chunk['start_date']} - {chunk['end_date']}: transform produced no rows, nothing to load.")
+    commit_manifest(job_id, chunk["chunk"])
+    return {**chunk, "job_id": job_id, "changed_files": len(changed_files),
+            "diseases": sorted({changed["table"] for changed in changed_files}), "stage": stats}
+
+# Backfill the pipeline for a date range, e.g. to load earlier years or rebuild the tables after a schema change
+# The range is split into chunks of chunk_weeks MMWR weeks; up to max_concurrent_chunks are extracted and transformed
+# at the same time, and each one is committed into staging as soon as it is ready. full_refresh (default) ignores the
+# extract manifest, so weeks that were downloaded before are extracted and loaded again.
+# Pass the backfill_id of an earlier run to resume it.
+@flow(task_runner=ThreadPoolTaskRunner(max_workers=32))
+def backfill_pipeline_flow(start_date: str, end_date: str = None, chunk_weeks: int = 4, max_concurrent_chunks: int = 4,
+                           shard_concurrency: int = 4, full_refresh: bool = True, backfill_id: str = None):
+    flow_start = time.time()
+    stage_timings.clear()
+    cache_status.clear()
+    collect_telemetry()  # drop the telemetry of an earlier run in this process
+    backfill_id = backfill_id or datetime.now().strftime('%Y%m%d_%H%M%S')
+    chunks = plan_backfill_chunks(start_date, end_date, chunk_weeks)
+    print(f"Backfill {backfill_id}: {len(chunks)} chunks of {chunk_weeks} weeks, {max_concurrent_chunks} at a time")
 
-    # Step 2: Create BigQuery Schema
+    # The chunks commit into tables created by the schema function
     create_schema()
 
-    # Step 3: Transform and upload text data to GCS
-    transform_txt_to_dataframe(job_id)
+    chunk_slots[backfill_id] = BoundedSemaphore(max(1, max_concurrent_chunks))
+    # The chunks extracting at the same time share the CDC request budget
+    rate = rate_share(describe_extract(), min(len(chunks), max_concurrent_chunks))
+    futures = backfill_chunk.map(unmapped(backfill_id), chunks, unmapped(shard_concurrency), unmapped(rate), unmapped(full_refresh))
+    results, failed = [], []
+    for chunk, future in zip(chunks, futures):
+        result = future.result(raise_on_failure=False)
+        if isinstance(result, dict):
+            results.append(result)
+        else:
+            failed.append(chunk["chunk"])
+            print(f"Chunk {chunk['start_date']} - {chunk['end_date']} failed: {result}")
 
-    # Step 4: Load Parquet data into BigQuery
-    load_to_raw(job_id)
+    # One compaction for all the lake partitions written by the backfill
+    diseases = sorted({disease for result in results for disease in result["diseases"]})
+    if diseases:
+        compact_lake(diseases)
 
-    # Step 5: Upsert data from raw to staging table in Bigquery
-    load_to_stage()
+    save_pipeline_metrics("backfill_pipeline_flow", backfill_id, collect_telemetry())
+    latency_report()
+    report = {**critical_path_report(flow_start), "cache": cache_report(), "backfill_id": backfill_id, "chunks": results}
+    print(f"Backfill {backfill_id}: {len(results)} chunks committed, {sum(result['changed_files'] for result in results)} files loaded.")
+    if failed:
+        raise RuntimeError(f"Backfill {backfill_id}: chunks {failed} failed; run the flow again with backfill_id='{backfill_id}' to resume them")
+    return report
 
 # Run the Prefect flow
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+# Cloud Function to compact the Hive-partitioned CDC data lake
+#
+# The transform function appends about one file per partition and run to
+#   gs://cdc-extract-dataframe/lake/cdc_occurrences/disease=<code>/year=<year>/part-<run_id>-<seq>.parquet
+# where run_id is "<UTC timestamp>_<job_id>". A run only writes the weeks it extracted, so a partition collects a small
+# file per run. Compaction merges all files of a partition, whatever run wrote them, into a single
+# part-<newest run_id>-compacted.parquet: a (Region, Date) row written by several runs keeps the newest run's row (the
+# CDC revised that week), then the merged files are deleted (expired).
+# Files of the earlier week-level layout (.../year=<year>/week=<week>/) are merged into their year's partition.
+# The request can limit compaction to some partitions: {"diseases": [250, 350], "year": 2024}.
+# {"dry_run": true} only reports what would be merged and deleted.
+# The response carries the request's telemetry (telemetry.py): rows and bytes of the merged files.
+
+import functions_framework
+from google.cloud import storage
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import io
+import json
+import re
+from collections import defaultdict
+from telemetry import instrumented, record
+
+# Define project and bucket information
+project_id = 'ba882-group-10'
+bucket_name = 'cdc-extract-dataframe'
+lake_prefix = 'lake/cdc_occurrences'
+
+# part-<run_id>-<seq or "compacted">.parquet
+part_pattern = re.compile(r'^part-(?P<run_id>.+)-(?P<seq>\d+|compacted)\.parquet$')
+
+# Folder of the earlier week-level layout, below the year partition
+week_folder_pattern = re.compile(r'/week=\d+$')
+
+# Helper function - prefixes to list; the more of disease/year are given, the fewer partitions are touched
+def partition_prefixes(diseases, year):
+    if not diseases:
+        return [f'{lake_prefix}/']
+    prefixes = []
+    for disease in diseases:
+        prefix = f'{lake_prefix}/disease={disease}/'
+        if year is not None:
+            prefix += f'year={year}/'
+        prefixes.append(prefix)
+    return prefixes
+
+# Helper function - group the lake files by partition folder: {partition: [(run_id, blob)]}, oldest file first
+def list_partitions(bucket, prefixes):
+    partitions = defaultdict(list)
+    for prefix in prefixes:
+        for blob in bucket.list_blobs(prefix=prefix):
+            folder, _, file_name = blob.name.rpartition('/')
+            match = part_pattern.match(file_name)
+            if match:
+                partitions[week_folder_pattern.sub('', folder)].append((match.group('run_id'), blob))
+    # Within a run, numbered parts sort before the run's compacted file
+    for files in partitions.values():
+        files.sort(key=lambda file: (file[0], file[1].name.rpartition('/')[2]))
+    return partitions
+
+# Helper function - keep the last row of every (Disease, Region, Date) of a table whose rows are in run order
+def latest_rows(table):
+    keys = pa.table({
+        "Disease": table["Disease"],
+        "Region": table["Region"].cast(pa.string()),
+        "Date": table["Date"],
+        "row": pa.array(np.arange(table.num_rows)),
+    })
+    latest = keys.group_by(["Disease", "Region", "Date"], use_threads=False).aggregate([("row", "max")])["row_max"]
+    return table.take(latest)
+
+# Merge the files of a partition into one file, keeping the codec of the newest file; returns (blob name, rows in, rows out)
+def merge_files(bucket, partition, run_id, blobs, dry_run):
+    tables, compression = [], None
+    for blob in blobs:
+        parquet_file = pq.ParquetFile(io.BytesIO(blob.download_as_bytes()))
+        compression = parquet_file.metadata.row_group(0).column(0).compression.lower()
+        tables.append(parquet_file.read())
+    merged = pa.concat_tables(tables, promote_options='permissive').unify_dictionaries().combine_chunks()
+    table = latest_rows(merged)
+    table = table.take(pc.sort_indices(table, sort_keys=[("Date", "ascending")]))
+
+    blob_name = f'{partition}/part-{run_id}-compacted.parquet'
+    if dry_run:
+        return blob_name, merged.num_rows, table.num_rows
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=compression)
+    bucket.blob(blob_name).upload_from_string(buffer.getvalue(), content_type='application/octet-stream')
+    record(rows_in=merged.num_rows, rows_out=table.num_rows, bytes_read=sum(blob.size or 0 for blob in blobs), bytes_written=buffer.tell())
+    return blob_name, merged.num_rows, table.num_rows
+
+# Compact one partition; returns the number of merged and expired files, bytes removed and superseded rows
+def compact_partition(bucket, partition, files, dry_run):
+    newest_run = files[-1][0]
+    blobs = [blob for _, blob in files]
+    blob_name, rows_in, rows_out = merge_files(bucket, partition, newest_run, blobs, dry_run)
+    print(f"{'Would merge' if dry_run else 'Merged'} {len(blobs)} files into {blob_name} ({rows_out} rows, {rows_in - rows_out} superseded)")
+
+    # The merged file is written before anything is deleted, so the partition is never empty. A merged file that
+    # replaces a compacted file of the same run overwrites it and must not be deleted.
+    expired = [blob for blob in blobs if blob.name != blob_name]
+    if not dry_run:
+        for blob in expired:
+            blob.delete()
+    return {"merged": len(blobs), "expired": len(expired), "bytes_expired": sum(blob.size or 0 for blob in expired),
+            "rows_superseded": rows_in - rows_out}
+
+# Google Cloud Function entry point
+@functions_framework.http
+@instrumented("compact_lake")
+def compact_lake(request):
+    request_json = request.get_json(silent=True) or {}
+    print(f"request: {json.dumps(request_json)}")
+    diseases = request_json.get('diseases') or []
+    year = request_json.get('year')
+    dry_run = bool(request_json.get('dry_run', False))
+    if year is not None and not diseases:
+        return "year can only be given together with diseases", 400
+
+    try:
+        storage_client = storage.Client(project=project_id)
+        bucket = storage_client.bucket(bucket_name)
+        partitions = list_partitions(bucket, partition_prefixes(diseases, year))
+    except Exception as e:
+        print(f"Error listing lake partitions: {str(e)}")
+        return f"Error listing lake partitions: {str(e)}", 500
+
+    totals = {"partitions": len(partitions), "partitions_compacted": 0, "merged": 0, "expired": 0, "bytes_expired": 0, "rows_superseded": 0}
+    for partition, files in sorted(partitions.items()):
+        # A single file is already compact, unless it is in a week folder of the earlier layout
+        if len(files) < 2 and files[0][1].name.rpartition('/')[0] == partition:
+            continue
+        try:
+            stats = compact_partition(bucket, partition, files, dry_run)
+        except Exception as e:
+            print(f"Error compacting partition {partition}: {str(e)}")
+            return f"Error compacting partition {partition}: {str(e)}", 500
+        totals["partitions_compacted"] += 1
+        for key in ("merged", "expired", "bytes_expired", "rows_superseded"):
+            totals[key] += stats[key]
+
+    print(f"Lake compaction {'(dry run) ' if dry_run else ''}finished: {json.dumps(totals)}")
+    return json.dumps({"message": "Lake compaction completed.", "dry_run": dry_run, "stats": totals})
@@ -0,0 +1,86 @@
+# Checkpoints for resumable extraction jobs
+#
+# The checkpoint of a job shard is stored at {job_id}/checkpoints/{shard}.json in the extract bucket. A job that
+# is not split into shards uses the shard name "all"; shards of the same job run in parallel function instances,
+# so each one keeps its own checkpoint. It keeps the parameters the shard was started with and, for every
+# finished (year, week, table) work item, its download status and manifest entry. When the function is called
+# again with the same job_id and shard, items already in the checkpoint are skipped, so a retry only fetches the
+# remaining work. Once the shard has finished, the checkpoint also stores the final response and a repeated
+# call simply returns it.
+
+import json
+import re
+from datetime import datetime
+
+# job_ids are used as object prefixes, so only allow simple characters
+job_id_pattern = re.compile(r'^[A-Za-z0-9_\-]{1,128}$')
+
+def is_valid_job_id(job_id):
+    return isinstance(job_id, str) and bool(job_id_pattern.match(job_id))
+
+# Shard names follow the same rules as job_ids
+is_valid_shard = is_valid_job_id
+
+def checkpoint_blob_name(job_id, shard):
+    return f'{job_id}/checkpoints/{shard}.json'
+
+
+class JobCheckpoint:
+    def __init__(self, bucket, job_id, shard, params, completed=None, attempts=0, result=None):
+        self.bucket = bucket
+        self.job_id = job_id
+        self.shard = shard
+        self.params = params
+        self.completed = completed or {}
+        self.attempts = attempts
+        self.result = result
+
+    @property
+    def blob_name(self):
+        return checkpoint_blob_name(self.job_id, self.shard)
+
+    @property
+    def complete(self):
+        return self.result is not None
+
+    # Load the checkpoint of a job shard, or None when it has never run
+    @classmethod
+    def load(cls, bucket, job_id, shard):
+        blob = bucket.blob(checkpoint_blob_name(job_id, shard))
+        if not blob.exists():
+            return None
+        state = json.loads(blob.download_as_text())
+        return cls(bucket, job_id, shard, state["params"], state.get("completed"), state.get("attempts", 0), state.get("result"))
+
+    # Load the checkpoints of every shard of a job
+    @classmethod
+    def load_all(cls, bucket, job_id):
+        shards = [blob.name.split('/')[-1][:-len('.json')] for blob in bucket.list_blobs(prefix=f'{job_id}/checkpoints/')
+                  if blob.name.endswith('.json')]
+        return [cls.load(bucket, job_id, shard) for shard in sorted(shards)]
+
+    # Manifest entries of the finished work items (missing files have none)
+    def manifest_entries(self):
+        return {key: item["entry"] for key, item in self.completed.items() if item["entry"]}
+
+    # Add finished work items: {key: {"year", "week", "table", "status", "entry"}}
+    def record(self, items):
+        self.completed.update(items)
+
+    def changed_files(self):
+        changed = [{"year": item["year"], "week": item["week"], "table": item["table"], "status": item["status"]}
+                   for item in self.completed.values() if item["status"] in ("new", "changed")]
+        return sorted(changed, key=lambda f: (f["table"], f["year"], f["week"]))
+
+    def save(self):
+        state = {
+            "job_id": self.job_id,
+            "shard": self.shard,
+            "params": self.params,
+            "attempts": self.attempts,
+            "completed": self.completed,
+            "result": self.result,
+            "updated_at": datetime.now().isoformat(),
+        }
+        self.bucket.blob(self.blob_name).upload_from_string(json.dumps(state), content_type='application/json')
+        print(f"Checkpoint saved for job {self.job_id} shard {self.shard}: {len(self.completed)} work items completed")
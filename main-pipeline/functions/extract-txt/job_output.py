@@ -0,0 +1,121 @@
+# Output writers for the extraction job
+#
+# FileOutput writes one object per CDC file under {job_id}/ (the original layout).
+# ArchiveOutput streams every file of the job into a gzip-compressed tar archive under {job_id}/archive/
+# and writes a small JSON index next to it, so the transform step can read the whole job with a few GETs
+# instead of listing and downloading ~1,000 tiny blobs.
+#
+# rotate() returns the work item keys whose content is durably stored since the previous call. Checkpoints only
+# record keys returned by rotate(), so a crashed job never claims a file that was still in an unfinished upload.
+# An archive is only finalised by rotate() once it holds archive_part_bytes, or by rotate(final=True) at the end
+# of the shard, so a shard normally writes a single archive (a job sharded N ways writes N, and a resumed shard
+# adds one for the files it downloads again). Until then its files are not in the checkpoint and a crashed shard
+# downloads them again when it is resumed.
+
+import hashlib
+import io
+import json
+import tarfile
+import threading
+import time
+import uuid
+
+archive_content_type = 'application/gzip'
+
+# Uncompressed size at which an archive is finalised and the next file starts a new one
+archive_part_bytes = 256 * 1024 * 1024
+
+
+class FileOutput:
+    def __init__(self, bucket, job_id):
+        self.bucket = bucket
+        self.job_id = job_id
+        self.files_written = 0
+        self._lock = threading.Lock()
+        self._committed = []
+
+    def write(self, filename, content, key=None):
+        blob = self.bucket.blob(f'{self.job_id}/{filename}')
+        blob.upload_from_string(content)
+        with self._lock:
+            self.files_written += 1
+            self._committed.append(key)
+        return blob.name
+
+    def rotate(self, final=False):
+        with self._lock:
+            committed, self._committed = self._committed, []
+        return committed
+
+    def close(self):
+        self.rotate(final=True)
+        return {"mode": "files", "files_written": self.files_written}
+
+
+class ArchiveOutput:
+    def __init__(self, bucket, job_id, part_bytes=archive_part_bytes):
+        self.bucket = bucket
+        self.job_id = job_id
+        self.part_bytes = part_bytes
+        self.parts = []
+        self.files_written = 0
+
+        # Workers write concurrently, so members are appended to the stream one at a time
+        self._lock = threading.Lock()
+        self._writer = None
+        self._tar = None
+        self._index = []
+        self._keys = []
+        self._bytes = 0
+
+    # Open a new part lazily so an empty run (or checkpoint) does not leave an empty archive behind
+    def _open(self):
+        part_id = time.strftime('%Y%m%d_%H%M%S') + '_' + uuid.uuid4().hex[:8]
+        self._archive_name = f'{self.job_id}/archive/part-{part_id}.tar.gz'
+        self._index_name = f'{self.job_id}/archive/part-{part_id}.index.json'
+        self._writer = self.bucket.blob(self._archive_name).open('wb', content_type=archive_content_type)
+        self._tar = tarfile.open(fileobj=self._writer, mode='w|gz')
+
+    def write(self, filename, content, key=None):
+        info = tarfile.TarInfo(name=filename)
+        info.size = len(content)
+        info.mtime = int(time.time())
+        with self._lock:
+            if self._tar is None:
+                self._open()
+            self._tar.addfile(info, io.BytesIO(content))
+            self._index.append({"name": filename, "size": len(content), "sha256": hashlib.sha256(content).hexdigest()})
+            self._keys.append(key)
+            self._bytes += len(content)
+            return f'{self._archive_name}#{filename}'
+
+    # Finalise the current part, if it is full or the shard is done, and return the keys stored in it
+    def rotate(self, final=False):
+        with self._lock:
+            if self._tar is None or (not final and self._bytes < self.part_bytes):
+                return []
+            self._tar.close()
+            self._writer.close()
+
+            index = {"archive": self._archive_name, "members": sorted(self._index, key=lambda m: m["name"])}
+            self.bucket.blob(self._index_name).upload_from_string(json.dumps(index), content_type='application/json')
+            print(f"Wrote {len(self._index)} files to archive {self.bucket.name}/{self._archive_name}")
+
+            self.parts.append(self._archive_name)
+            self.files_written += len(self._index)
+            committed = self._keys
+            self._tar, self._writer, self._index, self._keys, self._bytes = None, None, [], [], 0
+            return committed
+
+    def close(self):
+        self.rotate(final=True)
+        return {"mode": "archive", "files_written": self.files_written, "archives": self.parts}
+
+
+# Helper function - pick the output writer for a job
+def create_output(mode, bucket, job_id):
+    if mode == 'archive':
+        return ArchiveOutput(bucket, job_id)
+    if mode == 'files':
+        return FileOutput(bucket, job_id)
+    raise ValueError(f"Unknown output mode '{mode}', expected 'archive' or 'files'")
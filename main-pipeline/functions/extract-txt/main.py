@@ -1,14 +1,61 @@
-# This script is designed to be run as a Google Cloud Function. It downloads disease data in .txt format from the CDC website for the years 2023 and 2024.
-# It iterates over specified disease tables and weeks for each year to download the corresponding data files.
-# The downloaded files are saved to a Google Cloud Storage bucket.
+# This script is designed to be run as a Google Cloud Function. It downloads disease data in .txt format from the CDC website
+# for a configurable range of years (2023 up to the current MMWR year by default).
+# It iterates over specified disease tables and the MMWR weeks of each year that can exist (see week_planner.py) to download the corresponding data files.
+# The downloaded files are saved to a Google Cloud Storage bucket, either packed into one compressed archive per job
+# (output_mode "archive", the default) or as one object per file (output_mode "files"), see job_output.py.
 # If a file cannot be downloaded, an error message is printed with the status code.
+#
+# Downloads run concurrently on a thread pool. All workers share one pooled HTTP session and one
+# Cloud Storage bucket handle, and the response reports per-run throughput (files/sec, bytes/sec).
+#
+# Extraction is incremental: a manifest stored in the bucket keeps the ETag, Last-Modified and SHA-256 of
+# every (year, week, table) file. Requests are sent as conditional GETs and unchanged files are skipped,
+# so only new or changed files are written under the job_id. Pass {"full_refresh": true} to ignore the manifest.
+# A job's entries are only merged into the manifest when the flow confirms the job was loaded into staging
+# ({"job_id": ..., "commit_manifest": true}). If a downstream stage fails, the next run still sees the job's files as
+# changed and loads them again.
+#
+# All requests to wonder.cdc.gov go through a shared adaptive rate limiter (see rate_limiter.py) that backs off
+# on 429/5xx responses and honours Retry-After; its counters are returned with the run statistics.
+# CDC_RATE_LIMIT/CDC_RATE_BURST are the budget for all requests to the host. Callers that run several jobs or shards
+# at once split it between them with {"rate_limit": ..., "rate_burst": ...}; {"describe": true} returns the budget and
+# the disease tables, so the flows don't keep their own copies.
+#
+# Each request reports its telemetry (time, CPU, memory, bytes downloaded) with the response, see telemetry.py.
+#
+# Progress is checkpointed per job (see checkpoint.py). Calling the function again with the same job_id resumes the job
+# and only fetches the remaining (year, week, table) work items. The stored result of a completed job is returned as
+# a cache hit ({"cache": {"status": "hit", "key": "<job_id>/<shard>"}}); the manifest above is what keeps a new job
+# from downloading files it already has.
+#
+# The ETL flow can split one job into shards (by disease table or by year) and run them in parallel function
+# instances under a shared job_id. Each shard keeps its own checkpoint, and the shared manifest is merged with
+# a generation precondition so concurrent shards never overwrite each other's entries.
+#
+# A date range ({"start_date": "2019-01-06", "end_date": "2019-03-30"}) restricts the job to the MMWR weeks containing
+# those dates, in place of start_year/end_year; the backfill flow runs one such job per chunk of weeks.
+#
+# Request parameters (all optional):
+# {"job_id": "...", "shard": "table-250", "disease_tables": [250], "start_year": 2023, "end_year": 2025,
+#  "start_date": null, "end_date": null, "concurrency": 16, "rate_limit": 10, "rate_burst": 20, "full_refresh": false,
+#  "output_mode": "archive"}
 
 import requests
+from requests.adapters import HTTPAdapter
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 import os
 import functions_framework
-from retrying import retry
-from datetime import datetime
+from rate_limiter import get_limiter, reset_limiters, fetch_with_backoff, PermanentDownloadError
+from job_output import create_output
+from checkpoint import JobCheckpoint, is_valid_job_id, is_valid_shard
+from week_planner import plan_work_items, cdc_table_url, last_completed_mmwr_week, mmwr_week
+from telemetry import instrumented, record
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, date
+import hashlib
+import threading
+import time
 import uuid
 import json
 
@@ -16,61 +63,290 @@ import json
 project_id = 'ba882-group-10'
 bucket_name = 'cdc-extract-txt'
 
-@retry(stop_max_attempt_number=2, wait_fixed=1000)  # Retry up to 2 times, wait 1 second between retries
-def download_txt_file(year, week, disease_table, bucket_name, job_id):
-    url = f'https://wonder.cdc.gov/nndss/static/{year}/{week:02d}/{year}-{week:02d}-table{disease_table:02d}.txt'
-    response = requests.get(url)
+# CDC disease tables downloaded by default
+disease_tables_all = [250,350,354,370,392,550,560,1122,1130,1140]
 
-    if response.status_code == 200:  # Successful request
-        # Initialize Google Cloud Storage client
-        storage_client = storage.Client(project=project_id)
-        bucket = storage_client.get_bucket(bucket_name)
+# First year downloaded when the request does not specify one
+default_start_year = int(os.environ.get('EXTRACT_START_YEAR', 2023))
 
-        # Define the filename and blob path
-        filename = f'{year}_week{week:02d}_table{disease_table:02d}.txt'
-        blob_path = f'{job_id}/{filename}'
-        blob = bucket.blob(blob_path)
+# How downloaded files are written to the bucket: "archive" (one tar.gz per job) or "files"
+default_output_mode = os.environ.get('EXTRACT_OUTPUT_MODE', 'archive')
 
-        # Upload the content to the bucket
-        blob.upload_from_string(response.content)
-        print(f"Successfully uploaded: {filename} to bucket {bucket_name}/{job_id}")
+# Maximum number of files downloaded at the same time (can be overridden per request with "concurrency")
+default_concurrency = int(os.environ.get('EXTRACT_CONCURRENCY', 16))
+
+# Request rate allowed against wonder.cdc.gov (requests per second and burst size), shared by all concurrent requests
+cdc_rate_limit = float(os.environ.get('CDC_RATE_LIMIT', 10))
+cdc_rate_burst = int(os.environ.get('CDC_RATE_BURST', 20))
+max_download_attempts = int(os.environ.get('CDC_MAX_ATTEMPTS', 5))
+
+# A checkpoint is saved after this many finished work items or seconds, whichever comes first
+checkpoint_every = int(os.environ.get('EXTRACT_CHECKPOINT_EVERY', 100))
+checkpoint_interval = float(os.environ.get('EXTRACT_CHECKPOINT_SECONDS', 30))
+
+# Location of the download manifest inside the bucket
+manifest_blob_name = 'manifest/manifest.json'
+
+# Helper function - one keep-alive HTTP session whose connection pool matches the worker count
+def create_http_session(concurrency):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('https://', adapter)
+    return session
+
+# Helper function - manifest key for a single CDC file
+def manifest_key(year, week, disease_table):
+    return f"{year}/{week:02d}/{disease_table}"
+
+# Load the download manifest from the bucket (empty if it does not exist yet)
+def load_manifest(bucket):
+    blob = bucket.blob(manifest_blob_name)
+    if not blob.exists():
+        print("No download manifest found, all files will be treated as new")
+        return {}
+    return json.loads(blob.download_as_text())
+
+# Merge a job's entries into the manifest in the bucket. Jobs can commit concurrently (backfill chunks), so the upload
+# is conditional on the generation that was read and retried when another job saved in between.
+def save_manifest(bucket, entries, max_attempts=10):
+    for attempt in range(max_attempts):
+        blob = bucket.get_blob(manifest_blob_name)  # None when the manifest does not exist yet
+        generation = blob.generation if blob else 0
+        try:
+            manifest = json.loads(blob.download_as_text(if_generation_match=generation)) if blob else {}
+            manifest.update(entries)
+            bucket.blob(manifest_blob_name).upload_from_string(json.dumps(manifest, sort_keys=True), content_type='application/json', if_generation_match=generation)
+            print(f"Saved download manifest with {len(manifest)} entries to {bucket.name}/{manifest_blob_name}")
+            return
+        except PreconditionFailed:
+            print(f"Manifest was updated by another job, retrying merge (attempt {attempt + 1})")
+            time.sleep(0.5 * (attempt + 1))
+    raise RuntimeError(f"Could not save the download manifest after {max_attempts} attempts")
+
+def download_txt_file(session, limiter, year, week, disease_table, previous=None):
+    # Returns a tuple (status, entry, size, content) where status is one of "new", "changed", "unchanged" or "missing";
+    # content is only returned for new or changed files
+    url = cdc_table_url(year, week, disease_table)
+
+    # Send a conditional request when the file has been seen before
+    headers = {}
+    if previous:
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+    response = fetch_with_backoff(session, url, limiter, headers=headers, max_attempts=max_download_attempts)
+
+    if response.status_code == 304:  # Not modified since the last run
+        print(f"Unchanged (304): Year {year}, Week {week}, Table {disease_table}")
+        return "unchanged", previous, 0, None
+    elif response.status_code == 200:  # Successful request
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        entry = {
+            "etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified'),
+            "sha256": content_hash,
+        }
+
+        # The server may ignore conditional headers, so compare the content hash as well
+        if previous and previous.get('sha256') == content_hash:
+            print(f"Unchanged (same content): Year {year}, Week {week}, Table {disease_table}")
+            return "unchanged", entry, len(response.content), None
+
+        return ("changed" if previous else "new"), entry, len(response.content), response.content
     elif response.status_code == 404:
         print(f"File not found for Year {year}, Week {week}, Table {disease_table} (Status Code: 404)")
     else:
-        print(f"Failed to download Year {year}, Week {week}, Table {disease_table} (Status Code: {response.status_code})")
         print(f"Download failed for Year {year}, Week {week}, Table {disease_table} (Status Code: {response.status_code})")
+    return "missing", None, 0, None
+
+# Download all work items on a thread pool, checkpointing progress, and collect throughput statistics
+def download_all(session, limiter, output, work_items, concurrency, checkpoint, manifest):
+    stats = {"files_requested": len(work_items), "files_downloaded": 0, "files_unchanged": 0, "files_missing": 0, "files_failed": 0, "bytes_downloaded": 0}
+    lock = threading.Lock()
+    checkpoint_lock = threading.Lock()
+    results = {}  # finished work items of this attempt, by manifest key
+    unwritten = []  # finished keys that have nothing to store (unchanged or missing)
+    progress = {"since_checkpoint": 0, "last_checkpoint": time.monotonic()}
+
+    # Record every item whose content is durably stored (plus unchanged/missing items) in the checkpoint
+    # The archive output only finishes its archive when it is full or at the end, so that a shard writes one archive
+    def save_checkpoint(final=False):
+        with checkpoint_lock:
+            committed = output.rotate(final)
+            with lock:
+                finished = committed + unwritten
+                unwritten.clear()
+                checkpoint.record({key: results[key] for key in finished})
+                progress["since_checkpoint"] = 0
+                progress["last_checkpoint"] = time.monotonic()
+            checkpoint.save()
+
+    def worker(year, week, disease_table):
+        key = manifest_key(year, week, disease_table)
+        try:
+            print(f"Attempting download for Year {year}, Week {week}, Table {disease_table}")
+            status, entry, size, content = download_txt_file(session, limiter, year, week, disease_table, manifest.get(key))
+            with lock:
+                results[key] = {"year": year, "week": week, "table": disease_table, "status": status, "entry": entry}
+
+            # Write the content to the job output (a single blob or an archive member)
+            if content is not None:
+                filename = f'{year}_week{week:02d}_table{disease_table:02d}.txt'
+                location = output.write(filename, content, key)
+                print(f"Successfully stored: {filename} at {location}")
+
+            with lock:
+                stats["bytes_downloaded"] += size
+                if status == "missing":
+                    stats["files_missing"] += 1
+                elif status == "unchanged":
+                    stats["files_unchanged"] += 1
+                else:
+                    stats["files_downloaded"] += 1
+                if content is None:
+                    unwritten.append(key)
+                progress["since_checkpoint"] += 1
+                checkpoint_due = (progress["since_checkpoint"] >= checkpoint_every
+                                  or time.monotonic() - progress["last_checkpoint"] >= checkpoint_interval)
+            if checkpoint_due:
+                save_checkpoint()
+        except (PermanentDownloadError, requests.exceptions.RequestException) as e:
+            # Log network-related errors and continue
+            print(f"Network error while downloading file for Year {year}, Week {week}, Table {disease_table}: {e}")
+            with lock:
+                stats["files_failed"] += 1
+        except Exception as e:
+            # Log all other errors and continue
+            print(f"Error downloading file for Year {year}, Week {week}, Table {disease_table}: {e}")
+            with lock:
+                stats["files_failed"] += 1
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker, *item) for item in work_items]
+        for future in as_completed(futures):
+            future.result()
+    elapsed = time.perf_counter() - start_time
+
+    # Finish the job output and take a final checkpoint
+    save_checkpoint(final=True)
+    stats["output"] = output.close()
+
+    stats["concurrency"] = concurrency
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["files_per_second"] = round(stats["files_downloaded"] / elapsed, 2) if elapsed > 0 else 0.0
+    stats["bytes_per_second"] = round(stats["bytes_downloaded"] / elapsed, 2) if elapsed > 0 else 0.0
+    stats["rate_limiter"] = limiter.snapshot()
+    return stats
 
 # Google Cloud Function entry point
 @functions_framework.http
+@instrumented("extract")
 def task(request):
-    # Generate a unique job ID
-    job_id = datetime.now().strftime('%Y%m%d_%H%M%S') + '_' + str(uuid.uuid4())
+    request_json = request.get_json(silent=True) or {}
+
+    # Configuration the flows plan their shards with
+    if request_json.get('describe'):
+        return {"disease_tables": disease_tables_all, "start_year": default_start_year,
+                "rate_limit": cdc_rate_limit, "rate_burst": cdc_rate_burst}, 200
+
+    # Use the job ID from the request (to resume a job) or generate a unique one
+    job_id = request_json.get('job_id') or datetime.now().strftime('%Y%m%d_%H%M%S') + '_' + str(uuid.uuid4())
+    if not is_valid_job_id(job_id):
+        return f"Invalid job_id '{job_id}'", 400
+    shard = request_json.get('shard', 'all')
+    if not is_valid_shard(shard):
+        return f"Invalid shard '{shard}'", 400
+
+    # A single storage client and bucket handle are shared by all workers
+    storage_client = storage.Client(project=project_id)
+    bucket = storage_client.bucket(bucket_name)
+
+    # The job's files reached staging: record them in the manifest so later runs skip them
+    if request_json.get('commit_manifest'):
+        checkpoints = JobCheckpoint.load_all(bucket, job_id)
+        if not checkpoints:
+            return f"Job {job_id} has no checkpoints to commit", 404
+        entries = {key: entry for checkpoint in checkpoints for key, entry in checkpoint.manifest_entries().items()}
+        save_manifest(bucket, entries)
+        return {"job_id": job_id, "shards": [checkpoint.shard for checkpoint in checkpoints], "manifest_entries": len(entries)}, 200
+
+    checkpoint = JobCheckpoint.load(bucket, job_id, shard)
+    if checkpoint and checkpoint.complete:
+        print(f"Job {job_id} shard {shard} already completed, returning its stored result")
+        return {**checkpoint.result, "cache": {"status": "hit", "key": f"{job_id}/{shard}"}}, 200
+
+    if checkpoint:
+        # Resume with the parameters the job was started with so the plan stays the same
+        params = checkpoint.params
+        print(f"Resuming job {job_id} shard {shard}: {len(checkpoint.completed)} work items already completed")
+    else:
+        today = date.today()
+        params = {
+            "disease_tables": [int(t) for t in request_json.get('disease_tables', disease_tables_all)],
+            "start_year": int(request_json.get('start_year', default_start_year)),
+            "end_year": int(request_json.get('end_year', last_completed_mmwr_week(today)[0])),
+            "week_range": None,
+            "full_refresh": bool(request_json.get('full_refresh', False)),
+            "output_mode": request_json.get('output_mode', default_output_mode),
+            "planned_on": today.isoformat(),
+        }
+        if request_json.get('start_date'):
+            try:
+                start_date = date.fromisoformat(request_json['start_date'])
+                end_date = date.fromisoformat(request_json['end_date']) if request_json.get('end_date') else today
+            except ValueError:
+                return f"Invalid date range {request_json.get('start_date')} - {request_json.get('end_date')}, expected YYYY-MM-DD", 400
+            if end_date < start_date:
+                return f"end_date {end_date} is before start_date {start_date}", 400
+            params["week_range"] = [list(mmwr_week(start_date)), list(mmwr_week(end_date))]
+            params["start_year"], params["end_year"] = params["week_range"][0][0], params["week_range"][1][0]
+        if params["output_mode"] not in ('archive', 'files'):
+            return f"Unknown output_mode '{params['output_mode']}', expected 'archive' or 'files'", 400
+        unknown_tables = set(params["disease_tables"]) - set(disease_tables_all)
+        if unknown_tables:
+            return f"Unknown disease tables: {sorted(unknown_tables)}", 400
+        checkpoint = JobCheckpoint(bucket, job_id, shard, params)
 
     # Parameters for the function
-    years = [2023, 2024]
-    current_week = datetime.now().isocalendar()[1] - 1
-    disease_tables = [250,350,354,370,392,550,560,1122,1130,1140]
-
-    for disease_table in disease_tables:
-        for year in years:
-            if year == 2024:
-                weeks_range = range(1, current_week + 1)
-            else:
-                weeks_range = range(1, 53)
-
-            for week in weeks_range:
-                try:
-                    print(f"Attempting download for Year {year}, Week {week}, Table {disease_table}")
-                    download_txt_file(year, week, disease_table, bucket_name, job_id)
-                except requests.exceptions.RequestException as e:
-                    # Log network-related errors and continue
-                    print(f"Network error while downloading file for Year {year}, Week {week}, Table {disease_table}: {e}")
-                    pass  # Continue with the next iteration
-                except Exception as e:
-                    # Log all other errors and continue
-                    print(f"Error downloading file for Year {year}, Week {week}, Table {disease_table}: {e}")
-                    pass  # Continue with the next iteration
-
-    return {"job_id": job_id}, 200
+    concurrency = max(1, int(request_json.get('concurrency', default_concurrency)))
+    checkpoint.attempts += 1
+
+    # One HTTP session and rate limiter are shared by all workers
+    session = create_http_session(concurrency)
+    reset_limiters()  # counters and the concurrency window are tracked per run
+    rate_limit = min(cdc_rate_limit, float(request_json.get('rate_limit', cdc_rate_limit)))
+    rate_burst = max(1, min(cdc_rate_burst, int(request_json.get('rate_burst', cdc_rate_burst))))
+    limiter = get_limiter('https://wonder.cdc.gov', rate_limit, rate_burst, concurrency)
+
+    try:
+        # Only plan the MMWR weeks that can exist, probing the latest published week per table
+        planned_on = date.fromisoformat(params["planned_on"])
+        week_range = [tuple(week) for week in params["week_range"]] if params.get("week_range") else None
+        work_items, plan = plan_work_items(session, limiter, params["start_year"], params["end_year"], params["disease_tables"],
+                                           planned_on, concurrency, week_range)
+        print(f"Planned {len(work_items)} downloads for years {params['start_year']}-{params['end_year']}")
+
+        # Skip the work items finished by earlier attempts of this job
+        remaining = [item for item in work_items if manifest_key(*item) not in checkpoint.completed]
+        plan["resumed_items"] = len(work_items) - len(remaining)
+
+        manifest = {} if params["full_refresh"] else load_manifest(bucket)
+        output = create_output(params["output_mode"], bucket, job_id)
+        stats = download_all(session, limiter, output, remaining, concurrency, checkpoint, manifest)
+    finally:
+        session.close()
 
+    changed_files = checkpoint.changed_files()
+    record(bytes_read=stats["bytes_downloaded"], rows_out=len(changed_files))
+    print(f"Extraction stats: {json.dumps(stats)}")
+    print(f"{len(changed_files)} new or changed files written under job {job_id} shard {shard}")
 
+    # Only a run without failed downloads completes the job; otherwise a retry with this job_id picks up the rest
+    complete = stats["files_failed"] == 0
+    result = {"job_id": job_id, "shard": shard, "complete": complete, "attempt": checkpoint.attempts, "plan": plan, "stats": stats, "changed_files": changed_files}
+    if complete:
+        checkpoint.result = result
+    checkpoint.save()
+    return {**result, "cache": {"status": "miss", "key": f"{job_id}/{shard}"}}, 200
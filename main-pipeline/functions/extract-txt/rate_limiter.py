@@ -0,0 +1,165 @@
+# Adaptive rate limiting for requests sent to wonder.cdc.gov
+#
+# Every host gets one AdaptiveRateLimiter that is shared by all extraction workers. It combines:
+# - a token bucket that caps the request rate (requests per second, with a small burst),
+# - an AIMD concurrency window: +1/window per successful request, halved on every throttle (429/503),
+# - a global pause that honours the Retry-After header sent with throttled responses, up to max_delay, so a server
+#   asking for an hour can't hold the download threads past the function timeout.
+# fetch_with_backoff() sends GET/HEAD requests, retries retryable responses with jittered exponential
+# backoff and records counters for requests, throttles, retries and permanent failures.
+
+import email.utils
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+
+# Status codes that are worth retrying; 429 and 503 also shrink the concurrency window
+retryable_status_codes = {429, 500, 502, 503, 504}
+throttle_status_codes = {429, 503}
+
+
+class PermanentDownloadError(Exception):
+    """Raised when a request still fails after all retry attempts."""
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, rate, burst, max_concurrency, min_concurrency=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+        self.counters = {"requests": 0, "throttles": 0, "retries": 0, "permanent_failures": 0}
+
+    # Wait until the token bucket has a token and there is room in the concurrency window
+    def _acquire(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._in_flight >= int(self.concurrency_limit):
+                    wait = None  # woken up by _release()
+                elif self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self.counters["requests"] += 1
+                    return
+                self._condition.wait(timeout=wait)
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    # Additive increase: the window grows by roughly one slot per window of successful requests
+    def on_success(self):
+        with self._condition:
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+            self._condition.notify_all()
+
+    # Multiplicative decrease, plus a pause for every worker when the server sent Retry-After
+    def on_throttle(self, retry_after=None):
+        with self._condition:
+            self.counters["throttles"] += 1
+            self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            print(f"Throttled by server, concurrency window is now {int(self.concurrency_limit)}")
+
+    def record(self, counter):
+        with self._condition:
+            self.counters[counter] += 1
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self.counters, concurrency_limit=int(self.concurrency_limit))
+
+
+# Registry of limiters, one per host, shared by every worker in this instance
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(url, rate, burst, max_concurrency):
+    host = urlparse(url).netloc
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = AdaptiveRateLimiter(rate, burst, max_concurrency)
+        return _limiters[host]
+
+def reset_limiters():
+    with _limiters_lock:
+        _limiters.clear()
+
+# Helper function - Retry-After may be a number of seconds or an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Helper function - "full jitter" exponential backoff
+def backoff_delay(attempt, base_delay, max_delay):
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+# Send a request (GET by default) through the limiter, retrying network errors and retryable status codes
+def fetch_with_backoff(session, url, limiter, headers=None, max_attempts=5, base_delay=1.0, max_delay=60.0, timeout=(5, 30), method='GET'):
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            limiter.record("retries")
+
+        try:
+            with limiter.slot():
+                response = session.request(method, url, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            if attempt == max_attempts - 1:
+                limiter.record("permanent_failures")
+                raise PermanentDownloadError(f"{url} failed after {max_attempts} attempts: {e}") from e
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            continue
+
+        if response.status_code not in retryable_status_codes:
+            limiter.on_success()
+            return response
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            retry_after = min(retry_after, max_delay)
+        if response.status_code in throttle_status_codes:
+            limiter.on_throttle(retry_after)
+        if attempt == max_attempts - 1:
+            limiter.record("permanent_failures")
+            raise PermanentDownloadError(f"{url} failed after {max_attempts} attempts (Status Code: {response.status_code})")
+        time.sleep(retry_after if retry_after is not None else backoff_delay(attempt, base_delay, max_delay))
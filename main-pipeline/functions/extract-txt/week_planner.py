@@ -0,0 +1,125 @@
+# MMWR week planning for CDC NNDSS downloads
+#
+# CDC publishes the weekly tables by MMWR week, not ISO week. MMWR week 1 is the first Sunday-Saturday
+# week with at least four days in the calendar year, so a year has 52 or 53 weeks and the first week can
+# start in late December. This module computes the valid weeks for a range of years and probes the latest
+# published week of each table (HEAD requests + binary search) so the downloader only requests files that
+# can exist. A probe that fails plans all the candidate weeks of its (year, table) instead of failing the job; the
+# plan lists it under failed_probes.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from rate_limiter import fetch_with_backoff
+
+# Number of weeks after a year ends during which its last weeks may still be unpublished
+publication_lag_weeks = 8
+
+# Helper function - URL of a weekly CDC table
+def cdc_table_url(year, week, disease_table):
+    return f'https://wonder.cdc.gov/nndss/static/{year}/{week:02d}/{year}-{week:02d}-table{disease_table:02d}.txt'
+
+# First day (a Sunday) of MMWR week 1: the Sunday of the week that contains January 4th
+def mmwr_week_one_start(year):
+    jan4 = date(year, 1, 4)
+    return jan4 - timedelta(days=(jan4.weekday() + 1) % 7)
+
+# Number of MMWR weeks in a year (52 or 53)
+def weeks_in_mmwr_year(year):
+    return (mmwr_week_one_start(year + 1) - mmwr_week_one_start(year)).days // 7
+
+# Convert a calendar date to its (MMWR year, MMWR week)
+def mmwr_week(day):
+    year = day.year
+    if day < mmwr_week_one_start(year):
+        year -= 1
+    elif day >= mmwr_week_one_start(year + 1):
+        year += 1
+    return year, (day - mmwr_week_one_start(year)).days // 7 + 1
+
+# Last MMWR week that has fully ended (its Saturday is before the given day)
+def last_completed_mmwr_week(today):
+    return mmwr_week(today - timedelta(days=(today.weekday() + 1) % 7 + 1))
+
+# Candidate weeks per year: every week of past years, up to the last completed week for the latest year
+def candidate_weeks(start_year, end_year, today):
+    last_year, last_week = last_completed_mmwr_week(today)
+    weeks = {}
+    for year in range(start_year, min(end_year, last_year) + 1):
+        weeks[year] = last_week if year == last_year else weeks_in_mmwr_year(year)
+    return weeks
+
+# Years whose final weeks may not be published yet and therefore need probing
+def years_to_probe(weeks, today):
+    recent_year, _ = mmwr_week(today - timedelta(weeks=publication_lag_weeks))
+    return [year for year in weeks if year >= recent_year]
+
+# Check whether a weekly file exists with a HEAD request
+def week_exists(session, limiter, year, week, disease_table):
+    response = fetch_with_backoff(session, cdc_table_url(year, week, disease_table), limiter, method='HEAD')
+    return response.status_code == 200
+
+# Binary search for the latest published week, assuming weeks 1..N are published and N+1.. are not
+def probe_latest_week(session, limiter, year, disease_table, max_week):
+    low, high = 0, max_week
+    probes = 0
+    while low < high:
+        middle = (low + high + 1) // 2
+        probes += 1
+        if week_exists(session, limiter, year, middle, disease_table):
+            low = middle
+        else:
+            high = middle - 1
+    return low, probes
+
+# Probe one (year, table); a probe that fails falls back to every candidate week, since downloads of unpublished
+# weeks fail softly. Returns (latest week, probes, error or None)
+def probe_or_fallback(session, limiter, year, disease_table, max_week):
+    try:
+        return (*probe_latest_week(session, limiter, year, disease_table, max_week), None)
+    except Exception as e:
+        print(f"Probing Year {year}, Table {disease_table} failed, planning all {max_week} candidate weeks: {e}")
+        return max_week, 0, str(e)
+
+# Build the list of (year, week, table) work items that can exist for this run
+# week_range ((year, week), (year, week)), inclusive, restricts the plan to a window of MMWR weeks (backfill chunks)
+def plan_work_items(session, limiter, start_year, end_year, disease_tables, today=None, concurrency=8, week_range=None):
+    today = today or date.today()
+    weeks = candidate_weeks(start_year, end_year, today)
+    probe_years = years_to_probe(weeks, today)
+
+    # Probe the recent years of every table in parallel (each probe is a short binary search)
+    probe_keys = [(year, disease_table) for disease_table in disease_tables for year in probe_years]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        probe_results = dict(zip(probe_keys, executor.map(
+            lambda key: probe_or_fallback(session, limiter, key[0], key[1], weeks[key[0]]), probe_keys)))
+
+    work_items = []
+    latest_weeks = {}
+    failed_probes = {}
+    head_requests = 0
+    for disease_table in disease_tables:
+        for year, max_week in weeks.items():
+            if (year, disease_table) in probe_results:
+                max_week, probes, error = probe_results[(year, disease_table)]
+                head_requests += probes
+                if error:
+                    failed_probes[f"{year}/{disease_table}"] = error
+                latest_weeks[f"{year}/{disease_table}"] = max_week
+                print(f"Latest published week for Year {year}, Table {disease_table}: {max_week}")
+
+            for week in range(1, max_week + 1):
+                if week_range and not week_range[0] <= (year, week) <= week_range[1]:
+                    continue
+                work_items.append((year, week, disease_table))
+
+    plan = {
+        "years": {str(year): max_week for year, max_week in weeks.items()},
+        "latest_published_weeks": latest_weeks,
+        "head_requests": head_requests,
+        "failed_probes": failed_probes,
+        "work_items": len(work_items),
+    }
+    if week_range:
+        plan["week_range"] = [f"{year}/{week:02d}" for year, week in week_range]
+    return work_items, plan
@@ -1,10 +1,25 @@
-import pandas as pd
-import pyarrow  # Import pyarrow to ensure Parquet file support
-from google.cloud import bigquery
-from google.cloud import storage
+# Cloud Function to load the Parquet output of the transform step into the BigQuery raw table
+#
+# The Parquet file is never downloaded by the function: BigQuery reads it directly from its gs:// URI.
+# 1. A load job with the Parquet schema declared (int Disease, date Date) reads the file(s) into a landing table
+#    that expires after a day. {"job_id": ...} loads cdc_data_{job_id}.parquet; {"source_uri": "gs://.../cdc_data_*.parquet"}
+#    loads a single file or a wildcard across jobs from the same bucket.
+# 2. One transaction replaces the contents of cdc_occurrences_raw with the landing rows (converting Disease to the raw
+#    table's STRING), so raw only ever holds the current load and a retried load doesn't duplicate rows.
+# 3. The landing table is dropped. The response reports the load job's rows, bytes and duration, and the request's
+#    telemetry (telemetry.py).
+# Loads are cached by content (stage_cache.py): the key is the MD5 of the source Parquet file(s). When the raw table
+# hasn't been modified since the load stored under that key, it already holds exactly these rows and the function
+# returns the stored result without loading. {"use_cache": false} forces the load.
+
+from google.cloud import bigquery, storage
 import functions_framework
-import io
+import fnmatch
 import json
+from stage_cache import cache_info, cache_key, lookup, store
+from telemetry import instrumented, record
+import re
+from datetime import datetime, timedelta, timezone
 
 # Google Cloud project and bucket/table information
 project_id = 'ba882-group-10'
@@ -12,36 +27,116 @@ bucket_name = 'cdc-extract-dataframe'  # Parquet file storage bucket
 dataset_id = 'cdc_data'  # Your BigQuery dataset
 table_id = 'cdc_occurrences_raw'  # Your BigQuery raw table
 
+# Schema of the Parquet files written by the transform step
+parquet_schema = [
+    bigquery.SchemaField("Disease", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("Region", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Current_Week_Occurrence_Count", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("Date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("Fingerprint", "INTEGER", mode="NULLABLE"),
+]
+
+# Helper function - landing table name for a load (table names can't contain every job_id character)
+def landing_table_id(job_id):
+    return f"{project_id}.{dataset_id}.cdc_occurrences_load_{re.sub(r'[^A-Za-z0-9_]', '_', job_id)}"
+
+# Helper function - the objects a source URI refers to (one file, or a wildcard like BigQuery's)
+def source_blobs(bucket, source_uri):
+    name = source_uri[len(f"gs://{bucket_name}/"):]
+    if '*' not in name:
+        blob = bucket.get_blob(name)
+        return [blob] if blob else []
+    return [blob for blob in bucket.list_blobs(prefix=name.split('*')[0]) if fnmatch.fnmatchcase(blob.name, name)]
+
+# Helper function - last-modified time of a table in epoch milliseconds
+def modified_ms(table):
+    return int(table.modified.timestamp() * 1000)
+
+# Helper function - seconds between two job timestamps
+def job_seconds(job):
+    if job.started and job.ended:
+        return round((job.ended - job.started).total_seconds(), 3)
+    return None
+
 @functions_framework.http
+@instrumented("load_to_raw")
 def load_to_bigquery(request):
-    # Parse request to get job_id
+    # Parse request to get job_id (or an explicit gs:// URI)
     request_json = request.get_json()
     job_id = request_json.get('job_id') if request_json else None
-    if not job_id:
+    source_uri = request_json.get('source_uri') if request_json else None
+    if not job_id and not source_uri:
         return "Missing job_id in request payload", 400
+    if source_uri and not source_uri.startswith(f"gs://{bucket_name}/"):
+        return f"source_uri must point to gs://{bucket_name}/", 400
+    source_uri = source_uri or f"gs://{bucket_name}/cdc_data_{job_id}.parquet"
+    load_name = job_id or datetime.now().strftime('%Y%m%d_%H%M%S')
+    use_cache = bool(request_json.get('use_cache', True))
 
-    # Initialize BigQuery and GCS clients
+    # Initialize BigQuery client
     bigquery_client = bigquery.Client(project=project_id)
-    storage_client = storage.Client(project=project_id)
-    
-    # Get the bucket and blob (parquet file)
-    output_blob_name = f'cdc_data_{job_id}.parquet'
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(output_blob_name)
-    
-    # Download the parquet file into memory
-    parquet_data = io.BytesIO(blob.download_as_bytes())
-    
-    # Read the parquet data into a DataFrame
-    df = pd.read_parquet(parquet_data)
-    
-    # Define the BigQuery table to write to
-    table_ref = bigquery_client.dataset(dataset_id).table(table_id)
-    
-    # Write the DataFrame to BigQuery (append the data)
-    job = bigquery_client.load_table_from_dataframe(df, table_ref)
-    job.result()  # Wait for the job to complete
-    
-    print(f"Loaded {len(df)} rows into BigQuery table {table_id}.")
-    
-    return {}, 200
+    raw_table_id = f"{project_id}.{dataset_id}.{table_id}"
+
+    # The cache key is the content of the source files, whatever their names
+    bucket = storage.Client(project=project_id).bucket(bucket_name)
+    blobs = source_blobs(bucket, source_uri)
+    if not blobs:
+        return f"No Parquet file matches {source_uri}", 404
+    key = cache_key(sorted((blob.md5_hash or blob.crc32c, blob.size) for blob in blobs))
+    cached = lookup(bucket, 'load_to_raw', key) if use_cache else None
+    if cached and cached["raw_modified_ms"] == modified_ms(bigquery_client.get_table(raw_table_id)):
+        print(f"Raw table unchanged since {cached['source_uri']} was loaded, skipping the load of {source_uri}")
+        return json.dumps({"message": "Raw table already holds this load.", "job_id": job_id, "stats": cached["stats"],
+                           "cache": cache_info("hit", key)}), 200
+    landing_id = landing_table_id(load_name)
+
+    try:
+        # The landing table expires on its own if the function dies before dropping it
+        landing_table = bigquery.Table(landing_id, schema=parquet_schema)
+        landing_table.expires = datetime.now(timezone.utc) + timedelta(days=1)
+        bigquery_client.create_table(landing_table, exists_ok=True)
+
+        # Load job straight from GCS: no bytes pass through the function
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=parquet_schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        load_job = bigquery_client.load_table_from_uri(source_uri, landing_id, job_config=job_config)
+        load_job.result()  # Wait for the job to complete
+        print(f"Loaded {load_job.output_rows} rows from {source_uri} into {landing_id}")
+
+        # Replace the raw table's rows with this load (Disease codes are stored as strings there)
+        insert_job = bigquery_client.query(f"""
+        BEGIN TRANSACTION;
+        DELETE FROM `{raw_table_id}` WHERE TRUE;
+        INSERT INTO `{raw_table_id}` (Disease, Region, Current_Week_Occurrence_Count, Date, Fingerprint)
+        SELECT CAST(Disease AS STRING), Region, Current_Week_Occurrence_Count, Date, Fingerprint
+        FROM `{landing_id}`;
+        COMMIT TRANSACTION;
+        """)
+        insert_job.result()
+    except Exception as e:
+        print(f"Error loading {source_uri} into BigQuery: {str(e)}")
+        return f"Error loading {source_uri} into BigQuery: {str(e)}", 500
+    finally:
+        bigquery_client.delete_table(landing_id, not_found_ok=True)
+
+    stats = {
+        "source_uri": source_uri,
+        "input_files": load_job.input_files,
+        "input_bytes": load_job.input_file_bytes,
+        "rows": load_job.output_rows,
+        "bytes": load_job.output_bytes,
+        "load_seconds": job_seconds(load_job),
+        "insert_seconds": job_seconds(insert_job),
+        "insert_bytes_processed": insert_job.total_bytes_processed,
+    }
+    print(f"Loaded {stats['rows']} rows into BigQuery table {table_id}: {json.dumps(stats)}")
+    record(rows_in=load_job.output_rows, bytes_read=load_job.input_file_bytes, rows_out=load_job.output_rows)
+
+    # Keyed to the raw table's state after this load: any later write to raw invalidates the entry
+    store(bucket, 'load_to_raw', key, {"source_uri": source_uri, "stats": stats,
+                                      "raw_modified_ms": modified_ms(bigquery_client.get_table(raw_table_id))})
+    return json.dumps({"message": "Load completed.", "job_id": job_id, "stats": stats,
+                       "cache": cache_info("miss" if use_cache else "bypass", key)}), 200
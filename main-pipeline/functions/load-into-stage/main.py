@@ -1,25 +1,51 @@
 # Google Cloud Function to upsert records from raw table to staging table in BigQuery
-# 
+#
 # This function takes records from the raw table (`cdc_occurrences_raw`) and inserts them into the staging table (`cdc_occurrences_staging`) in BigQuery.
-# It ensures that only new records are copied from the raw table to the staging table, based on the unique combination of Disease, Region, and Date.
-# Records that already exist in the staging table are not duplicated.
+# New records are copied from the raw table to the staging table, based on the unique combination of Disease, Region, and Date.
+# Records that already exist in the staging table are not duplicated; records whose counts were revised are updated.
+#
+# The upsert is incremental:
+# - A high-watermark (the raw table's last-modified time at the last successful merge) is kept as a label on the
+#   staging table. Table metadata is free to read, so when raw is empty or has not changed since the last merge the
+#   function returns without running any query. {"force": true} ignores the watermark.
+#   The watermark is this stage's cache key: the response reports {"cache": {"status": "hit" | "miss", "key": ...}}
+#   like the content-keyed stages (see stage_cache.py).
+# - Otherwise the Date window present in raw is computed first, and a single MERGE restricts the staging side to that
+#   window, so only the matching Date partitions of the staging table are scanned.
+#
+# Revisions: the CDC revises counts of earlier weeks. Every row carries a Fingerprint (content hash computed by the
+# transform step), so a changed row is found by comparing one column. Rows whose key is missing are inserted, rows
+# whose fingerprint differs are updated (count and fingerprint), and one row per run is appended to cdc_revision_log
+# with the number of inserted and revised rows. Staging rows written before fingerprints existed simply take over
+# the new fingerprint (counted as fingerprints_added, not as revisions).
 
 # imports
 import functions_framework
 from google.cloud import bigquery
 import json
+from telemetry import instrumented, record
 
 # Project variables
 project_id = 'ba882-group-10'  # Replace with your project ID
 
 dataset_id = f"{project_id}.cdc_data"  # Dataset ID
 
+# Label on the staging table holding the watermark
+watermark_label = 'raw_modified_ms'
+
+# Helper function - watermark of the raw table: its last-modified time in epoch milliseconds
+def raw_watermark(raw_table):
+    return str(int(raw_table.modified.timestamp() * 1000))
+
 # Google Cloud Function entry point
 @functions_framework.http
+@instrumented("load_to_stage")
 def task(request):
     # Parse the request data
     request_json = request.get_json(silent=True)
     print(f"request: {json.dumps(request_json)}")
+    force = bool((request_json or {}).get('force', False))
+    job_id = (request_json or {}).get('job_id')
 
     # Initialize BigQuery client
     client = bigquery.Client()
@@ -27,20 +53,108 @@ def task(request):
     # Define table names
     raw_table_id = f"{dataset_id}.cdc_occurrences_raw"
     stage_table_id = f"{dataset_id}.cdc_occurrences_staging"
+    revision_log_id = f"{dataset_id}.cdc_revision_log"
+
+    # No-op runs are decided from table metadata only
+    raw_table = client.get_table(raw_table_id)
+    stage_table = client.get_table(stage_table_id)
+    watermark = raw_watermark(raw_table)
+    if not raw_table.num_rows:
+        print(f"Raw table {raw_table_id} is empty, nothing to upsert")
+        return json.dumps({"status": "skipped", "reason": "raw table is empty"}), 200
+    if not force and stage_table.labels.get(watermark_label) == watermark:
+        print(f"Raw table {raw_table_id} has not changed since the last upsert, nothing to do")
+        return json.dumps({"status": "skipped", "reason": "watermark unchanged", "watermark": watermark,
+                           "cache": {"status": "hit", "key": watermark}}), 200
 
-    # Query to get records from raw table that are not in the staging table
+    # Date window present in the raw table
+    window_job = client.query(f"SELECT MIN(Date) AS start_date, MAX(Date) AS end_date FROM `{raw_table_id}`")
+    window = list(window_job.result())[0]
+    if window.start_date is None:
+        return json.dumps({"status": "skipped", "reason": "raw table is empty"}), 200
+    print(f"Raw table covers {window.start_date} to {window.end_date}")
+
+    # One script: collect the rows that are new or whose fingerprint changed, apply them with a MERGE that only
+    # touches those rows, log the counts and return them. The constant Date range on the staging side lets
+    # BigQuery prune every staging partition outside the raw window.
+    # Raw holds a single load, so there is no load order to pick a duplicate key by; ties are broken on the row's
+    # content instead (fingerprinted rows first, then the highest fingerprint and count), so every run of the same
+    # raw table keeps the same row.
+    window_filter = f"Date BETWEEN DATE '{window.start_date}' AND DATE '{window.end_date}'"
     query = f"""
-    INSERT INTO `{stage_table_id}` (Disease, Region, Current_Week_Occurrence_Count, Date)
-    SELECT r.Disease, r.Region, r.Current_Week_Occurrence_Count, r.Date
-    FROM `{raw_table_id}` r
-    LEFT JOIN `{stage_table_id}` s
+    CREATE TEMP TABLE changes AS
+    SELECT r.Disease, r.Region, r.Current_Week_Occurrence_Count, r.Date, r.Fingerprint,
+        CASE
+            WHEN s.Disease IS NULL THEN 'insert'
+            WHEN s.Fingerprint IS NULL THEN 'fingerprint'
+            ELSE 'revision'
+        END AS change_type,
+        r.Current_Week_Occurrence_Count - IFNULL(s.Current_Week_Occurrence_Count, 0) AS count_delta
+    FROM (
+        SELECT Disease, Region, Current_Week_Occurrence_Count, Date, Fingerprint
+        FROM `{raw_table_id}`
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY Disease, Region, Date
+            ORDER BY Fingerprint IS NULL, Fingerprint DESC, Current_Week_Occurrence_Count DESC
+        ) = 1
+    ) r
+    LEFT JOIN (SELECT * FROM `{stage_table_id}` WHERE {window_filter}) s
     ON r.Disease = s.Disease AND r.Region = s.Region AND r.Date = s.Date
-    WHERE s.Disease IS NULL
+    WHERE s.Disease IS NULL OR (r.Fingerprint IS NOT NULL AND s.Fingerprint IS DISTINCT FROM r.Fingerprint);
+
+    MERGE `{stage_table_id}` s
+    USING changes r
+    ON s.{window_filter}
+        AND r.Disease = s.Disease AND r.Region = s.Region AND r.Date = s.Date
+    WHEN MATCHED THEN
+        UPDATE SET Current_Week_Occurrence_Count = r.Current_Week_Occurrence_Count, Fingerprint = r.Fingerprint
+    WHEN NOT MATCHED THEN
+        INSERT (Disease, Region, Current_Week_Occurrence_Count, Date, Fingerprint)
+        VALUES (r.Disease, r.Region, r.Current_Week_Occurrence_Count, r.Date, r.Fingerprint);
+
+    CREATE TEMP TABLE summary AS
+    SELECT
+        CURRENT_TIMESTAMP() AS run_at,
+        @job_id AS job_id,
+        DATE '{window.start_date}' AS window_start,
+        DATE '{window.end_date}' AS window_end,
+        COUNTIF(change_type = 'insert') AS rows_inserted,
+        COUNTIF(change_type = 'revision') AS rows_revised,
+        COUNTIF(change_type = 'fingerprint') AS fingerprints_added,
+        IFNULL(SUM(IF(change_type = 'revision', count_delta, 0)), 0) AS count_delta
+    FROM changes;
+
+    INSERT INTO `{revision_log_id}` SELECT * FROM summary;
+
+    SELECT * FROM summary;
     """
 
-    # Execute the query
-    query_job = client.query(query)
-    query_job.result()  # Wait for the job to complete
-    print(f"Inserted new records from {raw_table_id} into {stage_table_id}")
+    # Execute the script
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("job_id", "STRING", job_id)])
+    query_job = client.query(query, job_config=job_config)
+    summary = list(query_job.result())[0]  # Wait for the script to complete; the last statement returns the summary
+    print(f"Inserted {summary.rows_inserted} new and revised {summary.rows_revised} records from {raw_table_id} in {stage_table_id}")
+
+    # Persist the watermark only after the merge succeeded. The MERGE changed the table's etag, which update_table
+    # sends as If-Match, so the table is read again first.
+    stage_table = client.get_table(stage_table_id)
+    stage_table.labels = {**stage_table.labels, watermark_label: watermark}
+    client.update_table(stage_table, ["labels"])
+
+    stats = {
+        "window": [str(window.start_date), str(window.end_date)],
+        "rows_inserted": summary.rows_inserted,
+        "rows_revised": summary.rows_revised,
+        "fingerprints_added": summary.fingerprints_added,
+        "count_delta": summary.count_delta,
+        "window_bytes_processed": window_job.total_bytes_processed,
+        "merge_bytes_processed": query_job.total_bytes_processed,
+        "watermark": watermark,
+    }
+    print(f"Upsert stats: {json.dumps(stats)}")
+    record(rows_in=raw_table.num_rows, rows_out=summary.rows_inserted + summary.rows_revised + summary.fingerprints_added,
+           bytes_read=(window_job.total_bytes_processed or 0) + (query_job.total_bytes_processed or 0))
 
-    return {}, 200
+    return json.dumps({"status": "merged", "stats": stats,
+                       "cache": {"status": "bypass" if force else "miss", "key": watermark}}), 200
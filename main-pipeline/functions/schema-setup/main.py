@@ -1,74 +1,100 @@
-# Cloud Function to create a schema in BigQuery for storing CDC data
+# Cloud Function to create the BigQuery schema used by the pipelines
 # 
-# This function creates three tables in BigQuery: a raw table, a staging table for storing CDC data, and a disease dictionary table.
-# - If the raw and staging tables do not exist, it creates them; if they do exist, it clears the data to prepare for a new job run.
-# - The disease dictionary table (disease_dic) is created if it does not already exist.
+# Every table (raw, staging, revision log, disease dictionary, and the MLOps, symptom, census and dashboard tables) is
+# declared once in schema_registry.py, and this function brings BigQuery in line with it:
+# - A fingerprint of the registry is stored as a label on the cdc_data dataset. When it matches, the function returns
+#   right away; {"force": true} compares the tables anyway.
+# - Otherwise the current tables are read with one INFORMATION_SCHEMA query and only the DDL for the difference
+#   (missing datasets and tables, new NULLABLE columns) is run, as a single script.
 # - The disease dictionary table contains mappings of disease codes to disease labels.
+# - The revision log table (cdc_revision_log) gets one row per staging upsert with the number of inserted and revised rows.
+# - The raw and staging tables store Date as DATE, are partitioned by Date and clustered on Disease and Region, so
+#   queries that filter on a date window or a disease only scan the matching partitions and blocks.
+# - Tables created before that (Date as STRING, no partitioning) are migrated in place: the rows are copied into a
+#   new partitioned table, the row counts are compared, and only then the tables are swapped. The old table is
+#   kept as {table}_backup_{timestamp} for backup_retention_days.
+#   benchmarks/measure_bigquery_bytes.py reports the bytes scanned by the pipeline's queries before and after.
+# The raw table is no longer cleared here: load-into-raw replaces its contents in the same transaction as the load.
 
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 import functions_framework
+import json
+from datetime import datetime, timedelta, timezone
+from schema_registry import apply_schema_registry, create_table_statement, full_table_id
+from telemetry import instrumented
 
-def create_bigquery_schema():
-    # Initialize BigQuery client
-    client = bigquery.Client()
-    
-    # Define dataset and table information
-    dataset_id = "ba882-group-10.cdc_data"  # Replace with your dataset ID
-    
-    # Define schema for the raw table
-    raw_table_id = f"{dataset_id}.cdc_occurrences_raw"
-    raw_schema = [
-        bigquery.SchemaField("Disease", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("Region", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("Current_Week_Occurrence_Count", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("Date", "STRING", mode="REQUIRED")
-    ]
-    
-    # Set up raw table information
-    raw_table = bigquery.Table(raw_table_id, schema=raw_schema)
-    
-    # Create raw table in BigQuery (if not exists)
-    raw_table = client.create_table(raw_table, exists_ok=True)
-    print(f"Created or updated raw table {raw_table_id} with schema")
+# Days the pre-migration copy of a table is kept
+backup_retention_days = 7
+
+# Only the raw and staging tables have ever changed layout (Date as STRING, no partitioning), so only they are migrated
+migrated_tables = {"cdc_data.cdc_occurrences_raw", "cdc_data.cdc_occurrences_staging"}
+
+# Helper function - check whether a table exists
+def table_exists(client, table_id):
+    try:
+        client.get_table(table_id)
+        return True
+    except NotFound:
+        return False
+
+# Helper function - count the rows of a table with a query (num_rows misses rows in the streaming buffer)
+def count_rows(client, table_id):
+    return list(client.query(f"SELECT COUNT(*) AS n FROM `{table_id}`").result())[0].n
+
+# Copy a string-dated table into a table laid out as in the registry and swap the two
+def migrate_occurrence_table(client, name):
+    if name not in migrated_tables:
+        return False
+    table_id = full_table_id(name)
+    table_name = name.split('.')[-1]
+    migration_id = f"{table_id}_migration"
+
+    # A migration that stopped between the two renames left only the migrated copy: finish the swap
+    if not table_exists(client, table_id):
+        client.query(f"ALTER TABLE `{migration_id}` RENAME TO `{table_name}`").result()
+        print(f"Completed the interrupted migration of {table_id}")
+        return
 
-    # Clear the raw table if it already exists
-    query = f"TRUNCATE TABLE `{raw_table_id}`"
-    client.query(query).result()
-    print(f"Cleared raw table {raw_table_id}")
+    existing = client.get_table(table_id)
+    backup_name = f"{table_name}_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    date_type = next((field.field_type for field in existing.schema if field.name == "Date"), "STRING")
+    date_expression = "PARSE_DATE('%Y-%m-%d', Date)" if date_type == "STRING" else "DATE(Date)"
+    print(f"Migrating {table_id} to the layout of the schema registry")
 
-    # Define schema for the staging table
-    staging_table_id = f"{dataset_id}.cdc_occurrences_staging"
-    staging_schema = [
-        bigquery.SchemaField("Disease", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("Region", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("Current_Week_Occurrence_Count", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("Date", "STRING", mode="REQUIRED")
-    ]
-    
-    # Set up staging table information
-    staging_table = bigquery.Table(staging_table_id, schema=staging_schema)
-    
-    # Create staging table in BigQuery (if not exists)
-    staging_table = client.create_table(staging_table, exists_ok=True)
-    print(f"Created or updated staging table {staging_table_id} with schema")
+    # PARSE_DATE fails on malformed dates, which stops the migration before anything is swapped
+    client.delete_table(migration_id, not_found_ok=True)
+    client.query(create_table_statement(name, table_id=migration_id, if_not_exists=False)).result()
+    client.query(f"""
+    INSERT INTO `{migration_id}` (Disease, Region, Current_Week_Occurrence_Count, Date)
+    SELECT Disease, Region, Current_Week_Occurrence_Count, {date_expression}
+    FROM `{table_id}`
+    """).result()
 
-    # Define schema for the disease dictionary table
-    disease_dic_id = f"{dataset_id}.disease_dic"
-    disease_dic_schema = [
-        bigquery.SchemaField("disease_code", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("disease_label", "STRING", mode="REQUIRED")
-    ]
-    
-    # Set up disease dictionary table information
-    disease_dic_table = bigquery.Table(disease_dic_id, schema=disease_dic_schema)
-    
-    # Create disease dictionary table in BigQuery (if not exists)
-    disease_dic_table = client.create_table(disease_dic_table, exists_ok=True)
-    print(f"Created or updated disease dictionary table {disease_dic_id} with schema")
+    source_rows, migrated_rows = count_rows(client, table_id), count_rows(client, migration_id)
+    if source_rows != migrated_rows:
+        client.delete_table(migration_id, not_found_ok=True)
+        raise RuntimeError(f"Migration of {table_id} copied {migrated_rows} of {source_rows} rows, table left unchanged")
+
+    # Keep the old table as a backup that expires on its own, then move the migrated table into place
+    expiration = (datetime.now(timezone.utc) + timedelta(days=backup_retention_days)).strftime('%Y-%m-%d %H:%M:%S UTC')
+    client.query(f"ALTER TABLE `{table_id}` RENAME TO `{backup_name}`").result()
+    client.query(f"ALTER TABLE `{full_table_id(name.rpartition('.')[0] + '.' + backup_name)}` SET OPTIONS (expiration_timestamp = TIMESTAMP '{expiration}')").result()
+    client.query(f"ALTER TABLE `{migration_id}` RENAME TO `{table_name}`").result()
+    print(f"Migrated {source_rows} rows of {table_id}; previous table kept as {backup_name} for {backup_retention_days} days")
+
+def create_bigquery_schema(force=False):
+    # Initialize BigQuery client
+    client = bigquery.Client()
+
+    return apply_schema_registry(client, force=force, migrate=migrate_occurrence_table)
 
 # Google Cloud Function entry point
 @functions_framework.http
+@instrumented("create_schema")
 def create_schema(request):
-    create_bigquery_schema()
-    return {}, 200
-
+    request_json = request.get_json(silent=True) or {}
+    result = create_bigquery_schema(force=bool(request_json.get('force', False)))
+    if result.get("unsupported"):
+        return json.dumps(result), 500
+    return json.dumps(result), 200
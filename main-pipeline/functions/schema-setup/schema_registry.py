@@ -0,0 +1,285 @@
+# Declarative registry of every BigQuery table used by the pipelines
+#
+# The registry lists the tables of the main pipeline, the MLOps pipeline, the symptoms and census pipelines and the
+# dashboard, with their columns, partitioning and clustering. Both schema-setup functions (main-pipeline and
+# mlops-pipeline) apply it with apply_schema_registry(); the file is identical in both function folders
+# (deploy-mlops.sh copies it from main-pipeline/functions/schema-setup before deploying).
+#
+# A fingerprint (hash) of the registry is stored as a label on the cdc_data dataset and cached in the function
+# instance. When it matches, schema-setup returns at once: no API call on a warm instance, one get_dataset on a cold one.
+# When it doesn't, the current layout is read with one INFORMATION_SCHEMA query and only the DDL needed for the
+# difference (create dataset/table, add column, drop NOT NULL) is sent as one batched script, together with the new
+# fingerprint. Clustering has no DDL and is updated through the API; changes that need a rewrite (column types,
+# partitioning) are handed to a migrate callback, or reported when there is none.
+
+import hashlib
+import json
+from google.api_core.exceptions import NotFound
+
+project_id = 'ba882-group-10'
+location = 'US'
+
+# Dataset label holding the fingerprint of the applied registry
+fingerprint_dataset = 'cdc_data'
+fingerprint_label = 'schema_fingerprint'
+
+# Helper function - one column: DDL type, NOT NULL, optional DEFAULT expression
+def column(name, data_type, required=False, default=None):
+    return {"name": name, "type": data_type, "required": required, "default": default}
+
+# Columns shared by the raw and staging occurrence tables
+occurrence_columns = [
+    column("Disease", "STRING", required=True),
+    column("Region", "STRING", required=True),
+    column("Current_Week_Occurrence_Count", "INT64", required=True),
+    column("Date", "DATE", required=True),
+    column("Fingerprint", "INT64"),  # content hash computed by the transform step
+]
+
+# "<dataset>.<table>": columns, partition_by (a DATE column), cluster_by
+tables = {
+    # Main pipeline
+    "cdc_data.cdc_occurrences_raw": {"columns": occurrence_columns, "partition_by": "Date", "cluster_by": ["Disease", "Region"]},
+    "cdc_data.cdc_occurrences_staging": {"columns": occurrence_columns, "partition_by": "Date", "cluster_by": ["Disease", "Region"]},
+    "cdc_data.cdc_revision_log": {"columns": [
+        column("run_at", "TIMESTAMP", required=True),
+        column("job_id", "STRING"),
+        column("window_start", "DATE"),
+        column("window_end", "DATE"),
+        column("rows_inserted", "INT64", required=True),
+        column("rows_revised", "INT64", required=True),
+        column("fingerprints_added", "INT64", required=True),
+        column("count_delta", "INT64", required=True),
+    ]},
+    "cdc_data.pipeline_metrics": {"columns": [
+        column("run_at", "TIMESTAMP", required=True),
+        column("run_date", "DATE", required=True),
+        column("flow", "STRING", required=True),
+        column("run_id", "STRING"),
+        column("stage", "STRING", required=True),
+        column("function", "STRING"),
+        column("endpoint", "STRING"),
+        column("status_code", "INT64"),
+        column("wall_seconds", "FLOAT64"),
+        column("cpu_seconds", "FLOAT64"),
+        column("peak_rss_mb", "FLOAT64"),
+        column("python_peak_mb", "FLOAT64"),
+        column("rows_in", "INT64"),
+        column("rows_out", "INT64"),
+        column("bytes_read", "INT64"),
+        column("bytes_written", "INT64"),
+    ], "partition_by": "run_date", "cluster_by": ["flow", "stage"]},
+    "cdc_data.disease_dic": {"columns": [
+        column("disease_code", "INT64", required=True),
+        column("disease_label", "STRING", required=True),
+    ]},
+
+    # MLOps pipeline
+    "cdc_data.model_runs": {"columns": [
+        column("model_id", "STRING", required=True),
+        column("name", "STRING"),
+        column("gcs_path", "STRING"),
+        column("model_path", "STRING"),
+        column("disease_code", "STRING"),
+        column("created_at", "TIMESTAMP", default="CURRENT_TIMESTAMP()"),
+    ]},
+    "cdc_data.model_metrics": {"columns": [
+        column("model_id", "STRING", required=True),
+        column("metric_name", "STRING", required=True),
+        column("metric_value", "FLOAT64"),
+    ]},
+    "cdc_data.model_parameters": {"columns": [
+        column("model_id", "STRING", required=True),
+        column("parameter_name", "STRING", required=True),
+        column("parameter_value", "STRING"),
+    ]},
+    "cdc_data.predictions": {"columns": [
+        column("model_id", "STRING", required=True),
+        column("inference_date", "TIMESTAMP", required=True),
+        column("date", "DATE", required=True),
+        column("predicted_occurrence", "FLOAT64", required=True),
+        column("Disease", "STRING", required=True),
+    ]},
+
+    # Symptoms pipeline
+    "cdc_data.symptom": {"columns": [
+        column("Disease", "STRING", required=True),
+        column("Overview", "STRING"),
+        column("How_it_Spreads", "STRING"),
+        column("Symptoms_in_Women", "STRING"),
+        column("Symptoms_in_Men", "STRING"),
+        column("Symptoms_from_Rectal_Infections", "STRING"),
+        column("Prevention", "STRING"),
+        column("Treatment_and_Recovery", "STRING"),
+    ]},
+
+    # Census pipeline
+    "demographic_data.census_data": {"columns": [
+        column("White", "FLOAT64", required=True),
+        column("Black", "FLOAT64", required=True),
+        column("Native_American", "FLOAT64", required=True),
+        column("Asian", "FLOAT64", required=True),
+        column("Income", "INT64", required=True),
+        column("Total_Population", "INT64", required=True),
+        column("State", "STRING", required=True),
+    ]},
+
+    # Dashboard
+    "cdc_data.dashboard": {"columns": [
+        column("Disease", "STRING", required=True),
+        column("Date", "DATE", required=True),
+        column("Incidence", "FLOAT64"),
+    ]},
+}
+
+datasets = sorted({name.split('.')[0] for name in tables})
+
+# Fingerprint of the registry that is cached in this instance after a successful apply
+_applied_fingerprint = None
+
+
+def registry_fingerprint():
+    # Label values are limited to 63 characters
+    return hashlib.sha256(json.dumps(tables, sort_keys=True).encode()).hexdigest()[:32]
+
+# Helper function - fingerprint stored on the dataset by the last successful apply (None if there is none yet)
+def stored_fingerprint(client):
+    try:
+        return client.get_dataset(f"{project_id}.{fingerprint_dataset}").labels.get(fingerprint_label)
+    except NotFound:
+        return None
+
+# Helper function - fully qualified table id
+def full_table_id(name):
+    return f"{project_id}.{name}"
+
+# Helper function - column definition in DDL
+def column_ddl(col):
+    ddl = f"`{col['name']}` {col['type']}"
+    if col["default"]:
+        ddl += f" DEFAULT {col['default']}"
+    if col["required"]:
+        ddl += " NOT NULL"
+    return ddl
+
+# CREATE TABLE statement for a registry table (table_id may differ from the registry name, e.g. for a migration copy)
+def create_table_statement(name, table_id=None, if_not_exists=True):
+    spec = tables[name]
+    statement = f"CREATE TABLE {'IF NOT EXISTS ' if if_not_exists else ''}`{table_id or full_table_id(name)}` (\n    "
+    statement += ",\n    ".join(column_ddl(col) for col in spec["columns"]) + "\n)"
+    if spec.get("partition_by"):
+        statement += f"\nPARTITION BY {spec['partition_by']}"
+    if spec.get("cluster_by"):
+        statement += f"\nCLUSTER BY {', '.join(spec['cluster_by'])}"
+    return statement
+
+# Read the current layout of every registry dataset with one query:
+# {"datasets": set of existing datasets,
+#  "tables": {"<dataset>.<table>": {"columns": {name: (type, nullable)}, "partition_by": column, "cluster_by": [columns]}}}
+def read_current_schema(client):
+    query = f"""
+    SELECT s.schema_name, c.table_name, c.column_name, c.data_type, c.is_nullable, c.is_partitioning_column,
+        c.clustering_ordinal_position
+    FROM `{project_id}.region-{location.lower()}.INFORMATION_SCHEMA.SCHEMATA` s
+    LEFT JOIN `{project_id}.region-{location.lower()}.INFORMATION_SCHEMA.COLUMNS` c
+    ON c.table_schema = s.schema_name
+    WHERE s.schema_name IN ({', '.join(f"'{dataset}'" for dataset in datasets)})
+    ORDER BY c.table_name, c.clustering_ordinal_position
+    """
+    current = {"datasets": set(), "tables": {}}
+    for row in client.query(query).result():
+        current["datasets"].add(row.schema_name)
+        if row.table_name is None:
+            continue
+        table = current["tables"].setdefault(f"{row.schema_name}.{row.table_name}", {"columns": {}, "partition_by": None, "cluster_by": []})
+        table["columns"][row.column_name] = (row.data_type, row.is_nullable == "YES")
+        if row.is_partitioning_column == "YES":
+            table["partition_by"] = row.column_name
+        if row.clustering_ordinal_position is not None:
+            table["cluster_by"].append(row.column_name)
+    return current
+
+# Compare the registry with the current layout.
+# Returns (statements, reclustered, migrations, unsupported): DDL statements, tables whose clustering changed,
+# tables whose layout needs a data migration, and differences that can't be applied automatically.
+def plan_schema_changes(current):
+    statements, reclustered, migrations, unsupported = [], [], [], []
+    for dataset in datasets:
+        if dataset not in current["datasets"]:
+            statements.append(f"CREATE SCHEMA IF NOT EXISTS `{project_id}.{dataset}` OPTIONS (location = '{location}')")
+
+    for name, spec in tables.items():
+        existing = current["tables"].get(name)
+        if existing is None:
+            # A migration that stopped before its last rename left only the migrated copy behind
+            if f"{name}_migration" in current["tables"]:
+                migrations.append(name)
+            else:
+                statements.append(create_table_statement(name))
+            continue
+
+        # Partitioning and column types can only be changed by rewriting the table
+        changed_types = [col["name"] for col in spec["columns"]
+                         if col["name"] in existing["columns"] and existing["columns"][col["name"]][0] != col["type"]]
+        if changed_types or existing["partition_by"] != spec.get("partition_by"):
+            migrations.append(name)
+            continue
+
+        if existing["cluster_by"] != spec.get("cluster_by", []):
+            reclustered.append(name)
+
+        for col in spec["columns"]:
+            if col["name"] not in existing["columns"]:
+                if col["required"]:
+                    unsupported.append(f"{name}: can't add REQUIRED column {col['name']} to an existing table")
+                else:
+                    statements.append(f"ALTER TABLE `{full_table_id(name)}` ADD COLUMN IF NOT EXISTS {column_ddl(col)}")
+            elif not col["required"] and not existing["columns"][col["name"]][1]:
+                statements.append(f"ALTER TABLE `{full_table_id(name)}` ALTER COLUMN `{col['name']}` DROP NOT NULL")
+    return statements, reclustered, migrations, unsupported
+
+# Bring BigQuery in line with the registry. migrate(client, name) rewrites a table whose partitioning or column
+# types changed and returns False for tables it can't migrate; those (or all, without migrate) are reported. force=True skips the fingerprint check.
+def apply_schema_registry(client, force=False, migrate=None):
+    global _applied_fingerprint
+    fingerprint = registry_fingerprint()
+    if not force and _applied_fingerprint == fingerprint:
+        print(f"Schema registry {fingerprint} already applied (cached)")
+        return {"status": "unchanged", "fingerprint": fingerprint, "source": "cache"}
+
+    if not force and stored_fingerprint(client) == fingerprint:
+        _applied_fingerprint = fingerprint
+        print(f"Schema registry {fingerprint} already applied (dataset label)")
+        return {"status": "unchanged", "fingerprint": fingerprint, "source": "label"}
+
+    statements, reclustered, migrations, unsupported = plan_schema_changes(read_current_schema(client))
+
+    # Migrations copy data into a table created from the registry, so they run before the batched DDL
+    migrated = []
+    for name in migrations:
+        if migrate is None or migrate(client, name) is False:
+            unsupported.append(f"{name}: partitioning or column types differ from the registry and need a migration")
+        else:
+            migrated.append(name)
+
+    # Clustering (unlike partitioning) can be changed in place; it applies to newly written data
+    for name in reclustered:
+        table = client.get_table(full_table_id(name))
+        table.clustering_fields = tables[name].get("cluster_by") or None
+        client.update_table(table, ["clustering_fields"])
+        print(f"Updated clustering of {name} to {table.clustering_fields}")
+
+    # The fingerprint is only stored once everything matches the registry
+    if not unsupported:
+        statements.append(f"ALTER SCHEMA `{project_id}.{fingerprint_dataset}` SET OPTIONS (labels = [('{fingerprint_label}', '{fingerprint}')])")
+    if statements:
+        script = ";\n".join(statements) + ";"
+        print(f"Applying {len(statements)} schema statements:\n{script}")
+        client.query(script).result()
+
+    if unsupported:
+        print(f"Schema differences that were not applied: {unsupported}")
+    else:
+        _applied_fingerprint = fingerprint
+    return {"status": "updated", "fingerprint": fingerprint, "statements": statements, "reclustered": reclustered,
+            "migrated": migrated, "unsupported": unsupported}
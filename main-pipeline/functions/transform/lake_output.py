@@ -0,0 +1,139 @@
+# Hive-partitioned Parquet data lake for the transform output
+#
+# Besides the per-job cdc_data_{job_id}.parquet file, every transform run appends its rows to one dataset:
+#   gs://cdc-extract-dataframe/lake/cdc_occurrences/disease=<code>/year=<MMWR year>/part-<run_id>-<seq>.parquet
+# A partition holds one CDC table for one MMWR year (a few thousand rows), so reprocessing or exporting a single
+# disease or year only reads the matching prefix, and files don't shrink to the ~50 rows of a single week.
+# run_id is "<UTC timestamp>_<job_id>", so files of newer runs sort after older ones.
+#
+# Rows are buffered per partition and a run writes one file per partition, unless a partition reaches
+# lake_file_rows or the run holds more than lake_buffer_rows rows (the largest partitions are then written early).
+# Uploads run on a thread pool; at most 2 * upload_workers files are waiting for an upload, and write() blocks
+# when they are, so a slow bucket slows the parser down instead of piling tables up in memory.
+#
+# Writing rows of a week again (e.g. when the CDC revises it) adds a newer file to the partition; the compact-lake
+# function later merges all files of a partition, keeping the newest run's row of every (Region, Date).
+
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from write_profiles import sort_rows, to_output_table, writer_options
+
+lake_prefix = 'lake/cdc_occurrences'
+
+# A partition is written once it holds this many rows
+lake_file_rows = 250000
+
+# Rows buffered across all partitions before the largest ones are written early
+lake_buffer_rows = 500000
+
+# Helper function - partition folder of a disease/year
+def partition_path(disease, year):
+    return f'{lake_prefix}/disease={disease}/year={year}'
+
+# Helper function - MMWR year and week of week-ending dates (date32 column).
+# MMWR weeks run Sunday to Saturday and belong to the year that contains their Wednesday; week 1 is the week
+# with the first Wednesday of the year.
+def mmwr_year_week(dates):
+    wednesday = dates.to_numpy(zero_copy_only=False).astype('datetime64[D]') - np.timedelta64(3, 'D')
+    year = wednesday.astype('datetime64[Y]')
+    jan_1 = year.astype('datetime64[D]')
+    # 1970-01-01 was a Thursday, so (days + 4) % 7 is the weekday with Sunday = 0
+    first_wednesday = jan_1 + ((3 - (jan_1.astype(np.int64) + 4)) % 7)
+    week = (wednesday - first_wednesday).astype(np.int64) // 7 + 1
+    return year.astype(np.int64) + 1970, week
+
+
+class LakeOutput:
+    def __init__(self, bucket, job_id, profile, upload_workers=8, file_rows=lake_file_rows, buffer_rows=lake_buffer_rows):
+        self.bucket = bucket
+        self.profile = profile
+        self.run_id = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S') + '_' + job_id
+        self.file_rows = file_rows
+        self.buffer_rows = buffer_rows
+        self.rows = 0
+        self.files = []
+
+        # Rows not written yet: (disease, year) -> [tables], and their row counts
+        self._pending = {}
+        self._pending_rows = {}
+        self._buffered_rows = 0
+
+        # Partition files are uploaded concurrently, with a bounded number waiting
+        self._executor = ThreadPoolExecutor(max_workers=upload_workers)
+        self._upload_slots = threading.BoundedSemaphore(2 * upload_workers)
+        self._uploads = []
+        self._sequence = 0
+
+    def _upload(self, blob_name, table):
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, **writer_options(self.profile))
+        self.bucket.blob(blob_name).upload_from_string(buffer.getvalue(), content_type='application/octet-stream')
+        return blob_name, buffer.tell()
+
+    # Write the buffered rows of a partition as one file
+    def _flush(self, partition):
+        tables = self._pending.pop(partition)
+        self._buffered_rows -= self._pending_rows.pop(partition)
+        table = tables[0] if len(tables) == 1 else sort_rows(pa.concat_tables(tables).unify_dictionaries().combine_chunks(), self.profile)
+        blob_name = f'{partition_path(*partition)}/part-{self.run_id}-{self._sequence:05d}.parquet'
+        self._sequence += 1
+
+        # Wait for a free slot while too many files are waiting to be uploaded
+        self._upload_slots.acquire()
+        try:
+            upload = self._executor.submit(self._upload, blob_name, table)
+        except BaseException:
+            self._upload_slots.release()
+            raise
+        upload.add_done_callback(lambda _: self._upload_slots.release())
+        self._uploads.append(upload)
+
+    # Split the rows of a parsed batch by partition and add them to the partitions' buffers
+    def write(self, builder):
+        table = to_output_table(builder.to_table(), self.profile)
+        if not table.num_rows:
+            return
+        years, _ = mmwr_year_week(table["Date"])
+        diseases = table["Disease"].to_numpy()
+
+        # lexsort is stable, so the profile's sort order is kept inside every partition
+        order = np.lexsort((years, diseases))
+        sorted_diseases, sorted_years = diseases[order], years[order]
+        starts = np.flatnonzero(np.r_[True, (np.diff(sorted_diseases) != 0) | (np.diff(sorted_years) != 0)])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            partition = (int(sorted_diseases[start]), int(sorted_years[start]))
+            self._pending.setdefault(partition, []).append(table.take(order[start:end]))
+            self._pending_rows[partition] = self._pending_rows.get(partition, 0) + int(end - start)
+            self._buffered_rows += int(end - start)
+            if self._pending_rows[partition] >= self.file_rows:
+                self._flush(partition)
+        self.rows += table.num_rows
+
+        while self._buffered_rows > self.buffer_rows:
+            self._flush(max(self._pending_rows, key=self._pending_rows.get))
+
+    def close(self):
+        try:
+            for partition in sorted(self._pending):
+                self._flush(partition)
+            uploaded = [upload.result() for upload in self._uploads]
+        finally:
+            self._executor.shutdown()
+        self.files = [blob_name for blob_name, _ in uploaded]
+        partitions = {file.rsplit('/', 1)[0] for file in self.files}
+        print(f"Appended {self.rows} rows to {len(partitions)} lake partitions in {self.bucket.name}/{lake_prefix}")
+        return {"mode": "lake", "rows": self.rows, "partitions": len(partitions), "files": len(self.files),
+                "bytes": sum(size for _, size in uploaded), "run_id": self.run_id}
+
+    # Files that were already uploaded stay; they belong to this run_id and are merged by the next compaction
+    def abort(self):
+        self._pending.clear()
+        self._executor.shutdown(cancel_futures=True)
@@ -2,24 +2,440 @@
 # The script extracts relevant information from the text files, filters out specific regions, and stores the processed data as a Parquet file in another Google Cloud Storage bucket.
 # The script performs the following tasks:
 # 1. Parses the request payload to retrieve a job ID.
-# 2. Lists all text files in the specified Google Cloud Storage bucket for the given job ID.
+# 2. Lists the job's objects in the specified Google Cloud Storage bucket: compressed archives written by the extract step
+#    ({job_id}/archive/*.tar.gz, read with one GET each and iterated in memory) and/or individual text files.
 # 3. Defines a set of regions to exclude from processing.
 # 4. Extracts the date information from a specific line in the text file using a regular expression.
 # 5. Processes each text file to extract disease code, region, and occurrence count, skipping lines for excluded regions.
-# 6. Converts the collected data into a Pandas DataFrame.
-# 7. Stores the DataFrame as a Parquet file in the output Google Cloud Storage bucket.
+#    By default the tab-delimited bodies of a batch of files are parsed in bulk with the pandas C reader and filtered
+#    with vectorized operations ({"parser": "vectorized"}); the original line-by-line parser is kept as {"parser": "loop"}.
+#    Downloads and parsing overlap: a thread pool prefetches the job's objects while a process pool parses batches of
+#    files, both with bounded queues ({"fetch_workers": 8, "parse_workers": <CPU quota>, "queue_size": 4}). The default
+#    number of parse processes comes from the container's CPU quota and memory limit, 1 if they can't be read
+#    (TRANSFORM_PARSE_WORKERS overrides it).
+# 6. Collects the rows in a columnar builder: typed arrays, with Disease, Region and Date dictionary-encoded.
+# 7. Stores the rows as a Parquet file (dictionary encoding preserved). By default row groups are written as soon as
+#    they are parsed and streamed to GCS with a resumable upload, so memory stays bounded ({"writer_mode": "streaming",
+#    "row_group_rows": 100000}); {"writer_mode": "buffered"} builds the whole file in memory before uploading it.
+#    Files use a typed schema (int16 Disease, int32 counts, date32 Date) and a write profile that sets the codec,
+#    row-group size, sort order and statistics ({"write_profile": "analytics" | "fast" | "archive"}).
+# 8. Appends the rows to the Hive-partitioned lake (lake/cdc_occurrences/disease=/year=), one file per
+#    partition and run ({"write_lake": false} skips it). The compact-lake function merges these files across runs.
+# 9. {"async": true} returns a job handle right away and runs the transform in a separate request; {"job_status": <handle>}
+#    reports its state (job_handles.py, state kept in the output bucket).
+# 10. Each run reports its telemetry (time, CPU, memory, rows written, bytes read and written) with the response,
+#    see telemetry.py.
+# 11. Results are cached by content (stage_cache.py): the key is built from the hashes of the job's source files (the
+#    archive indexes written by extract-txt, or the objects' MD5) and the output settings. A job whose files were all
+#    transformed before returns the earlier Parquet file's location at once; the response's output_uri is the file to
+#    load either way. {"use_cache": false} forces the transform.
 
 import pandas as pd
+import numpy as np
+import csv
 from google.cloud import storage
 import functions_framework
 import pyarrow
 import io
 import json
 import re
+import os
+import resource
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+
+from job_handles import async_job
+from lake_output import LakeOutput
+from parquet_output import create_parquet_output
+from record_builder import ColumnarRecordBuilder
+from stage_cache import cache_info, cache_key, lookup, store
+from telemetry import instrumented, record
+from write_profiles import write_profiles
+
+# Define project and bucket information
+project_id = 'ba882-group-10'
+bucket_name = 'cdc-extract-txt'
+output_bucket_name = 'cdc-extract-dataframe'
+
+# Encoding used by the CDC text files
+file_encoding = 'ISO-8859-1'
+
+# Tab-delimited data starts at this line of each file
+data_start_line = 7
+
+# Line boundaries other than '\n' that str.splitlines() (used by the loop parser) also splits on
+line_boundaries = ('\r', '\x0b', '\x0c', '\x1c', '\x1d', '\x1e', '\x85', '\u2028', '\u2029')
+line_boundary_pattern = re.compile('\r\n?|[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+# Number of files parsed together by the vectorized parser
+parse_batch_size = 250
+
+# Memory a parse process needs for one batch (the decoded text of its files and their DataFrame)
+parse_worker_memory_mb = 256
+
+# Helper function - CPUs and memory (MB) allowed by the container's cgroup, None for a limit that can't be read.
+# os.cpu_count() reports the host's CPUs, not the function's quota.
+def container_limits():
+    cpus = memory_mb = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != 'max':
+            cpus = int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/memory.max') as memory_max:
+            limit = memory_max.read().strip()
+        if limit != 'max':
+            memory_mb = int(limit) // (1024 * 1024)
+    except (OSError, ValueError):
+        pass
+    return cpus, memory_mb
+
+# Helper function - parse processes the container can run: one per whole CPU of its quota, as far as the memory left
+# besides the main process allows; 1 when the quota can't be read
+def container_parse_workers():
+    cpus, memory_mb = container_limits()
+    if cpus is None:
+        return 1
+    workers = int(cpus)
+    if memory_mb is not None:
+        workers = min(workers, memory_mb // parse_worker_memory_mb - 1)
+    return max(1, workers)
+
+# Parallelism of the fetch/parse pipeline (can be overridden per request): threads downloading objects,
+# processes parsing batches, and the number of pending downloads/batches allowed in each stage
+default_fetch_workers = int(os.environ.get('TRANSFORM_FETCH_WORKERS', 8))
+default_parse_workers = int(os.environ.get('TRANSFORM_PARSE_WORKERS', 0)) or container_parse_workers()
+default_queue_size = int(os.environ.get('TRANSFORM_QUEUE_SIZE', 4))
+
+# The Parquet file is streamed to GCS one row group at a time ('streaming'), or built in memory first ('buffered')
+default_writer_mode = os.environ.get('TRANSFORM_WRITER_MODE', 'streaming')
+# Parquet write profile (schema, codec, row-group size, sort order and statistics, see write_profiles.py).
+# TRANSFORM_ROW_GROUP_ROWS overrides the profile's row-group size.
+default_write_profile = os.environ.get('TRANSFORM_WRITE_PROFILE', 'analytics')
+default_row_group_rows = int(os.environ.get('TRANSFORM_ROW_GROUP_ROWS', 0)) or None
+
+# Also append the rows to the Hive-partitioned data lake (see lake_output.py)
+default_write_lake = os.environ.get('TRANSFORM_WRITE_LAKE', 'true').lower() == 'true'
+
+# Size of each piece of the resumable upload (must be a multiple of 256 KiB)
+upload_chunk_size = 8 * 1024 * 1024
+
+# Part of the cache key: bump it when a change to the parsing changes the rows produced from the same files
+transform_cache_version = 3
+
+# Define regions to exclude
+excluded_regions = {
+    'U.S. Residents, excluding U.S. Territories',
+    'New England',
+    'Middle Atlantic',
+    'East North Central',
+    'West North Central',
+    'South Atlantic',
+    'East South Central',
+    'West South Central',
+    'Mountain',
+    'Pacific',
+    'U.S. Territories',
+    'Non-U.S. Residents',
+    'Total'
+}
+
+# Helper function to extract date from a specific line
+def extract_date_from_line(line):
+    # Define the regular expression pattern
+    pattern = r"Non-U\.S\. Residents week ending (\w+ \d{1,2}, \d{4})"
+    match = re.search(pattern, line)
+
+    if match:
+        date_str = match.group(1)  # Extract the date part
+        # Convert the extracted date string to a standardized date format
+        try:
+            extracted_date = datetime.strptime(date_str, "%B %d, %Y").strftime('%Y-%m-%d')
+            return extracted_date
+        except ValueError as e:
+            print(f"Error parsing date '{date_str}': {str(e)}")
+            return None
+    else:
+        print("Date pattern not found in line")
+        return None
+
+# Download one object of a job and return its text files as (file name, file content) pairs.
+# Archives are downloaded with one GET and their members are read from memory.
+def fetch_job_files(blob):
+    if not blob.name.endswith('.tar.gz'):
+        return [(blob.name, blob.download_as_text(encoding=file_encoding))]
+
+    print(f"Reading archive: {blob.name}")
+    files = []
+    with tarfile.open(fileobj=io.BytesIO(blob.download_as_bytes()), mode='r:gz') as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith('.txt'):
+                files.append((f"{blob.name}#{member.name}", archive.extractfile(member).read().decode(file_encoding)))
+    return files
+
+# Content hashes of the job's source files as sorted (file name, hash) pairs.
+# Archive members are taken from the archive's index (no download of the archive); files without one use the
+# object's MD5. A file stored twice by a resumed job counts once, like in the parse pipeline.
+def source_manifest(blobs, index_blobs):
+    indexes = {}
+    for index_blob in index_blobs:
+        index = json.loads(index_blob.download_as_text())
+        indexes[index["archive"]] = index["members"]
+    manifest = {}
+    for blob in blobs:
+        if blob.name in indexes:
+            for member in indexes[blob.name]:
+                manifest.setdefault(member["name"].split('/')[-1], member["sha256"])
+        else:
+            manifest.setdefault(blob.name.split('/')[-1], blob.md5_hash or blob.crc32c)
+    return sorted(manifest.items())
+
+# Yield fn(item) for every item, in order, running the calls on a thread pool.
+# At most max_pending results are in flight or buffered, so memory stays flat however many items there are.
+def prefetch(fn, items, workers, max_pending):
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(fn, item) for item in islice(items, max_pending))
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(executor.submit(fn, item))
+            yield result
+
+# Helper function - a count as int() reads it, 0 when it isn't an integer
+def int_or_zero(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+# Helper function - disease code from a file name such as 2024_week05_table370.txt
+def extract_disease_code(file_name):
+    disease_code_match = re.search(r"table(\d+)", file_name)
+    return disease_code_match.group(1) if disease_code_match else None
+
+# Helper function - split one file into (disease code, date, tab-delimited body); None when the file can't be used
+def split_txt_file(file_name, file_content):
+    disease_code = extract_disease_code(file_name)
+    if not disease_code:
+        print(f"Disease code not found in file name {file_name}")
+        return None
+
+    # Lines end where str.splitlines() ends them, so both parsers see the same lines; then split off the header
+    # lines without splitting the whole body into Python strings
+    if '\r' in file_content:
+        file_content = file_content.replace('\r\n', '\n')
+    if any(boundary in file_content for boundary in line_boundaries):
+        file_content = line_boundary_pattern.sub('\n', file_content)
+    head = file_content.split('\n', data_start_line)
+    if len(head) < 5:
+        print(f"File {file_name} does not contain enough lines to extract data")
+        return None
+
+    Date = extract_date_from_line(head[0])
+    if not Date:
+        print(f"Date not found in file {file_name}")
+        return None
+    if len(head) <= data_start_line or '\t' not in head[data_start_line]:
+        return None
+
+    body = head[data_start_line]
+    return disease_code, Date, body if body.endswith('\n') else body + '\n'
+
+# Parse a batch of CDC text files with vectorized operations and add the rows to a columnar builder.
+# The bodies of all files are read by a single pandas C-reader call; each parsed line is mapped back to its
+# file (disease code and date) by counting the lines of every body. The rows are the same as the loop parser's.
+def parse_txt_batch(files, builder=None):
+    builder = builder if builder is not None else ColumnarRecordBuilder()
+    codes, dates, bodies, line_counts = [], [], [], []
+    for file_name, file_content in files:
+        parts = split_txt_file(file_name, file_content)
+        if parts is None:
+            continue
+        codes.append(parts[0])
+        dates.append(parts[1])
+        bodies.append(parts[2])
+        line_counts.append(parts[2].count('\n'))
+    if not bodies:
+        return builder
+
+    # Read the region and current-week columns of every body in one call (rows may be ragged; empty cells stay "").
+    # Lines end at '\n' only, as counted above (split_txt_file turned the other line boundaries into '\n').
+    text = ''.join(bodies)
+    table = pd.read_csv(io.StringIO(text), sep='\t', header=None, names=[0, 1], usecols=[0, 1], index_col=False, dtype=str,
+                        keep_default_na=False, quoting=csv.QUOTE_NONE, skip_blank_lines=False, lineterminator='\n', engine='c')
+    file_index = np.repeat(np.arange(len(bodies)), line_counts)
+    is_total = table[0].str.startswith("Total").to_numpy()
+    region, count = table[0].str.strip(), table[1].str.strip()
+
+    # A line whose first two cells both have content splits the same with or without line.strip(). The others (blank
+    # lines, empty count cells, leading tabs) are rare and are split like the loop parser does: strip the line, then
+    # split it on tabs, and skip it if that leaves fewer than 2 columns.
+    has_columns = ((region != "") & (count != "")).to_numpy(copy=True)
+    irregular = np.flatnonzero(~has_columns)
+    if len(irregular):
+        lines = text.split('\n')
+        split_lines = [(line_index, lines[line_index].strip().split('\t')) for line_index in irregular]
+        split_lines = [(line_index, columns) for line_index, columns in split_lines if len(columns) >= 2]
+        if split_lines:
+            line_indices = [line_index for line_index, _ in split_lines]
+            has_columns[line_indices] = True
+            region.iloc[line_indices] = [columns[0].strip() for _, columns in split_lines]
+            count.iloc[line_indices] = [columns[1].strip() for _, columns in split_lines]
+
+    # Skip empty lines, the 'Total' line, lines with fewer than 2 columns, and excluded regions
+    keep = has_columns & ~is_total & ~region.isin(excluded_regions).to_numpy()
+
+    # Plain ASCII integers are converted in bulk, and ASCII counts without a digit ('-', 'N', 'U', empty) are 0. The
+    # few others go through int() like in the loop parser, which also accepts e.g. '1_000' and non-ASCII digits.
+    counts = count[keep]
+    plain = counts.str.fullmatch(r'[+-]?[0-9]+')
+    other = ~plain & (counts.str.contains(r'[0-9]') | ~counts.str.isascii())
+    counts = counts.where(plain, '0').where(~other, counts[other].map(int_or_zero)).astype('int64')
+    kept_files = file_index[keep]
+
+    # Disease and Date are already encoded by file; Region is encoded by its distinct values
+    region_indices, region_values = pd.factorize(region[keep])
+    builder.extend(counts.to_numpy(), Disease=(codes, kept_files), Region=(list(region_values), region_indices), Date=(dates, kept_files))
+    return builder
+
+# Parse one CDC text file line by line and add its rows to a columnar builder
+def parse_txt_file(file_name, file_content, builder=None):
+    builder = builder if builder is not None else ColumnarRecordBuilder()
+
+    # Extract disease code from the filename
+    disease_code = extract_disease_code(file_name)
+    if disease_code:
+        print(f"Extracted disease code: {disease_code}")
+    else:
+        print(f"Disease code not found in file name {file_name}")
+        return builder  # Skip this file if disease code extraction fails
+
+    lines = file_content.splitlines()
+    if len(lines) < 5:
+        print(f"File {file_name} does not contain enough lines to extract data")
+        return builder
+
+    # Extract the date from the specific line containing "Non-U.S. Residents week ending"
+    date_line = lines[0]  # Assuming the date is in the first line
+    Date = extract_date_from_line(date_line)
+    if not Date:
+        print(f"Date not found in file {file_name}")
+        return builder  # Skip this file if date extraction fails
+    print(f"Parsed Date: {Date}")  # Debugging log
+
+    # Start reading tab-delimited data from the appropriate line
+    start_index = data_start_line  # Data starts from line 7 in the provided file
+    for line in lines[start_index:]:
+        if line.strip() == "" or line.startswith("Total") or len(line.strip().split("\t")) < 2:
+            continue  # Skip empty lines, the 'Total' line, and lines with fewer than 2 columns
+
+        columns = line.strip().split("\t")
+        region = columns[0].strip()  # Ensure to strip spaces for accurate matching
+
+        # Skip if the region is in the excluded list
+        if region in excluded_regions:
+            print(f"Skipping excluded region: {region}")  # Debugging log
+            continue
+
+        current_week_count = columns[1]
+
+        # Handle non-numeric counts (e.g., '-', 'N', 'U')
+        try:
+            current_week_count = int(current_week_count)
+        except ValueError:
+            print(f"Non-numeric count '{current_week_count}' found, setting to 0")
+            current_week_count = 0  # Set to 0 if the value is not a valid integer
+
+        # Append the extracted data to the builder
+        builder.append(disease_code, region, current_week_count, Date)  # Use dynamically extracted date
+
+    return builder
+
+# Parse one batch of files into a columnar builder (runs in a worker process when parse_workers > 1).
+# If a vectorized batch fails, its files are parsed one at a time so only the bad file is skipped.
+def parse_batch(batch, parser):
+    builder = ColumnarRecordBuilder()
+    if parser == 'loop':
+        for file_name, file_content in batch:
+            try:
+                builder.merge(parse_txt_file(file_name, file_content))
+            except Exception as e:
+                print(f"Error processing file {file_name}: {str(e)}")
+        return builder
+
+    try:
+        return parse_txt_batch(batch, builder)
+    except Exception as e:
+        print(f"Error processing batch of {len(batch)} files, retrying file by file: {str(e)}")
+    builder = ColumnarRecordBuilder()
+    for file_name, file_content in batch:
+        try:
+            builder.merge(parse_txt_batch([(file_name, file_content)]))
+        except Exception as e:
+            print(f"Error processing file {file_name}: {str(e)}")
+    return builder
+
+# Producer/consumer pipeline: a thread pool prefetches the job's objects while a process pool parses batches of files.
+# Both stages are bounded by queue_size, so at most queue_size downloads and queue_size parse batches are pending.
+# Parsed batches are handed to write() of every output, in file order.
+def run_parse_pipeline(job_blobs, parser, fetch_workers, parse_workers, queue_size, outputs):
+    pending = deque()
+    stats = {"files": 0, "duplicates": 0, "batches": 0}
+    executor = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 else None
+
+    def write(builder):
+        for output in outputs:
+            output.write(builder)
+
+    def submit(batch):
+        stats["batches"] += 1
+        if executor is None:
+            write(parse_batch(batch, parser))
+            return
+        pending.append(executor.submit(parse_batch, batch, parser))
+        while len(pending) > queue_size:
+            write(pending.popleft().result())
+
+    try:
+        batch = []
+        seen_files = set()
+        for files in prefetch(fetch_job_files, job_blobs, fetch_workers, queue_size):
+            for file_name, file_content in files:
+                # A resumed extraction job can store the same file in two archive parts
+                base_name = file_name.split('#')[-1].split('/')[-1]
+                if base_name in seen_files:
+                    print(f"Skipping duplicate file: {file_name}")
+                    stats["duplicates"] += 1
+                    continue
+                seen_files.add(base_name)
+                stats["files"] += 1
+                print(f"Processing file: {file_name}")
+
+                batch.append((file_name, file_content))
+                if len(batch) >= parse_batch_size:
+                    submit(batch)
+                    batch = []
+        if batch:
+            submit(batch)
+        while pending:
+            write(pending.popleft().result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return stats
 
 # Google Cloud Function entry point
 @functions_framework.http
+@async_job(output_bucket_name, 'transform_txt_to_dataframe')
+@instrumented("transform")
 def transform_txt_to_dataframe(request):
     # Parse request to get job_id
     request_json = request.get_json()
@@ -28,11 +444,23 @@ def transform_txt_to_dataframe(request):
         print("Error: Missing job_id in request payload")
         return "Missing job_id in request payload", 400
     print(f"Received job ID: {job_id}")
+    parser = request_json.get('parser', 'vectorized')
+    if parser not in ('vectorized', 'loop'):
+        return f"Unknown parser '{parser}', expected 'vectorized' or 'loop'", 400
+    fetch_workers = max(1, int(request_json.get('fetch_workers', default_fetch_workers)))
+    parse_workers = max(1, int(request_json.get('parse_workers', default_parse_workers)))
+    queue_size = max(1, int(request_json.get('queue_size', default_queue_size)))
+    writer_mode = request_json.get('writer_mode', default_writer_mode)
+    if writer_mode not in ('streaming', 'buffered'):
+        return f"Unknown writer mode '{writer_mode}', expected 'streaming' or 'buffered'", 400
+    row_group_rows = request_json.get('row_group_rows', default_row_group_rows)
+    row_group_rows = max(1, int(row_group_rows)) if row_group_rows else None
+    write_lake = bool(request_json.get('write_lake', default_write_lake))
+    write_profile = request_json.get('write_profile', default_write_profile)
+    if write_profile not in write_profiles:
+        return f"Unknown write profile '{write_profile}', expected one of {sorted(write_profiles)}", 400
+    use_cache = bool(request_json.get('use_cache', True))
 
-    # Define project and bucket information
-    project_id = 'ba882-group-10'
-    bucket_name = 'cdc-extract-txt'
-    output_bucket_name = 'cdc-extract-dataframe'
     output_blob_name = f'cdc_data_{job_id}.parquet'
 
     # Initialize Google Cloud Storage client
@@ -44,146 +472,65 @@ def transform_txt_to_dataframe(request):
         print(f"Error initializing Google Cloud Storage client: {str(e)}")
         return f"Error initializing Google Cloud Storage client: {str(e)}", 500
 
-    # List all text files in the bucket for the given job_id
+    # List the archives and text files in the bucket for the given job_id
     try:
         print(f"Listing blobs in bucket {bucket_name} with prefix {job_id}...")
         blobs = list(bucket.list_blobs(prefix=f"{job_id}/"))
+        archive_blobs = [blob for blob in blobs if blob.name.endswith('.tar.gz')]
         txt_blobs = [blob for blob in blobs if blob.name.endswith('.txt')]
-        if not txt_blobs:
+        index_blobs = [blob for blob in blobs if blob.name.endswith('.index.json')]
+        if not archive_blobs and not txt_blobs:
             print(f"No text files found for job ID {job_id} in bucket {bucket_name}")
             return f"No text files found for job ID {job_id}", 404
+        manifest = source_manifest(archive_blobs + txt_blobs, index_blobs)
     except Exception as e:
         print(f"Error listing blobs: {str(e)}")
         return f"Error listing blobs: {str(e)}", 500
 
-    # Collect data from all files
-    all_data = []
-
-    # Define regions to exclude
-    excluded_regions = {
-        'U.S. Residents, excluding U.S. Territories',
-        'New England',
-        'Middle Atlantic',
-        'East North Central',
-        'West North Central',
-        'South Atlantic',
-        'East South Central',
-        'West South Central',
-        'Mountain',
-        'Pacific',
-        'U.S. Territories',
-        'Non-U.S. Residents',
-        'Total'
-    }
-
-    # Helper function to extract date from a specific line
-    def extract_date_from_line(line):
-        # Define the regular expression pattern
-        pattern = r"Non-U\.S\. Residents week ending (\w+ \d{1,2}, \d{4})"
-        match = re.search(pattern, line)
-
-        if match:
-            date_str = match.group(1)  # Extract the date part
-            # Convert the extracted date string to a standardized date format
-            try:
-                extracted_date = datetime.strptime(date_str, "%B %d, %Y").strftime('%Y-%m-%d')
-                return extracted_date
-            except ValueError as e:
-                print(f"Error parsing date '{date_str}': {str(e)}")
-                return None
-        else:
-            print("Date pattern not found in line")
-            return None
-
-    # Process each text file
-    for blob in txt_blobs:
-        try:
-            print(f"Processing file: {blob.name}")
-
-            # Extract disease code from the filename
-            disease_code_match = re.search(r"table(\d+)", blob.name)
-            if disease_code_match:
-                disease_code = disease_code_match.group(1)
-                print(f"Extracted disease code: {disease_code}")
-            else:
-                print(f"Disease code not found in file name {blob.name}")
-                continue  # Skip this file if disease code extraction fails
-
-            # Download file content
-            file_content = blob.download_as_text(encoding='ISO-8859-1')
-            lines = file_content.splitlines()
-            if len(lines) < 5:
-                print(f"File {blob.name} does not contain enough lines to extract data")
-                continue
-
-            # Extract the date from the specific line containing "Non-U.S. Residents week ending"
-            date_line = lines[0]  # Assuming the date is in the first line
-            Date = extract_date_from_line(date_line)
-            if not Date:
-                print(f"Date not found in file {blob.name}")
-                continue  # Skip this file if date extraction fails
-            print(f"Parsed Date: {Date}")  # Debugging log
-
-            # Start reading tab-delimited data from the appropriate line
-            start_index = 7  # Data starts from line 7 in the provided file
-            for line in lines[start_index:]:
-                if line.strip() == "" or line.startswith("Total") or len(line.strip().split("\t")) < 2:
-                    continue  # Skip empty lines, the 'Total' line, and lines with fewer than 2 columns
-
-                columns = line.strip().split("\t")
-                region = columns[0].strip()  # Ensure to strip spaces for accurate matching
-
-                # Skip if the region is in the excluded list
-                if region in excluded_regions:
-                    print(f"Skipping excluded region: {region}")  # Debugging log
-                    continue
-
-                current_week_count = columns[1]
+    # Same files and output settings as an earlier run whose Parquet file is still there: return that run's result
+    key = cache_key(transform_cache_version, manifest, write_profile, row_group_rows, write_lake)
+    output_bucket = storage_client.bucket(output_bucket_name)
+    cached = lookup(output_bucket, 'transform', key) if use_cache else None
+    if cached and output_bucket.blob(cached["output_uri"].split('/', 3)[3]).exists():
+        print(f"{len(manifest)} source files unchanged since job {cached['job_id']}, returning {cached['output_uri']}")
+        return json.dumps({"message": "Source files already transformed.", "job_id": job_id, "output_uri": cached["output_uri"],
+                           "stats": cached["stats"], "cache": cache_info("hit", key)})
 
-                # Handle non-numeric counts (e.g., '-', 'N', 'U')
-                try:
-                    current_week_count = int(current_week_count)
-                except ValueError:
-                    print(f"Non-numeric count '{current_week_count}' found, setting to 0")
-                    current_week_count = 0  # Set to 0 if the value is not a valid integer
-
-                # Append the extracted data to the list
-                all_data.append({
-                    "Disease": disease_code,
-                    "Region": region,
-                    "Current_Week_Occurrence_Count": current_week_count,
-                    "Date": Date  # Use dynamically extracted date
-                })
-
-        except Exception as e:
-            print(f"Error processing file {blob.name}: {str(e)}")
-            continue
-
-    # Convert list to DataFrame
+    # Fetch and parse all files of the job, writing the Parquet file to the output bucket as rows come in
     try:
-        print("Converting collected data to DataFrame...")
-        df = pd.DataFrame(all_data)
+        start_time = time.perf_counter()
+        outputs = [create_parquet_output(writer_mode, output_bucket, output_blob_name, write_profiles[write_profile],
+                                         row_group_rows, upload_chunk_size)]
+        if write_lake:
+            outputs.append(LakeOutput(output_bucket, job_id, write_profiles[write_profile]))
+        try:
+            pipeline_stats = run_parse_pipeline(archive_blobs + txt_blobs, parser, fetch_workers, parse_workers, queue_size, outputs)
+            print("Storing table in Google Cloud Storage as Parquet file...")
+            pipeline_stats["output"] = outputs[0].close()
+            if write_lake:
+                pipeline_stats["lake"] = outputs[1].close()
+        except Exception:
+            for output in outputs:
+                output.abort()
+            raise
+        pipeline_stats["elapsed_seconds"] = round(time.perf_counter() - start_time, 3)
+        pipeline_stats["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        print(f"Parse pipeline stats: {json.dumps(pipeline_stats)}")
     except Exception as e:
-        print(f"Error converting data to DataFrame: {str(e)}")
-        return f"Error converting data to DataFrame: {str(e)}", 500
+        print(f"Error processing files for job {job_id}: {str(e)}")
+        return f"Error processing files for job {job_id}: {str(e)}", 500
 
-    # Store DataFrame in Google Cloud Storage as a Parquet file
-    if not df.empty:
-        try:
-            print("Storing DataFrame in Google Cloud Storage as Parquet file...")
-            output_bucket = storage_client.bucket(output_bucket_name)
-            output_buffer = io.BytesIO()
-            df.to_parquet(output_buffer, index=False)
-            output_buffer.seek(0)  # Reset buffer position to the beginning
-            output_blob = output_bucket.blob(output_blob_name)
-            output_blob.upload_from_file(output_buffer, content_type='application/octet-stream')
-            print(f"Stored DataFrame to {output_bucket_name}/{output_blob_name}")
-        except Exception as e:
-            print(f"Error storing DataFrame to Parquet file: {str(e)}")
-            return f"Error storing DataFrame to Parquet file: {str(e)}", 500
+    output_uri = None
+    if pipeline_stats["output"]["rows"]:
+        print(f"Stored table to {output_bucket_name}/{output_blob_name}")
+        output_uri = f"gs://{output_bucket_name}/{output_blob_name}"
     else:
         print("No data to store.")
 
-    return json.dumps({"message": "Data processing and storage completed.", "job_id": job_id})
-
-
+    pipeline_stats["rows"] = pipeline_stats["output"]["rows"]
+    record(bytes_read=sum(blob.size or 0 for blob in archive_blobs + txt_blobs), rows_out=pipeline_stats["rows"],
+           bytes_written=pipeline_stats["output"]["bytes"] + pipeline_stats.get("lake", {}).get("bytes", 0))
+    if output_uri:
+        store(output_bucket, 'transform', key, {"job_id": job_id, "output_uri": output_uri, "stats": pipeline_stats})
+    return json.dumps({"message": "Data processing and storage completed.", "job_id": job_id, "output_uri": output_uri,
+                       "stats": pipeline_stats, "cache": cache_info("miss" if use_cache else "bypass", key)})
@@ -0,0 +1,112 @@
+# Parquet writers for the transform output
+#
+# BufferedParquetOutput keeps every parsed row in one builder and uploads the whole file at the end (the original
+# behaviour). Memory grows with the number of weeks processed.
+#
+# StreamingParquetOutput writes a row group as soon as row_group_rows rows have been parsed. The row groups go
+# through a pyarrow ParquetWriter straight into a resumable GCS upload (blob.open('wb')), which sends the file in
+# upload_chunk_size pieces. At most one row group and one upload chunk are held in memory, however long the history.
+# The object only appears in the bucket when close() finalises the upload; abort() leaves any previous version in place.
+#
+# Both writers use a write profile (write_profiles.py) for the schema, codec, row-group size, sort order and
+# statistics. The buffered writer sorts the whole file; the streaming writer sorts each row group.
+
+import io
+
+import pyarrow.parquet as pq
+
+from record_builder import ColumnarRecordBuilder
+from write_profiles import output_schema, to_output_table, writer_options
+
+parquet_content_type = 'application/octet-stream'
+
+
+class BufferedParquetOutput:
+    def __init__(self, bucket, blob_name, profile, row_group_rows):
+        self.bucket = bucket
+        self.blob_name = blob_name
+        self.profile = profile
+        self.row_group_rows = row_group_rows
+        self.builder = ColumnarRecordBuilder()
+
+    def write(self, builder):
+        self.builder.merge(builder)
+
+    def close(self):
+        table = to_output_table(self.builder.to_table(), self.profile)
+        size = 0
+        if table.num_rows:
+            output_buffer = io.BytesIO()
+            pq.write_table(table, output_buffer, row_group_size=self.row_group_rows, **writer_options(self.profile))
+            size = output_buffer.tell()
+            output_buffer.seek(0)  # Reset buffer position to the beginning
+            self.bucket.blob(self.blob_name).upload_from_file(output_buffer, content_type=parquet_content_type)
+        row_groups = -(-table.num_rows // self.row_group_rows)
+        return {"mode": "buffered", "rows": table.num_rows, "row_groups": row_groups, "bytes": size}
+
+    def abort(self):
+        self.builder = ColumnarRecordBuilder()
+
+
+class StreamingParquetOutput:
+    def __init__(self, bucket, blob_name, profile, row_group_rows, upload_chunk_size):
+        self.bucket = bucket
+        self.blob_name = blob_name
+        self.profile = profile
+        self.row_group_rows = row_group_rows
+        self.upload_chunk_size = upload_chunk_size
+        self.rows = 0
+        self.row_groups = 0
+
+        self._pending = ColumnarRecordBuilder()
+        self._upload = None
+        self._writer = None
+
+    # Start the upload lazily so a job without rows does not leave an empty file behind
+    def _open(self):
+        # ParquetWriter flushes its sink, which a resumable upload only supports with ignore_flush
+        self._upload = self.bucket.blob(self.blob_name).open('wb', chunk_size=self.upload_chunk_size, ignore_flush=True,
+                                                              content_type=parquet_content_type)
+        self._writer = pq.ParquetWriter(self._upload, output_schema, **writer_options(self.profile))
+
+    def _write_row_group(self):
+        table = to_output_table(self._pending.to_table(), self.profile)
+        self._pending = ColumnarRecordBuilder()
+        if not table.num_rows:
+            return
+        if self._writer is None:
+            self._open()
+        self._writer.write_table(table, row_group_size=table.num_rows)
+        self.rows += table.num_rows
+        self.row_groups += 1
+
+    def write(self, builder):
+        self._pending.merge(builder)
+        if len(self._pending) >= self.row_group_rows:
+            self._write_row_group()
+
+    def close(self):
+        self._write_row_group()
+        size = 0
+        if self._writer is not None:
+            self._writer.close()
+            size = self._upload.tell()
+            self._upload.close()
+        return {"mode": "streaming", "rows": self.rows, "row_groups": self.row_groups, "bytes": size}
+
+    # Drop the pending rows without finalising the upload
+    def abort(self):
+        self._pending = ColumnarRecordBuilder()
+        self._writer = None
+        self._upload = None
+
+
+# Helper function - pick the Parquet writer for a job
+# (row_group_rows overrides the profile's row-group size when given)
+def create_parquet_output(mode, bucket, blob_name, profile, row_group_rows, upload_chunk_size):
+    row_group_rows = row_group_rows or profile["row_group_rows"]
+    if mode == 'streaming':
+        return StreamingParquetOutput(bucket, blob_name, profile, row_group_rows, upload_chunk_size)
+    if mode == 'buffered':
+        return BufferedParquetOutput(bucket, blob_name, profile, row_group_rows)
+    raise ValueError(f"Unknown writer mode '{mode}', expected 'streaming' or 'buffered'")
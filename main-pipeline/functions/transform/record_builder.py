@@ -0,0 +1,93 @@
+# Columnar accumulator for the parsed CDC rows
+#
+# Instead of one Python dict per row, the builder keeps one typed array per column. Disease, Region and Date have
+# very few distinct values (10 diseases, ~60 regions, ~100 weeks), so they are dictionary-encoded: every distinct
+# value is stored once and each row only holds an int32 index into that dictionary. Counts are kept as int64.
+# to_table() returns a pyarrow Table with DictionaryArray columns, which the Parquet writer stores with dictionary
+# encoding, so readers of the output get the dictionary back as well.
+#
+# Builders are small and picklable, so the parse workers each fill their own builder and the consumer merges them.
+
+from array import array
+
+import numpy as np
+import pyarrow as pa
+
+dictionary_columns = ("Disease", "Region", "Date")
+count_column = "Current_Week_Occurrence_Count"
+output_columns = ["Disease", "Region", count_column, "Date"]
+
+
+class ColumnarRecordBuilder:
+    def __init__(self):
+        # Dictionary values in first-seen order, and value -> index lookups
+        self._values = {column: [] for column in dictionary_columns}
+        self._lookup = {column: {} for column in dictionary_columns}
+
+        # Finished chunks of indices/counts, plus typed buffers for rows added one at a time with append()
+        self._index_chunks = {column: [] for column in dictionary_columns}
+        self._count_chunks = []
+        self._index_buffer = {column: array('i') for column in dictionary_columns}
+        self._count_buffer = array('q')
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def _encode(self, column, value):
+        lookup = self._lookup[column]
+        index = lookup.get(value)
+        if index is None:
+            index = lookup[value] = len(self._values[column])
+            self._values[column].append(value)
+        return index
+
+    # Move the rows added with append() into a chunk, so chunks stay in row order
+    def _flush_buffers(self):
+        if not self._count_buffer:
+            return
+        for column in dictionary_columns:
+            self._index_chunks[column].append(np.frombuffer(self._index_buffer[column], dtype=np.int32).copy())
+            self._index_buffer[column] = array('i')
+        self._count_chunks.append(np.frombuffer(self._count_buffer, dtype=np.int64).copy())
+        self._count_buffer = array('q')
+
+    # Add one row (used by the line-by-line parser)
+    def append(self, disease, region, count, date):
+        self._index_buffer["Disease"].append(self._encode("Disease", disease))
+        self._index_buffer["Region"].append(self._encode("Region", region))
+        self._index_buffer["Date"].append(self._encode("Date", date))
+        self._count_buffer.append(count)
+        self._rows += 1
+
+    # Add many rows at once. Every dictionary column is given already encoded, as (values, indices): row i has the
+    # value values[indices[i]]. The values are re-encoded against this builder's dictionaries (one lookup per
+    # distinct value), so the rows themselves are never touched one by one.
+    def extend(self, counts, **columns):
+        self._flush_buffers()
+        counts = np.asarray(counts, dtype=np.int64)
+        for column in dictionary_columns:
+            values, indices = columns[column]
+            mapping = np.fromiter((self._encode(column, value) for value in values), dtype=np.int32, count=len(values))
+            self._index_chunks[column].append(mapping[np.asarray(indices, dtype=np.intp)])
+        self._count_chunks.append(counts)
+        self._rows += len(counts)
+
+    # Append all rows of another builder (e.g. the result of a parse worker)
+    def merge(self, other):
+        if not len(other):
+            return
+        other._flush_buffers()
+        self.extend(np.concatenate(other._count_chunks),
+                    **{column: (other._values[column], np.concatenate(other._index_chunks[column])) for column in dictionary_columns})
+
+    def to_table(self):
+        self._flush_buffers()
+        arrays = {}
+        for column in dictionary_columns:
+            chunks = self._index_chunks[column]
+            indices = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int32)
+            arrays[column] = pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(self._values[column], type=pa.string()))
+        counts = np.concatenate(self._count_chunks) if self._count_chunks else np.empty(0, dtype=np.int64)
+        arrays[count_column] = pa.array(counts, type=pa.int64())
+        return pa.table([arrays[column] for column in output_columns], names=output_columns)
@@ -0,0 +1,110 @@
+# Parquet write profiles for the transform output
+#
+# Every file is written with an explicit Arrow schema instead of pandas defaults:
+#   Disease                        int16   (CDC table number, e.g. 1122)
+#   Region                         dictionary<int32, string>
+#   Current_Week_Occurrence_Count  int32
+#   Date                           date32  (week ending date)
+#   Fingerprint                    int64   (content hash of the row, see row_fingerprints)
+# A profile picks the compression codec, the row-group size, the sort order inside each row group and whether
+# column/page statistics are written. Sorting by (Disease, Date, Region) gives every row group tight min/max
+# statistics, so readers that filter on a disease or a date range can skip row groups and pages.
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+output_schema = pa.schema([
+    pa.field("Disease", pa.int16(), nullable=False),
+    pa.field("Region", pa.dictionary(pa.int32(), pa.string()), nullable=False),
+    pa.field("Current_Week_Occurrence_Count", pa.int32(), nullable=False),
+    pa.field("Date", pa.date32(), nullable=False),
+    pa.field("Fingerprint", pa.int64(), nullable=False),
+])
+
+write_profiles = {
+    # Default: small files with statistics and a page index for predicate pushdown
+    "analytics": {
+        "compression": "zstd",
+        "compression_level": 3,
+        "row_group_rows": 100000,
+        "sort_by": ["Disease", "Date", "Region"],
+        "write_statistics": True,
+        "write_page_index": True,
+    },
+    # Cheapest to write: snappy, no sorting, no page index
+    "fast": {
+        "compression": "snappy",
+        "compression_level": None,
+        "row_group_rows": 100000,
+        "sort_by": [],
+        "write_statistics": True,
+        "write_page_index": False,
+    },
+    # Smallest files for long backfills that are rarely read
+    "archive": {
+        "compression": "zstd",
+        "compression_level": 9,
+        "row_group_rows": 500000,
+        "sort_by": ["Disease", "Date", "Region"],
+        "write_statistics": True,
+        "write_page_index": True,
+    },
+}
+
+
+# Helper function - convert a dictionary-encoded string column by converting only its dictionary
+def _convert_dictionary(column, target_type):
+    column = column.combine_chunks()
+    return column.dictionary.cast(target_type).take(column.indices)
+
+# Per-row content hash over all columns, computed with pandas' vectorized hashing (fixed key, so it is stable
+# between runs). The staging upsert compares fingerprints instead of every column to find revised rows.
+def row_fingerprints(table):
+    frame = pd.DataFrame({
+        "Disease": table["Disease"].to_numpy(),
+        "Region": table["Region"].to_pandas(),
+        "Current_Week_Occurrence_Count": table["Current_Week_Occurrence_Count"].to_numpy(),
+        "Date": table["Date"].cast(pa.int32()).to_numpy(),
+    })
+    return pa.array(pd.util.hash_pandas_object(frame, index=False).to_numpy().view(np.int64))
+
+# Convert a builder table (dictionary-encoded strings) to output_schema and sort it by the profile's sort order
+def to_output_table(table, profile):
+    region = table["Region"].combine_chunks()
+    table = pa.table({
+        "Disease": _convert_dictionary(table["Disease"], pa.int16()),
+        "Region": region,
+        "Current_Week_Occurrence_Count": table["Current_Week_Occurrence_Count"].cast(pa.int32()),
+        "Date": _convert_dictionary(table["Date"], pa.date32()),
+    }, schema=output_schema.remove(output_schema.get_field_index("Fingerprint")))
+    table = table.append_column(output_schema.field("Fingerprint"), row_fingerprints(table))
+    return sort_rows(table, profile)
+
+# Sort an output_schema table by the profile's sort order
+def sort_rows(table, profile):
+    if not profile["sort_by"] or not table.num_rows:
+        return table
+
+    # Arrow can't sort dictionary columns directly, so Region is sorted by the rank of its dictionary value
+    keys = {column: table[column] for column in profile["sort_by"] if column != "Region"}
+    if "Region" in profile["sort_by"]:
+        region = table["Region"].combine_chunks()
+        keys["Region"] = pc.rank(region.dictionary, sort_keys="ascending").take(region.indices)
+    order = pc.sort_indices(pa.table({column: keys[column] for column in profile["sort_by"]}),
+                            sort_keys=[(column, "ascending") for column in profile["sort_by"]])
+    return table.take(order)
+
+# Keyword arguments for pq.ParquetWriter / pq.write_table
+def writer_options(profile):
+    options = {
+        "compression": profile["compression"],
+        "compression_level": profile["compression_level"],
+        "write_statistics": profile["write_statistics"],
+        "write_page_index": profile["write_page_index"],
+    }
+    if profile["sort_by"]:
+        options["sorting_columns"] = [pq.SortingColumn(output_schema.get_field_index(column)) for column in profile["sort_by"]]
+    return options
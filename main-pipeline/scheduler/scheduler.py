@@ -10,10 +10,26 @@ if __name__ == "__main__":
         work_pool_name="victor-pool1",  # work pool
         job_variables={
             "env": {"ENVIRONMENT": "production"},
-            "pip_packages": ["pandas", "requests"]  # Add any other dependencies your flow requires
+            "pip_packages": ["pandas", "requests", "google-cloud-bigquery"]  # Add any other dependencies your flow requires
         },
         cron="0 23 * * 0",  # Schedule: Runs at 11 PM EST on Sundays
         tags=["production"],
         description="The pipeline to extract, transform, and load CDC data into BigQuery",
         version="1.0.0",
     )
+
+    # Historical backfill: run on demand with a date range (see backfill_pipeline_flow)
+    flow.from_source(
+        source="https://github.com/Olivia-Peng/BA882-pipeline_G10.git",
+        entrypoint="main-pipeline/flows/etl-flow.py:backfill_pipeline_flow",
+    ).deploy(
+        name="cdc-backfill",
+        work_pool_name="victor-pool1",
+        job_variables={
+            "env": {"ENVIRONMENT": "production"},
+            "pip_packages": ["pandas", "requests", "google-cloud-bigquery"]
+        },
+        tags=["production"],
+        description="Backfill of the CDC pipeline for a date range, in parallel chunks of MMWR weeks",
+        version="1.0.0",
+    )
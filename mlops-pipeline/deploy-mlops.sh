@@ -1,6 +1,11 @@
 # Set the project
 gcloud config set project ba882-group-10
 
+# Telemetry wrapper of the function entry points, shared with other functions from pipeline_utils
+for function_dir in retrieve-train-data schema-setup hyperparameter-tuning trainer predictions; do
+    cp ../pipeline_utils/telemetry.py ./functions/$function_dir/telemetry.py
+done
+
 echo "======================================================"
 echo "Deploying the CDC disease occurrences view creation function"
 echo "======================================================"
@@ -23,6 +28,9 @@ echo "======================================================"
 echo "Deploying the MLOps Model Schema Creation Function"
 echo "======================================================"
 
+# The schema registry is maintained with the main pipeline's schema-setup function
+cp ../main-pipeline/functions/schema-setup/schema_registry.py ./functions/schema-setup/schema_registry.py
+
 gcloud functions deploy mlops_create_schema \
     --gen2 \
     --runtime python311 \
@@ -41,6 +49,14 @@ echo "======================================================"
 echo "Deploying the SARIMA Model Training Function"
 echo "======================================================"
 
+# Asynchronous job handles, shared with other functions from pipeline_utils
+cp ../pipeline_utils/job_handles.py ./functions/trainer/job_handles.py
+
+# Queue delivering the worker requests of asynchronous jobs (a worker request runs exactly once)
+# The tasks carry an identity token of etl-pipeline@, which needs the invoker role on the function (and actAs on itself)
+gcloud tasks queues describe function-jobs --location us-central1 > /dev/null 2>&1 || \
+    gcloud tasks queues create function-jobs --location us-central1 --max-attempts 1
+
 gcloud functions deploy train_sarima_models \
     --gen2 \
     --runtime python311 \
@@ -52,7 +68,8 @@ gcloud functions deploy train_sarima_models \
     --region us-central1 \
     --allow-unauthenticated \
     --memory 2048MB \
-    --timeout 600s
+    --timeout 600s \
+    --set-env-vars JOB_TIMEOUT_SECONDS=600,JOB_DISPATCH_QUEUE=projects/ba882-group-10/locations/us-central1/queues/function-jobs,JOB_DISPATCH_SERVICE_ACCOUNT=etl-pipeline@ba882-group-10.iam.gserviceaccount.com
 
 
 
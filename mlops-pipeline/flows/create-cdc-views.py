@@ -1,15 +1,16 @@
 # CDC Disease Occurrences View Creation Job
 
 # imports
-import requests
+import sys
+from pathlib import Path
 from prefect import flow, task
+from prefect.runtime import flow_run
 from prefect.events import DeploymentEventTrigger
 
-# helper function - generic invoker
-def invoke_gcf(url: str, payload: dict):
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    return response.json()
+# The shared Cloud Function invoker lives in pipeline_utils at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from pipeline_utils.gcf_invoker import collect_telemetry, invoke_gcf
+from pipeline_utils.pipeline_metrics import save_pipeline_metrics
 
 @task(retries=2)
 def create_cdc_views():
@@ -22,7 +23,9 @@ def create_cdc_views():
 @flow(name="cdc-disease-ml-datasets", log_prints=True)
 def cdc_ml_datasets():
     # Execute the CDC occurrences view creation
+    collect_telemetry()
     create_cdc_views()
+    save_pipeline_metrics("cdc-disease-ml-datasets", flow_run.id, collect_telemetry())
 
 #Set up for local testing
 if __name__ == "__main__":
@@ -10,7 +10,7 @@ if __name__ == "__main__":
         work_pool_name="victor-pool1",
         job_variables={
             "env": {"ENVIRONMENT": "production"},
-            "pip_packages": ["pandas", "requests"]
+            "pip_packages": ["pandas", "requests", "google-cloud-bigquery"]
         },
         tags=["prod"],
         description="Pipeline to create CDC disease occurrences ML datasets after data extraction to BigQuery.",
@@ -10,7 +10,7 @@ if __name__ == "__main__":
         work_pool_name="victor-pool1",  # Work pool
         job_variables={
             "env": {"ENVIRONMENT": "production"},
-            "pip_packages": ["pandas", "requests", "scikit-learn", "statsmodels", "google-cloud-storage"]  # Required dependencies
+            "pip_packages": ["pandas", "requests", "scikit-learn", "statsmodels", "google-cloud-storage", "google-cloud-bigquery"]  # Required dependencies
         },
         cron="0 0 1 */3 *",  # Schedule: Runs on the first day of every 3rd month at midnight UTC
         tags=["prod"],
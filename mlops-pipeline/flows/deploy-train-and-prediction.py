@@ -10,7 +10,7 @@ if __name__ == "__main__":
         work_pool_name="victor-pool1",
         job_variables={
             "env": {"ENVIRONMENT": "production"},
-            "pip_packages": ["pandas", "requests", "prefect"]
+            "pip_packages": ["pandas", "requests", "prefect", "google-cloud-bigquery"]
         },
         tags=["prod"],
         description="Pipeline to ensure schema, train SARIMA models, and generate predictions weekly.",
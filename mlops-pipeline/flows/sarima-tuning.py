@@ -1,15 +1,16 @@
 # SARIMA Hyperparameter Tuning Job
 
 # imports
-import requests
+import sys
+from pathlib import Path
 from prefect import flow, task
+from prefect.runtime import flow_run
 from prefect.events import DeploymentEventTrigger
 
-# helper function - generic invoker
-def invoke_gcf(url: str, payload: dict):
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    return response.json()
+# The shared Cloud Function invoker lives in pipeline_utils at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from pipeline_utils.gcf_invoker import collect_telemetry, invoke_gcf
+from pipeline_utils.pipeline_metrics import save_pipeline_metrics
 
 @task(retries=2)
 def execute_sarima_tuning(disease_code: str):
@@ -24,7 +25,9 @@ def execute_sarima_tuning(disease_code: str):
 def sarima_tuning_flow(disease_code: str = "370"):
     """Execute the SARIMA Hyperparameter Tuning process."""
     # Execute the SARIMA tuning Cloud Function
+    collect_telemetry()
     result = execute_sarima_tuning(disease_code)
+    save_pipeline_metrics("sarima-hyperparameter-tuning", flow_run.id, collect_telemetry())
     print(f"Result: {result}")
 
 # Set up for local testing
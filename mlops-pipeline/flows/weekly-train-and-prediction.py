@@ -33,14 +33,15 @@ and set to trigger weekly after the completion of the "cdc-disease-ml-datasets"
 """
 
 # Imports
-import requests
+import sys
+from pathlib import Path
 from prefect import flow, task, get_run_logger
+from prefect.runtime import flow_run
 
-# Helper function to invoke a Cloud Function
-def invoke_gcf(url: str, payload: dict):
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    return response.json()
+# The shared Cloud Function invoker lives in pipeline_utils at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from pipeline_utils.gcf_invoker import collect_telemetry, invoke_gcf, latency_report, run_gcf_job
+from pipeline_utils.pipeline_metrics import save_pipeline_metrics
 
 @task(retries=2)
 def ensure_schema():
@@ -58,12 +59,12 @@ def ensure_schema():
 
 @task(retries=1)
 def train_sarima_models():
-    """Invoke the Cloud Function to train SARIMA models."""
+    """Submit SARIMA model training as an asynchronous job and poll it until it has finished."""
     logger = get_run_logger()
     url = "https://train-sarima-models-162771833878.us-central1.run.app"  
     logger.info("Invoking Cloud Function for model training: %s", url)
     try:
-        resp = invoke_gcf(url, payload={})
+        resp = run_gcf_job(url, payload={})
         logger.info("Model training completed successfully: %s", resp)
         return resp
     except Exception as e:
@@ -89,6 +90,7 @@ def predict_sarima_models():
 def weekly_train_and_prediction():
     logger = get_run_logger()
     logger.info("Starting the weekly train-and-prediction flow.")
+    collect_telemetry()  # drop the telemetry of an earlier run in this process
 
     # Ensure all necessary BigQuery tables are created
     schema_result = ensure_schema()
@@ -103,6 +105,8 @@ def weekly_train_and_prediction():
     logger.info("Prediction result: %s", predict_result)
 
     logger.info("Weekly train-and-prediction flow completed successfully.")
+    save_pipeline_metrics("weekly-train-and-prediction", flow_run.id, collect_telemetry())
+    latency_report()
 
 # Allow for local testing
 if __name__ == "__main__":
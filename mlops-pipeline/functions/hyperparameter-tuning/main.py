@@ -9,6 +9,7 @@ from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 from datetime import datetime
 import functions_framework
 import tempfile
+from telemetry import instrumented, record
 
 ## Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -131,6 +132,7 @@ def load_data_from_gcs(bucket_name, disease_code):
 
 # Cloud Function entry point
 @functions_framework.http
+@instrumented("hyperparameter_tuning")
 def sarima_hyperparameter_tuning(request):
     request_json = request.get_json(silent=True)
     
@@ -148,6 +150,8 @@ def sarima_hyperparameter_tuning(request):
         logging.error(f"Failed to load training data for disease code {disease_code}: {str(e)}")
         return {"error": "Failed to load training data"}, 500
 
+    record(rows_in=len(df))
+
     # Split data
     train_df, val_df = split_data(df)
     
@@ -4,6 +4,7 @@ Cloud Function to generate predictions for each trained SARIMA model in GCS.
 2. Loads each model and retrieves its last training date from the metadata file.
 3. Generates predictions for the next 8 weeks.
 4. Stores predictions in the BigQuery `predictions` table.
+5. Returns the request's telemetry (time, CPU, memory, predictions written) with the results (telemetry.py).
 
 BigQuery Dataset: cdc_data
 GCS Bucket: ba882-group-10-mlops
@@ -16,6 +17,7 @@ import json
 import re
 import tempfile
 from google.cloud import storage, bigquery
+from telemetry import instrumented, record
 
 # Settings
 project_id = 'ba882-group-10'
@@ -28,6 +30,7 @@ bigquery_client = bigquery.Client(project=project_id)
 storage_client = storage.Client()
 
 @functions_framework.http
+@instrumented("predict")
 def predict_with_latest_models(request):
     """Predicts for the next 8 weeks using the latest SARIMA model for each disease code."""
 
@@ -72,6 +75,7 @@ def predict_with_latest_models(request):
 
         # Log predictions to BigQuery
         log_predictions_to_bq(bigquery_client, disease_code, model_id, future_dates, predictions)
+        record(rows_out=len(future_dates))
 
         # Append results for logging
         results.append({
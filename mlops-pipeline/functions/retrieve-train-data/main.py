@@ -11,6 +11,7 @@ Function Steps:
    - Define and execute a SQL query to create or replace a view with aggregated data.
    - Query the view, convert the data to a pandas DataFrame, and convert `Date` to datetime.
    - Save the DataFrame as a CSV file in a specified GCS bucket, with a unique path for each disease code.
+3. Return the request's telemetry (time, CPU, memory, rows and bytes written) with the response (telemetry.py).
 
 Requirements:
 - Google Cloud Project ID: ba882-group-10
@@ -23,6 +24,7 @@ Requirements:
 import functions_framework
 from google.cloud import bigquery, storage
 import pandas as pd
+from telemetry import instrumented, record
 
 # Settings
 project_id = 'ba882-group-10'
@@ -33,6 +35,7 @@ disease_codes = ['370']  # Add disease codes to this list as needed
 
 # Cloud Function to create or update BigQuery views and save them as CSVs in GCS
 @functions_framework.http
+@instrumented("retrieve_train_data")
 def task(request):
     # Initialize BigQuery and GCS clients
     client = bigquery.Client()
@@ -75,7 +78,9 @@ def task(request):
         
         # Write DataFrame to CSV in-memory and upload to GCS
         print(f"Writing the DataFrame for disease code {disease_code} to GCS as CSV...")
-        blob.upload_from_string(df.to_csv(index=False), content_type='text/csv')
+        csv_data = df.to_csv(index=False)
+        blob.upload_from_string(csv_data, content_type='text/csv')
+        record(rows_out=len(df), bytes_written=len(csv_data))
 
         # Add the CSV path to the list of output paths
         csv_paths.append(f"gs://{ml_bucket_name}/{csv_path}")
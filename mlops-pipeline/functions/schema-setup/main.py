@@ -8,74 +8,34 @@ Tables created:
 3. model_parameters: Stores model hyperparameters used in training, along with model_id and parameter values.
 4. predictions: Stores weekly predictions made by the latest trained model, including model_id, inference_date, date, predicted occurrence, and disease code.
 
+The tables are declared in schema_registry.py, shared with the main pipeline's schema-setup function (deploy-mlops.sh
+copies it from main-pipeline/functions/schema-setup). When the registry's fingerprint, stored on the cdc_data dataset,
+matches, the function returns without touching any table; otherwise only the DDL for the missing pieces runs, as one
+script. Layout changes that need a data migration are left to the main pipeline's schema-setup and reported here.
+
 BigQuery Dataset: cdc_data
 """
 
 # Imports
 import functions_framework
 from google.cloud import bigquery
+import json
+from schema_registry import apply_schema_registry
+from telemetry import instrumented
 
 # Settings
 project_id = 'ba882-group-10'
-dataset_id = 'cdc_data'
 
 # Cloud Function to create the required tables
 @functions_framework.http
+@instrumented("mlops_create_schema")
 def create_schema(request):
     # Initialize BigQuery client
     client = bigquery.Client(project=project_id)
 
-    # Define the tables and their schemas
-    tables = {
-        "model_runs": [
-            bigquery.SchemaField("model_id", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("name", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("gcs_path", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("model_path", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("disease_code", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("created_at", "TIMESTAMP", mode="NULLABLE", default_value_expression="CURRENT_TIMESTAMP")
-        ],
-        "model_metrics": [
-            bigquery.SchemaField("model_id", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("metric_name", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("metric_value", "FLOAT", mode="NULLABLE")
-        ],
-        "model_parameters": [
-            bigquery.SchemaField("model_id", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("parameter_name", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("parameter_value", "STRING", mode="NULLABLE")
-        ],
-        "predictions": [
-            bigquery.SchemaField("model_id", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("inference_date", "TIMESTAMP", mode="REQUIRED"),
-            bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
-            bigquery.SchemaField("predicted_occurrence", "FLOAT", mode="REQUIRED"),
-            bigquery.SchemaField("Disease", "STRING", mode="REQUIRED")  # Added disease code field
-        ]
-    }
-
-    # Create the dataset if it does not exist
-    dataset_ref = bigquery.Dataset(f"{project_id}.{dataset_id}")
-    try:
-        client.get_dataset(dataset_ref)
-        print(f"Dataset {dataset_id} already exists.")
-    except Exception:
-        print(f"Dataset {dataset_id} does not exist. Creating it...")
-        client.create_dataset(bigquery.Dataset(dataset_ref))
-
-    # Loop through tables and create them if they don't exist
-    for table_name, schema in tables.items():
-        table_id = f"{project_id}.{dataset_id}.{table_name}"
-        table = bigquery.Table(table_id, schema=schema)
-        try:
-            client.get_table(table_id)  # Check if table exists
-            print(f"Table {table_name} already exists.")
-        except Exception:
-            print(f"Table {table_name} does not exist. Creating it...")
-            client.create_table(table)
-            print(f"Table {table_name} created successfully.")
-
-    return {"status": "Tables created or verified successfully."}, 200
-
-
-
+    # Create the missing datasets, tables and columns of the registry
+    request_json = request.get_json(silent=True) or {}
+    result = apply_schema_registry(client, force=bool(request_json.get('force', False)))
+    if result.get("unsupported"):
+        return json.dumps(result), 500
+    return {"status": "Tables created or verified successfully.", "schema": result}, 200
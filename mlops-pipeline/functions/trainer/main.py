@@ -9,6 +9,9 @@ Updates:
 5. Evaluates the trained SARIMA model using R2, MAE, and MSE metrics.
 6. Stores the trained SARIMA model and metadata in GCS.
 7. Logs metadata, metrics, and hyperparameters for each trained model into BigQuery.
+8. With {"async": true}, returns a job handle right away and trains in a separate request; {"job_status": <handle>}
+   reports the job's state (job_handles.py, state kept in the GCS bucket below).
+9. Returns the run's telemetry (time, CPU, memory, training rows, models logged) with the results (telemetry.py).
 
 BigQuery Dataset: cdc_data
 GCS Bucket: ba882-group-10-mlops
@@ -26,6 +29,8 @@ from google.cloud import storage, bigquery
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from gcsfs import GCSFileSystem
+from job_handles import async_job
+from telemetry import instrumented, record
 
 # Settings
 project_id = 'ba882-group-10'
@@ -35,6 +40,8 @@ model_storage_path = 'pipeline'
 best_params_path = 'tunning_results'  # Path to JSON files with best parameters
 
 @functions_framework.http
+@async_job(bucket_name, 'train_sarima_models')
+@instrumented("train")
 def train_sarima_models(request):
     """Train SARIMA models for each disease code in the training data."""
 
@@ -56,6 +63,7 @@ def train_sarima_models(request):
             # Load data
             df = pd.read_csv(csv_path, parse_dates=['Date'])
             df = df.sort_values(by="Date")
+            record(rows_in=len(df))
 
             # Load best parameters from GCS
             best_params = get_best_params_from_gcs(bucket_name, disease_code)
@@ -109,6 +117,7 @@ def train_sarima_models(request):
         except Exception as e:
             print(f"Error processing disease code {disease_code}: {e}")
 
+    record(rows_out=len(results))  # one model_runs row per trained model
     return {"results": results}, 200
 
 def get_best_params_from_gcs(bucket_name, disease_code):
@@ -0,0 +1 @@
+# Helpers shared by the Prefect flows of all pipelines
@@ -0,0 +1,179 @@
+# Shared Cloud Function invoker for the Prefect flows
+#
+# All flows (main ETL, MLOps, symptoms) call their Cloud Functions through invoke_gcf():
+# - One requests.Session per process with a pooled HTTPAdapter, so connections to the same host are kept alive and
+#   reused, also by tasks running concurrently in a thread-pool task runner.
+# - Every request has a connect and a read timeout; a hung function raises requests.Timeout instead of blocking a
+#   worker forever. The defaults come from GCF_CONNECT_TIMEOUT / GCF_READ_TIMEOUT and can be set per call.
+# - Responses with a retryable status (429, 500, 502, 503, 504) and connection errors are retried up to
+#   GCF_MAX_RETRIES times with full-jitter exponential backoff (Retry-After is honoured). Read timeouts are not
+#   retried here: the function may still be running, and the task's own Prefect retries decide what to do.
+# - The latency of every attempt is recorded in a histogram per endpoint; latency_report() prints them.
+# Functions decorated with job_handles.async_job can also be run with run_gcf_job(): the work is submitted, the
+# function answers with a job handle right away, and the flow polls the job's status with backoff instead of holding
+# one HTTP request open for the whole run.
+# Functions wrapped with telemetry.instrumented return their measurements (time, CPU, memory, rows, bytes) with each
+# response; they are kept per call and collect_telemetry() hands them to the flow, which stores them with
+# pipeline_metrics.save_pipeline_metrics().
+
+import json
+import os
+import random
+import time
+from bisect import bisect_left
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Defaults, overridable through the environment of the flow run
+connect_timeout = float(os.environ.get('GCF_CONNECT_TIMEOUT', '10'))
+read_timeout = float(os.environ.get('GCF_READ_TIMEOUT', '600'))  # the functions are deployed with up to 600s timeouts
+max_retries = int(os.environ.get('GCF_MAX_RETRIES', '3'))
+backoff_base = float(os.environ.get('GCF_BACKOFF_BASE', '1'))
+backoff_cap = float(os.environ.get('GCF_BACKOFF_CAP', '30'))
+pool_size = int(os.environ.get('GCF_POOL_SIZE', '32'))
+
+# Polling of asynchronous jobs: first interval, growth factor and longest interval (seconds)
+poll_interval = float(os.environ.get('GCF_POLL_INTERVAL', '2'))
+poll_backoff = 1.5
+max_poll_interval = float(os.environ.get('GCF_MAX_POLL_INTERVAL', '30'))
+
+retryable_status_codes = {429, 500, 502, 503, 504}
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is everything above
+latency_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+_session = None
+_session_lock = Lock()
+_latencies = {}
+_latencies_lock = Lock()
+_telemetry = []
+_telemetry_lock = Lock()
+
+telemetry_header = 'X-Pipeline-Telemetry'
+
+
+# Helper function - the process-wide session, created on first use
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+# Helper function - histogram key of a URL (host and path, without the query string)
+def endpoint_name(url):
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}"
+
+# Helper function - add one attempt to the endpoint's histogram; outcome is the status code or the exception name
+def record_latency(endpoint, seconds, outcome):
+    with _latencies_lock:
+        stats = _latencies.setdefault(endpoint, {"buckets": [0] * (len(latency_buckets) + 1), "count": 0,
+                                                 "total_seconds": 0.0, "max_seconds": 0.0, "outcomes": {}})
+        stats["buckets"][bisect_left(latency_buckets, seconds)] += 1
+        stats["count"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["outcomes"][str(outcome)] = stats["outcomes"].get(str(outcome), 0) + 1
+
+# Helper function - keep the telemetry a function returned for one call
+def record_telemetry(endpoint, telemetry):
+    if not isinstance(telemetry, dict):
+        return
+    with _telemetry_lock:
+        _telemetry.append({**telemetry, "endpoint": endpoint})
+
+# Helper function - full-jitter backoff, or the server's Retry-After when it sent one
+def retry_delay(attempt, response=None):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), backoff_cap)
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+# POST a JSON payload to a Cloud Function and return its JSON response (or its text when the body isn't JSON)
+def invoke_gcf(url: str, payload: dict = None, timeout=None, retries: int = None):
+    timeout = timeout or (connect_timeout, read_timeout)
+    retries = max_retries if retries is None else retries
+    endpoint = endpoint_name(url)
+    session = get_session()
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = session.post(url, json=payload, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_latency(endpoint, time.perf_counter() - start, type(e).__name__)
+            # A connect failure never reached the function, so it is safe to send again
+            if isinstance(e, requests.ReadTimeout) or attempt == retries:
+                raise
+            delay = retry_delay(attempt)
+            print(f"{endpoint}: {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+            time.sleep(delay)
+            continue
+
+        record_latency(endpoint, time.perf_counter() - start, response.status_code)
+        if response.headers.get(telemetry_header):
+            record_telemetry(endpoint, json.loads(response.headers[telemetry_header]))
+        if response.status_code in retryable_status_codes and attempt < retries:
+            delay = retry_delay(attempt, response)
+            print(f"{endpoint}: HTTP {response.status_code}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+            time.sleep(delay)
+            continue
+
+        response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError:
+            return response.text
+
+# Submit work to an async_job function and poll until it has finished; returns the function's result.
+# timeout bounds the total wait (seconds); a failed or lost job raises RuntimeError.
+def run_gcf_job(url: str, payload: dict = None, timeout: float = None):
+    start = time.monotonic()
+    accepted = invoke_gcf(url, {**(payload or {}), "async": True})
+    handle = accepted["handle"]
+    print(f"{endpoint_name(url)}: job {handle} accepted")
+
+    interval = poll_interval
+    while True:
+        time.sleep(random.uniform(interval / 2, interval))
+        state = invoke_gcf(url, {"job_status": handle})
+        # The worker request's response never reaches the flow, so its telemetry comes with the stored result
+        if isinstance(state.get("result"), dict):
+            record_telemetry(endpoint_name(url), state["result"].get("telemetry"))
+        if state["state"] == "succeeded":
+            record_latency(f"{endpoint_name(url)} (job)", time.monotonic() - start, "succeeded")
+            return state.get("result")
+        if state["state"] in ("failed", "lost"):
+            record_latency(f"{endpoint_name(url)} (job)", time.monotonic() - start, state["state"])
+            raise RuntimeError(f"Job {handle} of {endpoint_name(url)} {state['state']}: {state.get('error') or state.get('result')}")
+        if timeout and time.monotonic() - start > timeout:
+            raise TimeoutError(f"Job {handle} of {endpoint_name(url)} still {state['state']} after {timeout}s")
+        interval = min(interval * poll_backoff, max_poll_interval)
+
+# Print the latency histogram of every endpoint called by this process and return it
+def latency_report():
+    with _latencies_lock:
+        report = {endpoint: {**stats, "buckets": list(stats["buckets"]), "outcomes": dict(stats["outcomes"])}
+                  for endpoint, stats in _latencies.items()}
+
+    labels = [f"<={bound}s" for bound in latency_buckets] + [f">{latency_buckets[-1]}s"]
+    for endpoint, stats in sorted(report.items()):
+        mean = stats["total_seconds"] / stats["count"]
+        print(f"{endpoint}: {stats['count']} calls, mean {mean:.2f}s, max {stats['max_seconds']:.2f}s, outcomes {stats['outcomes']}")
+        print("    " + "  ".join(f"{label} {count}" for label, count in zip(labels, stats["buckets"]) if count))
+    return report
+
+# Return the telemetry of the calls made since the last collect and forget it
+def collect_telemetry():
+    with _telemetry_lock:
+        records = list(_telemetry)
+        _telemetry.clear()
+    return records
@@ -0,0 +1,182 @@
+# Asynchronous job handles for long-running Cloud Functions
+#
+# A function decorated with @async_job keeps working as before when it is called synchronously, and additionally
+# understands three kinds of requests:
+# - {"async": true, ...}: the work is accepted and the function answers 202 with a job handle right away. The state
+#   of the job is stored as gs://<bucket>/function-jobs/<function>/<handle>.json, and a worker request
+#   {"run_job": <handle>, ...} is sent to the same function, so the work runs in its own request.
+# - {"run_job": <handle>, ...}: the worker request. It claims the job (a generation precondition on the state
+#   object makes a duplicate delivery a no-op), runs the wrapped function and stores its status code and result.
+# - {"job_status": <handle>}: returns the stored state. A job still "running" after its deadline (the function
+#   timeout, JOB_TIMEOUT_SECONDS) is reported as "lost", e.g. when the instance was shut down mid-run. So is a job
+#   still "queued" JOB_DISPATCH_GRACE_SECONDS after it was accepted: its worker request never started, and a worker
+#   request arriving after that does not run it.
+#
+# Dispatch: the worker request is a Cloud Tasks HTTP task on JOB_DISPATCH_QUEUE
+# (projects/<project>/locations/<region>/queues/<queue>, created by the deploy scripts). Cloud Tasks keeps the request
+# open until the function answers (up to its dispatch deadline, the job timeout), so Cloud Run counts the instance
+# as busy for the whole job. The task carries an OIDC token of JOB_DISPATCH_SERVICE_ACCOUNT, so it also reaches
+# functions that don't allow unauthenticated calls; the account needs the invoker role on the function, and the
+# function's own account needs iam.serviceAccounts.actAs on it. Without a queue, {"async": true} is refused
+# rather than relying on a request that outlives its caller.
+# The flows submit and poll with pipeline_utils.gcf_invoker.run_gcf_job(). Since the worker request is not tied to
+# the caller's connection, a flow that disconnects or restarts can keep polling the same handle.
+#
+# The canonical copy lives in pipeline_utils/ at the root of the repository; the deploy scripts copy it into the
+# folders of the functions that use it.
+
+import functools
+import json
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import storage
+
+jobs_prefix = 'function-jobs'
+
+# Longest a worker request can run (the function's deployed timeout)
+job_timeout_seconds = int(os.environ.get('JOB_TIMEOUT_SECONDS', '600'))
+
+# Cloud Tasks queue delivering the worker requests, and the service account whose identity token they carry
+dispatch_queue = os.environ.get('JOB_DISPATCH_QUEUE')
+dispatch_service_account = os.environ.get('JOB_DISPATCH_SERVICE_ACCOUNT')
+
+# Longest a job can stay queued before its worker request is considered lost
+dispatch_grace_seconds = int(os.environ.get('JOB_DISPATCH_GRACE_SECONDS', '120'))
+
+
+# Helper function - current time as an ISO string
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+# Helper function - state object of a job
+def state_blob(bucket_name, function_name, handle):
+    return storage.Client().bucket(bucket_name).blob(f"{jobs_prefix}/{function_name}/{handle}.json")
+
+# Helper function - read a job state and the generation it was read at (None, None when there is no such job)
+def read_state(blob):
+    if not blob.exists():
+        return None, None
+    return json.loads(blob.download_as_text()), blob.generation
+
+# Helper function - write a job state; with generation set, only if nobody changed it since it was read
+def write_state(blob, state, generation=None):
+    blob.upload_from_string(json.dumps(state), content_type='application/json', if_generation_match=generation)
+
+# Helper function - the URL this function was called on (Cloud Run terminates TLS in front of the function)
+def own_url(request):
+    scheme = request.headers.get('X-Forwarded-Proto', request.scheme)
+    return f"{scheme}://{request.host}{request.path}"
+
+# Helper function - whether a queued job has waited longer than the dispatch grace period
+def dispatch_overdue(state):
+    accepted = datetime.fromisoformat(state["created_at"])
+    return state["state"] == "queued" and datetime.now(timezone.utc) > accepted + timedelta(seconds=dispatch_grace_seconds)
+
+# Helper function - send the worker request of a job as a Cloud Tasks task
+# (imported here: functions that are only called synchronously, e.g. in local runs, don't need the client)
+def dispatch(url, payload):
+    from google.cloud import tasks_v2
+    from google.protobuf import duration_pb2
+
+    oidc_token = tasks_v2.OidcToken(service_account_email=dispatch_service_account, audience=url) if dispatch_service_account else None
+    task = tasks_v2.Task(
+        http_request=tasks_v2.HttpRequest(http_method=tasks_v2.HttpMethod.POST, url=url,
+                                          headers={"Content-Type": "application/json"},
+                                          body=json.dumps(payload).encode(), oidc_token=oidc_token),
+        # Cloud Tasks allows at most 30 minutes
+        dispatch_deadline=duration_pb2.Duration(seconds=min(job_timeout_seconds, 1800)),
+    )
+    tasks_v2.CloudTasksClient().create_task(parent=dispatch_queue, task=task)
+
+# Helper function - split a Flask-style return value into (body, status code), decoding JSON bodies
+def split_response(response):
+    body, status_code = (response[0], response[1]) if isinstance(response, tuple) else (response, 200)
+    if isinstance(body, (str, bytes)):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            body = body.decode() if isinstance(body, bytes) else body
+    return body, status_code
+
+# Accept the work, store it as queued and start the worker request
+def submit_job(request, request_json, bucket_name, function_name):
+    if not dispatch_queue:
+        return f"{function_name} cannot run asynchronous jobs: JOB_DISPATCH_QUEUE is not set", 501
+    handle = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:12]}"
+    blob = state_blob(bucket_name, function_name, handle)
+    payload = {key: value for key, value in request_json.items() if key != 'async'}
+    state = {"handle": handle, "function": function_name, "state": "queued", "created_at": now_iso(), "request": payload}
+    write_state(blob, state, generation=0)
+
+    # The worker request runs for as long as the work takes; only its dispatch is awaited here
+    try:
+        dispatch(own_url(request), {**payload, "run_job": handle})
+    except Exception as e:
+        write_state(blob, {**state, "state": "failed", "finished_at": now_iso(), "error": f"Dispatch failed: {str(e)}"})
+        return json.dumps({"handle": handle, "state": "failed", "error": str(e)}), 500
+
+    print(f"Accepted job {handle} for {function_name}")
+    return json.dumps({"handle": handle, "state": "queued"}), 202
+
+# Worker request: claim the job, run the function and store the outcome
+def run_job(function, request, handle, bucket_name, function_name):
+    blob = state_blob(bucket_name, function_name, handle)
+    state, generation = read_state(blob)
+    if state is None:
+        return f"Unknown job {handle}", 404
+    if state["state"] != "queued":
+        return json.dumps({"handle": handle, "state": state["state"]}), 409
+    # The job was already reported as lost to whoever polls it
+    if dispatch_overdue(state):
+        print(f"Job {handle} was dispatched too late and is not run")
+        return json.dumps({"handle": handle, "state": "lost"}), 409
+
+    started = datetime.now(timezone.utc)
+    state = {**state, "state": "running", "started_at": started.isoformat(),
+             "deadline": (started + timedelta(seconds=job_timeout_seconds)).isoformat()}
+    try:
+        write_state(blob, state, generation=generation)
+    except PreconditionFailed:
+        print(f"Job {handle} was already claimed by another request")
+        return json.dumps({"handle": handle, "state": "claimed"}), 409
+
+    try:
+        response = function(request)
+    except Exception as e:
+        write_state(blob, {**state, "state": "failed", "finished_at": now_iso(), "status_code": 500, "error": str(e)})
+        raise
+    result, status_code = split_response(response)
+    outcome = "succeeded" if status_code < 400 else "failed"
+    write_state(blob, {**state, "state": outcome, "finished_at": now_iso(), "status_code": status_code, "result": result})
+    print(f"Job {handle} {outcome} with status {status_code}")
+    return response
+
+# Status request: the stored state, with overdue queued and running jobs reported as lost
+def job_status(handle, bucket_name, function_name):
+    state, _ = read_state(state_blob(bucket_name, function_name, handle))
+    if state is None:
+        return f"Unknown job {handle}", 404
+    if state["state"] == "running" and datetime.now(timezone.utc) > datetime.fromisoformat(state["deadline"]):
+        state = {**state, "state": "lost", "error": "The worker did not finish before the function timeout"}
+    elif dispatch_overdue(state):
+        state = {**state, "state": "lost", "error": f"The worker request did not start within {dispatch_grace_seconds}s"}
+    return json.dumps(state), 200
+
+# Decorator for an HTTP entry point: adds the async/run_job/job_status requests described above
+def async_job(bucket_name, function_name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(request):
+            request_json = request.get_json(silent=True) or {}
+            if request_json.get('job_status'):
+                return job_status(request_json['job_status'], bucket_name, function_name)
+            if request_json.get('run_job'):
+                return run_job(function, request, request_json['run_job'], bucket_name, function_name)
+            if request_json.get('async'):
+                return submit_job(request, request_json, bucket_name, function_name)
+            return function(request)
+        return wrapper
+    return decorator
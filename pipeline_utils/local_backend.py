@@ -0,0 +1,622 @@
+# Local execution backend: a directory stands in for Cloud Storage and a DuckDB database for BigQuery
+#
+# The Cloud Functions talk to google.cloud.storage / google.cloud.bigquery clients. This module implements the part
+# of those client interfaces the functions use, on local resources, so the functions run unchanged in one process
+# (local_pipeline.py installs these clients in place of the real ones):
+# - LocalStorageClient: bucket "<name>" is the directory <root>/buckets/<name>. Objects are files written atomically;
+#   the file's modification time is its generation, so if_generation_match preconditions behave like in GCS.
+#   gs:// URIs (pandas, gcsfs, load jobs) are mapped to the same files.
+# - DuckDBClient: dataset "<project>.<dataset>" is the DuckDB schema <dataset>. Queries are the functions' BigQuery
+#   SQL, translated where the dialects differ (backtick table ids, INT64/FLOAT64, COUNTIF, PARSE_DATE, MERGE without
+#   INTO, @parameters, PARTITION BY / CLUSTER BY and OPTIONS clauses) and run statement by statement, so scripts with
+#   TEMP tables and transactions work. Table labels, partitioning, clustering and last-modified times, which DuckDB
+#   doesn't have, are kept in the _local_meta schema, and INFORMATION_SCHEMA.SCHEMATA/COLUMNS are served from views
+#   with BigQuery's column names and types. A table's etag changes with its data and metadata, and update_table()
+#   of a table read before such a change fails with PreconditionFailed, like BigQuery's If-Match check.
+# Bytes processed/billed are not measured locally and are reported as None.
+
+import base64
+import glob
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import duckdb
+from google.api_core.exceptions import Conflict, NotFound, PreconditionFailed
+from google.cloud import bigquery
+
+# Helper function - local path of a gs:// URI under a backend root
+def gs_path(root, uri):
+    bucket_name, _, name = uri[len('gs://'):].partition('/')
+    return os.path.join(root, 'buckets', bucket_name, name)
+
+
+######
+## Cloud Storage
+######
+
+# File opened by blob.open('wb'): written next to the object and moved into place when closed
+class LocalUpload(io.FileIO):
+    def __init__(self, temp_path, path):
+        super().__init__(temp_path, 'wb')
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            os.replace(self.name, self.path)
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+        self.generation = None
+        self.size = None
+        self.updated = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.generation = self.size = self.updated = None
+            return False
+        self.generation, self.size = stat.st_mtime_ns, stat.st_size
+        self.updated = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        return True
+
+    # Base64 MD5 of the content, like GCS reports it; computed when read, since local files carry no hash
+    @property
+    def md5_hash(self):
+        if not os.path.isfile(self.path):
+            return None
+        digest = hashlib.md5()
+        with open(self.path, 'rb') as file_obj:
+            for chunk in iter(lambda: file_obj.read(1 << 20), b''):
+                digest.update(chunk)
+        return base64.b64encode(digest.digest()).decode()
+
+    @property
+    def crc32c(self):
+        return None
+
+    def _temp_path(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return os.path.join(os.path.dirname(self.path), f".{os.path.basename(self.path)}.tmp-{uuid.uuid4().hex}")
+
+    def exists(self, **kwargs):
+        return self._stat()
+
+    def reload(self, **kwargs):
+        if not self._stat():
+            raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        data = data.encode() if isinstance(data, str) else data
+        with self.bucket.client.lock:
+            # Generation 0 means "only if the object doesn't exist yet", as in GCS
+            current = self.generation if self._stat() else 0
+            if if_generation_match is not None and if_generation_match != current:
+                raise PreconditionFailed(f"gs://{self.bucket.name}/{self.name}: generation {current}, expected {if_generation_match}")
+            temp_path = self._temp_path()
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, self.path)
+            # Make sure every write gets a new generation, even within the clock's resolution
+            if self.generation is not None and os.stat(self.path).st_mtime_ns <= current:
+                os.utime(self.path, ns=(current + 1, current + 1))
+            self._stat()
+
+    def upload_from_file(self, file_obj, content_type=None, **kwargs):
+        self.upload_from_string(file_obj.read(), content_type=content_type, **kwargs)
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        with open(filename, 'rb') as source:
+            self.upload_from_string(source.read(), content_type=content_type, **kwargs)
+
+    def download_as_bytes(self, **kwargs):
+        try:
+            with open(self.path, 'rb') as source:
+                return source.read()
+        except FileNotFoundError:
+            raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+
+    def download_as_text(self, encoding='utf-8', **kwargs):
+        return self.download_as_bytes().decode(encoding)
+
+    def download_to_file(self, file_obj, **kwargs):
+        file_obj.write(self.download_as_bytes())
+
+    def download_to_filename(self, filename, **kwargs):
+        with open(filename, 'wb') as target:
+            target.write(self.download_as_bytes())
+
+    def open(self, mode='r', encoding=None, **kwargs):
+        if 'w' in mode:
+            upload = LocalUpload(self._temp_path(), self.path)
+            return upload if 'b' in mode else io.TextIOWrapper(upload, encoding=encoding or 'utf-8')
+        if not self._stat():
+            raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+        return open(self.path, mode if 'b' in mode else 'r', encoding=None if 'b' in mode else (encoding or 'utf-8'))
+
+    def delete(self, **kwargs):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, 'buckets', name)
+
+    def blob(self, name, **kwargs):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name, **kwargs):
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def exists(self, **kwargs):
+        return os.path.isdir(self.path)
+
+    def list_blobs(self, prefix=None, **kwargs):
+        blobs = []
+        for directory, _, files in os.walk(self.path):
+            for file_name in files:
+                if file_name.startswith('.') and '.tmp-' in file_name:
+                    continue
+                name = os.path.relpath(os.path.join(directory, file_name), self.path).replace(os.sep, '/')
+                if name.startswith(prefix or ''):
+                    blobs.append(self.blob(name))
+        blobs.sort(key=lambda blob: blob.name)
+        for blob in blobs:
+            blob._stat()
+        return blobs
+
+class LocalStorageClient:
+    def __init__(self, root, project='local'):
+        self.root = root
+        self.project = project
+        self.lock = threading.Lock()
+
+    def bucket(self, bucket_name, **kwargs):
+        return LocalBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name, **kwargs):
+        bucket = LocalBucket(self, bucket_name)
+        os.makedirs(bucket.path, exist_ok=True)
+        return bucket
+
+    def lookup_bucket(self, bucket_name, **kwargs):
+        return self.get_bucket(bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, LocalBucket) else self.bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix)
+
+
+######
+## BigQuery
+######
+
+# DuckDB types of BigQuery schema field types, and BigQuery names of DuckDB column types
+duckdb_types = {"STRING": "VARCHAR", "INTEGER": "BIGINT", "INT64": "BIGINT", "FLOAT": "DOUBLE", "FLOAT64": "DOUBLE",
+                "NUMERIC": "DECIMAL(38, 9)", "BOOLEAN": "BOOLEAN", "BOOL": "BOOLEAN", "DATE": "DATE",
+                "TIMESTAMP": "TIMESTAMPTZ", "DATETIME": "TIMESTAMP", "BYTES": "BLOB"}
+bigquery_types = {"VARCHAR": "STRING", "BIGINT": "INT64", "INTEGER": "INT64", "SMALLINT": "INT64", "DOUBLE": "FLOAT64",
+                  "FLOAT": "FLOAT64", "BOOLEAN": "BOOL", "DATE": "DATE", "TIMESTAMP WITH TIME ZONE": "TIMESTAMP",
+                  "TIMESTAMP": "DATETIME", "BLOB": "BYTES"}
+
+meta_schema = '_local_meta'
+meta_statements = [
+    f"CREATE SCHEMA IF NOT EXISTS {meta_schema}",
+    f"CREATE TABLE IF NOT EXISTS {meta_schema}.table_meta (table_name VARCHAR PRIMARY KEY, partition_by VARCHAR, cluster_by VARCHAR, modified TIMESTAMPTZ)",
+    f"CREATE TABLE IF NOT EXISTS {meta_schema}.labels (object_name VARCHAR, key VARCHAR, value VARCHAR, PRIMARY KEY (object_name, key))",
+    f"""CREATE OR REPLACE VIEW {meta_schema}.schemata AS
+    SELECT schema_name FROM information_schema.schemata
+    WHERE catalog_name = current_database() AND schema_name NOT IN ('{meta_schema}', 'main', 'information_schema', 'pg_catalog')""",
+    f"""CREATE OR REPLACE VIEW {meta_schema}.columns AS
+    SELECT c.table_schema, c.table_name, c.column_name,
+        CASE {' '.join(f"WHEN c.data_type = '{duck}' THEN '{bq}'" for duck, bq in bigquery_types.items())} ELSE c.data_type END AS data_type,
+        c.is_nullable,
+        CASE WHEN m.partition_by = c.column_name THEN 'YES' ELSE 'NO' END AS is_partitioning_column,
+        NULLIF(list_position(string_split(m.cluster_by, ','), c.column_name), 0) AS clustering_ordinal_position
+    FROM information_schema.columns c
+    LEFT JOIN {meta_schema}.table_meta m ON m.table_name = c.table_schema || '.' || c.table_name
+    WHERE c.table_catalog = current_database() AND c.table_schema NOT IN ('{meta_schema}', 'main')""",
+]
+
+# Statements that change a table: the table is the first identifier after these keywords
+write_pattern = re.compile(r'^\s*(?:INSERT\s+INTO|DELETE\s+FROM|MERGE(?:\s+INTO)?|UPDATE|TRUNCATE\s+TABLE|'
+                           r'CREATE\s+(?:OR\s+REPLACE\s+)?TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ALTER\s+TABLE)\s+"([^"]+)"\."([^"]+)"', re.I)
+
+# Helper function - "dataset.table" of a table id, Table or TableReference
+def table_key(table):
+    if isinstance(table, str):
+        return '.'.join(table.replace(':', '.').split('.')[-2:])
+    return f"{table.dataset_id}.{table.table_id}"
+
+# Helper function - quoted DuckDB name of a table
+def quoted(key):
+    return '.'.join(f'"{part}"' for part in key.split('.'))
+
+# Helper function - split a script into statements on semicolons outside quotes
+def split_statements(script):
+    statements, current, quote = [], [], None
+    for char in script:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in ("'", '"', '`'):
+            quote = char
+        elif char == ';':
+            statements.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+# Helper function - DuckDB name of a backtick-quoted BigQuery identifier
+def translate_identifier(match):
+    parts = match.group(1).split('.')
+    if 'INFORMATION_SCHEMA' in parts:
+        return f"{meta_schema}.{parts[-1].lower()}"
+    return quoted('.'.join(parts[-2:]))
+
+# Helper function - COUNTIF(x) as COUNT(*) FILTER (WHERE x), which is 0 rather than NULL over no rows, like BigQuery
+def translate_countif(sql):
+    match = re.search(r'\bCOUNTIF\(', sql, re.I)
+    while match:
+        depth, end = 1, match.end()
+        while depth:
+            depth += {'(': 1, ')': -1}.get(sql[end], 0)
+            end += 1
+        sql = f"{sql[:match.start()]}COUNT(*) FILTER (WHERE {sql[match.end():end - 1]}){sql[end:]}"
+        match = re.search(r'\bCOUNTIF\(', sql, re.I)
+    return sql
+
+# Translate one BigQuery statement. Returns (DuckDB statement or None, metadata action or None)
+def translate_statement(statement):
+    # A dataset is a schema: `project.dataset` names the schema "dataset"
+    sql = re.sub(r'\bSCHEMA(\s+IF\s+NOT\s+EXISTS)?\s+`(?:[^`.]+\.)?([^`.]+)`', r'SCHEMA\1 "\2"', statement, flags=re.I)
+    sql = re.sub(r'`([^`]+)`', translate_identifier, sql)
+    sql = re.sub(r'\bCURRENT_TIMESTAMP\(\)', 'CURRENT_TIMESTAMP', sql, flags=re.I)
+    sql = re.sub(r'(?<![\w])TIMESTAMP(?![\w(])(?!\s*\')', 'TIMESTAMPTZ', sql)
+    sql = re.sub(r'\bINT64\b', 'BIGINT', sql)
+    sql = re.sub(r'\bFLOAT64\b', 'DOUBLE', sql)
+    sql = translate_countif(sql)
+    sql = re.sub(r'\bSAFE_CAST\(', 'TRY_CAST(', sql, flags=re.I)
+    sql = re.sub(r"\bPARSE_DATE\('([^']*)',\s*([^)]+)\)", r"CAST(strptime(\2, '\1') AS DATE)", sql, flags=re.I)
+    sql = re.sub(r'\bDATE_SUB\(([^,]+),\s*INTERVAL\s+(\d+)\s+(\w+)\)', r'(\1 - INTERVAL \2 \3)', sql, flags=re.I)
+    sql = re.sub(r'@(\w+)', r'$\1', sql)
+    sql = re.sub(r'^\s*MERGE\s+(?!INTO\b)', 'MERGE INTO ', sql, flags=re.I)
+    sql = re.sub(r'^\s*CREATE\s+TEMP(ORARY)?\s+TABLE\s+', 'CREATE OR REPLACE TEMP TABLE ', sql, flags=re.I)
+    sql = re.sub(r'^\s*COMMIT\s+TRANSACTION\s*$', 'COMMIT', sql, flags=re.I)
+
+    # Dataset labels (the schema registry's fingerprint) live in the metadata tables
+    labels = re.match(r'^\s*ALTER\s+SCHEMA\s+"([^"]+)"\s+SET\s+OPTIONS\s*\(\s*labels\s*=\s*\[(.*)\]\s*\)\s*$', sql, re.I | re.S)
+    if labels:
+        return None, ("dataset_labels", labels.group(1), dict(re.findall(r"\(\s*'([^']*)'\s*,\s*'([^']*)'\s*\)", labels.group(2))))
+    # Other OPTIONS (expiration, description) have no local meaning
+    if re.match(r'^\s*ALTER\s+TABLE\s+\S+\s+SET\s+OPTIONS', sql, re.I):
+        return None, None
+    sql = re.sub(r'\s+OPTIONS\s*\([^)]*\)\s*$', '', sql, flags=re.I)
+
+    # Partitioning and clustering are recorded for INFORMATION_SCHEMA.COLUMNS
+    layout = None
+    create = re.match(r'^\s*CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?\s+"([^"]+)"\."([^"]+)"', sql, re.I)
+    if create:
+        cluster_by = re.search(r'\s+CLUSTER\s+BY\s+([\w\s,]+)$', sql, re.I)
+        if cluster_by:
+            sql = sql[:cluster_by.start()]
+        partition_by = re.search(r'\s+PARTITION\s+BY\s+(\w+)\s*$', sql, re.I)
+        if partition_by:
+            sql = sql[:partition_by.start()]
+        layout = ("layout", f"{create.group(1)}.{create.group(2)}", partition_by.group(1) if partition_by else None,
+                  [field.strip() for field in cluster_by.group(1).split(',')] if cluster_by else None)
+    return sql, layout
+
+# Rows returned by a local query; rows support attribute, key and index access like BigQuery rows
+class LocalRowIterator:
+    def __init__(self, columns, values):
+        field_to_index = {column: index for index, column in enumerate(columns)}
+        self.columns = columns
+        self.rows = [bigquery.Row(row, field_to_index) for row in values]
+        self.total_rows = len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def to_dataframe(self, **kwargs):
+        import pandas as pd
+        return pd.DataFrame([list(row.values()) for row in self.rows], columns=self.columns)
+
+class LocalQueryJob:
+    def __init__(self, rows, started, ended, affected_rows=None):
+        self._rows = rows
+        self.started, self.ended = started, ended
+        self.num_dml_affected_rows = affected_rows
+        self.total_bytes_processed = None
+        self.total_bytes_billed = None
+        self.job_id = uuid.uuid4().hex
+
+    def result(self, **kwargs):
+        return self._rows
+
+    def to_dataframe(self, **kwargs):
+        return self._rows.to_dataframe()
+
+class LocalLoadJob:
+    def __init__(self, input_files, input_file_bytes, output_rows, started, ended):
+        self.input_files, self.input_file_bytes = input_files, input_file_bytes
+        self.output_rows, self.output_bytes = output_rows, None
+        self.started, self.ended = started, ended
+        self.job_id = uuid.uuid4().hex
+
+    def result(self, **kwargs):
+        return self
+
+class LocalTable:
+    def __init__(self, client, key, schema, num_rows, labels, partition_by, cluster_by, modified, etag):
+        self.project = client.project
+        self.dataset_id, self.table_id = key.split('.')
+        self.full_table_id = f"{client.project}:{key}"
+        self.schema, self.num_rows, self.labels = schema, num_rows, labels
+        self.time_partitioning = bigquery.TimePartitioning(field=partition_by) if partition_by else None
+        self.clustering_fields = cluster_by
+        self.modified = modified
+        self.etag = etag
+        self.expires = None
+
+class LocalDataset:
+    def __init__(self, project, dataset_id, labels):
+        self.project, self.dataset_id, self.labels = project, dataset_id, labels
+        self.location = 'US'
+
+class DuckDBClient:
+    def __init__(self, database, project='local', storage_root=None):
+        self.project = project
+        self.storage_root = storage_root
+        self.connection = duckdb.connect(database)
+        self.lock = threading.RLock()
+        for statement in meta_statements:
+            self.connection.execute(statement)
+
+    ## Metadata
+
+    def _touch(self, key):
+        self.connection.execute(f"""
+        INSERT INTO {meta_schema}.table_meta (table_name, modified) VALUES ($table, now())
+        ON CONFLICT (table_name) DO UPDATE SET modified = now()""", {"table": key})
+
+    def _set_layout(self, key, partition_by, cluster_by):
+        self.connection.execute(f"""
+        INSERT INTO {meta_schema}.table_meta (table_name, partition_by, cluster_by, modified) VALUES ($table, $partition_by, $cluster_by, now())
+        ON CONFLICT (table_name) DO UPDATE SET partition_by = $partition_by, cluster_by = $cluster_by""",
+                                {"table": key, "partition_by": partition_by, "cluster_by": ','.join(cluster_by) if cluster_by else None})
+
+    def _set_labels(self, object_name, labels):
+        self.connection.execute(f"DELETE FROM {meta_schema}.labels WHERE object_name = $name", {"name": object_name})
+        for key, value in (labels or {}).items():
+            if value is not None:
+                self.connection.execute(f"INSERT INTO {meta_schema}.labels VALUES ($name, $key, $value)",
+                                        {"name": object_name, "key": key, "value": str(value)})
+
+    def _labels(self, object_name):
+        return dict(self.connection.execute(f"SELECT key, value FROM {meta_schema}.labels WHERE object_name = $name",
+                                            {"name": object_name}).fetchall())
+
+    def _table_exists(self, key):
+        dataset, table = key.split('.')
+        return self.connection.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = $dataset AND table_name = $table",
+                                       {"dataset": dataset, "table": table}).fetchone()[0] > 0
+
+    def _forget_table(self, key):
+        self.connection.execute(f"DELETE FROM {meta_schema}.table_meta WHERE table_name = $table", {"table": key})
+        self.connection.execute(f"DELETE FROM {meta_schema}.labels WHERE object_name = $table", {"table": key})
+
+    ## Queries
+
+    def query(self, query, job_config=None, **kwargs):
+        params = {parameter.name: parameter.value for parameter in getattr(job_config, 'query_parameters', None) or []}
+        started = datetime.now(timezone.utc)
+        if job_config is not None and getattr(job_config, 'dry_run', False):
+            return LocalQueryJob(LocalRowIterator([], []), started, started)
+
+        rows, affected_rows = LocalRowIterator([], []), None
+        with self.lock:
+            for statement in split_statements(query):
+                sql, action = translate_statement(statement)
+                if action and action[0] == "dataset_labels":
+                    self._set_labels(action[1], action[2])
+                if sql is None:
+                    continue
+                rename = re.match(r'^\s*ALTER\s+TABLE\s+"([^"]+)"\."([^"]+)"\s+RENAME\s+TO\s+"([^"]+)"', sql, re.I)
+                statement_params = {name: value for name, value in params.items() if f'${name}' in sql}
+                cursor = self.connection.execute(sql, statement_params)
+                if cursor.description:
+                    columns = [column[0] for column in cursor.description]
+                    values = cursor.fetchall()
+                    if re.match(r'^\s*(INSERT|DELETE|UPDATE|MERGE)\b', sql, re.I) and columns == ['Count']:
+                        affected_rows = values[0][0]
+                    else:
+                        rows = LocalRowIterator(columns, values)
+                if action and action[0] == "layout":
+                    self._set_layout(action[1], action[2], action[3])
+                if rename:
+                    old_key, new_key = f"{rename.group(1)}.{rename.group(2)}", f"{rename.group(1)}.{rename.group(3)}"
+                    self.connection.execute(f"UPDATE {meta_schema}.table_meta SET table_name = $new WHERE table_name = $old", {"new": new_key, "old": old_key})
+                    self.connection.execute(f"UPDATE {meta_schema}.labels SET object_name = $new WHERE object_name = $old", {"new": new_key, "old": old_key})
+                else:
+                    written = write_pattern.match(sql)
+                    if written:
+                        self._touch(f"{written.group(1)}.{written.group(2)}")
+        return LocalQueryJob(rows, started, datetime.now(timezone.utc), affected_rows)
+
+    ## Tables
+
+    def get_table(self, table, **kwargs):
+        key = table_key(table)
+        with self.lock:
+            if not self._table_exists(key):
+                raise NotFound(f"Table {self.project}:{key} not found")
+            dataset, name = key.split('.')
+            columns = self.connection.execute(f"SELECT column_name, data_type, is_nullable FROM {meta_schema}.columns WHERE table_schema = $dataset AND table_name = $table",
+                                              {"dataset": dataset, "table": name}).fetchall()
+            schema = [bigquery.SchemaField(column, data_type, mode="NULLABLE" if nullable == "YES" else "REQUIRED") for column, data_type, nullable in columns]
+            num_rows = self.connection.execute(f"SELECT COUNT(*) FROM {quoted(key)}").fetchone()[0]
+            meta = self.connection.execute(f"SELECT partition_by, cluster_by, modified FROM {meta_schema}.table_meta WHERE table_name = $table", {"table": key}).fetchone()
+            partition_by, cluster_by, modified = meta or (None, None, datetime.now(timezone.utc))
+            labels = self._labels(key)
+            etag = base64.b64encode(hashlib.md5(repr((modified, partition_by, cluster_by, sorted(labels.items()))).encode()).digest()[:12]).decode()
+            return LocalTable(self, key, schema, num_rows, labels, partition_by,
+                              cluster_by.split(',') if cluster_by else None, modified, etag)
+
+    def create_table(self, table, exists_ok=False, **kwargs):
+        key = table_key(table)
+        with self.lock:
+            if self._table_exists(key):
+                if not exists_ok:
+                    raise Conflict(f"Already Exists: Table {self.project}:{key}")
+                return self.get_table(key)
+            columns = []
+            for field in getattr(table, 'schema', None) or []:
+                column = f'"{field.name}" {duckdb_types.get(field.field_type, field.field_type)}'
+                if field.default_value_expression:
+                    column += f" DEFAULT {translate_statement(field.default_value_expression)[0]}"
+                if field.mode == "REQUIRED":
+                    column += " NOT NULL"
+                columns.append(column)
+            self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{key.split(".")[0]}"')
+            self.connection.execute(f"CREATE TABLE {quoted(key)} ({', '.join(columns)})")
+            partitioning = getattr(table, 'time_partitioning', None)
+            self._set_layout(key, partitioning.field if partitioning else None, getattr(table, 'clustering_fields', None))
+            self._set_labels(key, getattr(table, 'labels', None))
+            return self.get_table(key)
+
+    def update_table(self, table, fields, **kwargs):
+        key = table_key(table)
+        with self.lock:
+            current = self.get_table(key)
+            # The real client sends the etag of a table it has read as If-Match
+            if getattr(table, 'etag', None) and table.etag != current.etag:
+                raise PreconditionFailed(f"Precondition check failed: table {self.project}:{key} changed since it was read")
+            if "labels" in fields:
+                self._set_labels(key, table.labels)
+            if "schema" in fields:
+                existing = {field.name for field in current.schema}
+                for field in table.schema:
+                    if field.name not in existing:
+                        self.connection.execute(f'ALTER TABLE {quoted(key)} ADD COLUMN "{field.name}" {duckdb_types.get(field.field_type, field.field_type)}')
+            if "clustering_fields" in fields:
+                self._set_layout(key, current.time_partitioning.field if current.time_partitioning else None, table.clustering_fields)
+            return self.get_table(key)
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        key = table_key(table)
+        with self.lock:
+            if not self._table_exists(key):
+                if not_found_ok:
+                    return
+                raise NotFound(f"Table {self.project}:{key} not found")
+            self.connection.execute(f"DROP TABLE {quoted(key)}")
+            self._forget_table(key)
+
+    def insert_rows_json(self, table, json_rows, **kwargs):
+        key = table_key(table)
+        with self.lock:
+            for row in json_rows:
+                columns = list(row)
+                self.connection.execute(f"INSERT INTO {quoted(key)} ({', '.join(f'{chr(34)}{column}{chr(34)}' for column in columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                                        [row[column] for column in columns])
+            self._touch(key)
+        return []
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None, **kwargs):
+        started = datetime.now(timezone.utc)
+        key = table_key(destination)
+        uris = [source_uris] if isinstance(source_uris, str) else list(source_uris)
+        files = sorted(path for uri in uris for path in glob.glob(gs_path(self.storage_root, uri)))
+        if not files:
+            raise NotFound(f"Not found: URI {', '.join(uris)}")
+        source_format = getattr(job_config, 'source_format', None) or bigquery.SourceFormat.CSV
+        file_list = '[' + ', '.join(f"'{path}'" for path in files) + ']'
+        if source_format == bigquery.SourceFormat.PARQUET:
+            source = f"read_parquet({file_list})"
+        else:
+            source = f"read_csv({file_list}, header = {'true' if getattr(job_config, 'skip_leading_rows', 0) else 'false'})"
+
+        with self.lock:
+            if not self._table_exists(key):
+                self.create_table(bigquery.Table(f"{self.project}.{key}", schema=getattr(job_config, 'schema', None)))
+            if getattr(job_config, 'write_disposition', None) == bigquery.WriteDisposition.WRITE_TRUNCATE:
+                self.connection.execute(f"DELETE FROM {quoted(key)}")
+            before = self.connection.execute(f"SELECT COUNT(*) FROM {quoted(key)}").fetchone()[0]
+            self.connection.execute(f"INSERT INTO {quoted(key)} BY NAME SELECT * FROM {source}")
+            output_rows = self.connection.execute(f"SELECT COUNT(*) FROM {quoted(key)}").fetchone()[0] - before
+            self._touch(key)
+        return LocalLoadJob(len(files), sum(os.path.getsize(path) for path in files), output_rows, started, datetime.now(timezone.utc))
+
+    ## Datasets
+
+    def get_dataset(self, dataset, **kwargs):
+        dataset_id = dataset if isinstance(dataset, str) else dataset.dataset_id
+        dataset_id = dataset_id.replace(':', '.').split('.')[-1]
+        with self.lock:
+            exists = self.connection.execute(f"SELECT COUNT(*) FROM {meta_schema}.schemata WHERE schema_name = $dataset", {"dataset": dataset_id}).fetchone()[0]
+            if not exists:
+                raise NotFound(f"Dataset {self.project}:{dataset_id} not found")
+            return LocalDataset(self.project, dataset_id, self._labels(dataset_id))
+
+    def create_dataset(self, dataset, exists_ok=False, **kwargs):
+        dataset_id = (dataset if isinstance(dataset, str) else dataset.dataset_id).replace(':', '.').split('.')[-1]
+        with self.lock:
+            try:
+                self.get_dataset(dataset_id)
+                if not exists_ok:
+                    raise Conflict(f"Already Exists: Dataset {self.project}:{dataset_id}")
+            except NotFound:
+                self.connection.execute(f'CREATE SCHEMA "{dataset_id}"')
+            return self.get_dataset(dataset_id)
+
+    def list_datasets(self, **kwargs):
+        with self.lock:
+            names = [row[0] for row in self.connection.execute(f"SELECT schema_name FROM {meta_schema}.schemata ORDER BY 1").fetchall()]
+            return [LocalDataset(self.project, name, self._labels(name)) for name in names]
+
+    def close(self):
+        self.connection.close()
+
+
+######
+## gs:// paths for pandas (fsspec) and gcsfs
+######
+
+# Only needed when a function reads or writes gs:// paths directly (pandas, gcsfs); fsspec comes with pandas' extras
+def local_gcs_filesystem(root):
+    from fsspec.implementations.local import LocalFileSystem
+
+    class LocalGCSFileSystem(LocalFileSystem):
+        protocol = ('gs', 'gcs')
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(auto_mkdir=True)
+
+        @classmethod
+        def _strip_protocol(cls, path):
+            path = path[0] if isinstance(path, list) else path
+            if path.startswith(('gs://', 'gcs://')):
+                path = gs_path(root, 'gs://' + path.split('://', 1)[1])
+            return super()._strip_protocol(path)
+
+    return LocalGCSFileSystem
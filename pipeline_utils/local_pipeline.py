@@ -0,0 +1,215 @@
+# Run the Cloud Functions of the pipeline in one local process, on local storage and a DuckDB warehouse
+#
+# Every function is loaded from its folder and called with a request object, exactly like functions-framework does,
+# after google.cloud.storage.Client and google.cloud.bigquery.Client have been replaced by the local clients of
+# local_backend.py. No function code changes: the same SQL runs on DuckDB and the same blob calls on files under
+# --root. Stages run in the order of the flows (extract -> transform -> load-into-raw -> load-into-stage, then the
+# MLOps retrieve -> train -> predict); each one's telemetry is printed and stored in the local pipeline_metrics table,
+# and --profile writes a cProfile dump per stage for snakeviz/pstats.
+#
+# Usage (from the root of the repository, with pipeline_utils/requirements-local.txt and the requirements of the
+# functions being run installed):
+#   python -m pipeline_utils.local_pipeline --root /tmp/cdc-local --txt-dir ./some-cdc-files --stages etl
+#   python -m pipeline_utils.local_pipeline --root /tmp/cdc-local --stages mlops --profile
+# Without --txt-dir the extract stage downloads the CDC files, so it needs network access.
+
+import argparse
+import cProfile
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+from pipeline_utils.local_backend import DuckDBClient, LocalStorageClient, local_gcs_filesystem
+from pipeline_utils.pipeline_metrics import save_pipeline_metrics
+
+repo_root = Path(__file__).resolve().parents[1]
+
+# stage -> (function folder, entry point, payload for a run context)
+stages = {
+    "create_schema": ("main-pipeline/functions/schema-setup", "create_schema", lambda run: {}),
+    "extract": ("main-pipeline/functions/extract-txt", "task", lambda run: {"job_id": run["job_id"]}),
+    "transform": ("main-pipeline/functions/transform", "transform_txt_to_dataframe", lambda run: {"job_id": run["job_id"]}),
+    "load_to_raw": ("main-pipeline/functions/load-into-raw", "load_to_bigquery",
+                    lambda run: {"job_id": run["job_id"], **({"source_uri": run["output_uri"]} if run.get("output_uri") else {})}),
+    "load_to_stage": ("main-pipeline/functions/load-into-stage", "task", lambda run: {"job_id": run["job_id"]}),
+    "commit_manifest": ("main-pipeline/functions/extract-txt", "task", lambda run: {"job_id": run["job_id"], "commit_manifest": True}),
+    "compact_lake": ("main-pipeline/functions/compact-lake", "compact_lake", lambda run: {"diseases": run["diseases"]}),
+    "mlops_create_schema": ("mlops-pipeline/functions/schema-setup", "create_schema", lambda run: {}),
+    "retrieve_train_data": ("mlops-pipeline/functions/retrieve-train-data", "task", lambda run: {}),
+    "hyperparameter_tuning": ("mlops-pipeline/functions/hyperparameter-tuning", "sarima_hyperparameter_tuning", lambda run: {}),
+    "train": ("mlops-pipeline/functions/trainer", "train_sarima_models", lambda run: {}),
+    "predict": ("mlops-pipeline/functions/predictions", "predict_with_latest_models", lambda run: {}),
+}
+
+# Stage groups accepted by --stages, besides single stage names
+stage_groups = {
+    "etl": ["create_schema", "extract", "transform", "load_to_raw", "load_to_stage", "commit_manifest", "compact_lake"],
+    "mlops": ["mlops_create_schema", "retrieve_train_data", "hyperparameter_tuning", "train", "predict"],
+}
+stage_groups["all"] = stage_groups["etl"] + stage_groups["mlops"]
+
+# Folders of the modules the deploy scripts copy into the function folders; they follow the function's own folder
+# on sys.path, so the functions import them by name as they do once deployed
+shared_module_dirs = [repo_root / 'pipeline_utils', repo_root / 'main-pipeline/functions/schema-setup']
+
+# Bucket the extract stage writes the CDC text files to
+extract_bucket_name = 'cdc-extract-txt'
+
+# Minimal stand-in for the flask.Request that functions-framework passes to a function
+class LocalRequest:
+    def __init__(self, payload):
+        self.payload = payload
+        self.args = {}
+        self.headers = {}
+        self.scheme, self.host, self.path = 'http', 'localhost', '/'
+
+    def get_json(self, silent=False, force=False):
+        return self.payload
+
+# Install the local clients for everything imported or called inside the block
+@contextmanager
+def local_backend(root):
+    os.makedirs(root, exist_ok=True)
+    storage_client = LocalStorageClient(root)
+    bigquery_client = DuckDBClient(os.path.join(root, 'warehouse.duckdb'), storage_root=root)
+    patches = [
+        mock.patch('google.cloud.storage.Client', lambda *args, **kwargs: storage_client),
+        mock.patch('google.cloud.bigquery.Client', lambda *args, **kwargs: bigquery_client),
+    ]
+    try:
+        import fsspec
+        fsspec.register_implementation('gs', local_gcs_filesystem(root), clobber=True)
+        fsspec.register_implementation('gcs', local_gcs_filesystem(root), clobber=True)
+    except ImportError:
+        print("fsspec is not installed, gs:// paths opened by pandas will not be mapped to the local root")
+    for patch in patches:
+        patch.start()
+    try:
+        yield storage_client, bigquery_client
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+        bigquery_client.close()
+
+# Helper function - import a function's main.py under its own module name, with its folder first on sys.path
+def load_function(function_dir, root):
+    path = repo_root / function_dir / 'main.py'
+    search_path = [str(path.parent)] + [str(folder) for folder in shared_module_dirs]
+    sys.path[:0] = search_path
+    try:
+        spec = importlib.util.spec_from_file_location(f"local_{path.parent.name.replace('-', '_')}_{uuid.uuid4().hex[:6]}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for folder in search_path:
+            sys.path.remove(folder)
+    # gcsfs is imported by name in the trainer, so it doesn't go through the fsspec registry
+    if hasattr(module, 'GCSFileSystem'):
+        module.GCSFileSystem = local_gcs_filesystem(root)
+    return module
+
+# Helper function - copy local CDC text files into the extract bucket as the files of a job
+def seed_job_files(storage_client, txt_dir, job_id):
+    bucket = storage_client.get_bucket(extract_bucket_name)
+    files = sorted(Path(txt_dir).glob('*.txt'))
+    for file_path in files:
+        bucket.blob(f"{job_id}/{file_path.name}").upload_from_filename(str(file_path))
+    print(f"Copied {len(files)} text files from {txt_dir} to job {job_id}")
+    return files
+
+# Run one stage; returns (status code, body, seconds)
+def run_stage(stage, run, root, profile_dir=None):
+    function_dir, entry_point, payload = stages[stage]
+    module = load_function(function_dir, root)
+    request = LocalRequest(payload(run))
+
+    profiler = cProfile.Profile() if profile_dir else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        response = getattr(module, entry_point)(request)
+    finally:
+        if profiler:
+            profiler.disable()
+    seconds = time.perf_counter() - start
+    if profiler:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{stage}.prof"))
+
+    body, status_code = (response[0], response[1]) if isinstance(response, tuple) else (response, 200)
+    try:
+        body = json.loads(body) if isinstance(body, (str, bytes)) else body
+    except ValueError:
+        pass
+    return status_code, body, seconds
+
+# Run the stages in order, stopping at the first one that fails; returns the timings and the stages' telemetry
+def run_pipeline(root, stage_names, job_id=None, txt_dir=None, profile_dir=None):
+    run = {"job_id": job_id or datetime.now().strftime('%Y%m%d_%H%M%S') + '_' + str(uuid.uuid4()), "diseases": []}
+    timings, telemetry = {}, []
+    with local_backend(root) as (storage_client, _):
+        if txt_dir:
+            files = seed_job_files(storage_client, txt_dir, run["job_id"])
+            run["diseases"] = sorted({int(code) for code in (file_path.name.split('table')[-1].split('.')[0] for file_path in files) if code.isdigit()})
+            stage_names = [stage for stage in stage_names if stage not in ("extract", "commit_manifest")]
+
+        for stage in stage_names:
+            # A transform without rows leaves nothing to load
+            if stage in ("load_to_raw", "load_to_stage") and "output_uri" in run and not run["output_uri"]:
+                print(f"--- {stage}: skipped, the transform produced no rows")
+                continue
+            print(f"--- {stage}")
+            status_code, body, seconds = run_stage(stage, run, root, profile_dir)
+            timings[stage] = round(seconds, 3)
+            if isinstance(body, dict) and body.get("telemetry"):
+                telemetry.append({**body["telemetry"], "endpoint": stages[stage][0]})
+            cache = f", cache {body['cache']['status']}" if isinstance(body, dict) and body.get("cache") else ""
+            print(f"--- {stage}: HTTP {status_code} in {seconds:.2f}s{cache}")
+            if status_code >= 400:
+                print(f"Stopping, {stage} failed: {body}")
+                break
+            if stage == "extract" and isinstance(body, dict):
+                run["diseases"] = sorted({changed["table"] for changed in body.get("changed_files", [])})
+            if stage == "transform" and isinstance(body, dict):
+                run["output_uri"] = body.get("output_uri")
+        save_pipeline_metrics("local_pipeline", run["job_id"], telemetry)
+
+    print(f"Job {run['job_id']} under {root}:")
+    print(f"  {'stage':22s} {'wall':>9s} {'cpu':>9s} {'rss MB':>8s} {'rows out':>10s} {'bytes read':>12s} {'bytes written':>14s}")
+    for record in telemetry:
+        print(f"  {record['stage']:22s} {record['wall_seconds']:8.2f}s {record['cpu_seconds']:8.2f}s {record['peak_rss_mb']:8.1f} "
+              f"{record['rows_out'] or 0:10d} {record['bytes_read'] or 0:12d} {record['bytes_written'] or 0:14d}")
+    return {"job_id": run["job_id"], "timings": timings, "telemetry": telemetry}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline's Cloud Functions locally on files and DuckDB")
+    parser.add_argument('--root', default=os.path.join(os.getcwd(), '.local-pipeline'),
+                        help="folder holding the buckets and warehouse.duckdb")
+    parser.add_argument('--stages', default='etl',
+                        help=f"comma-separated stages or groups ({', '.join(stage_groups)}); stages: {', '.join(stages)}")
+    parser.add_argument('--job-id', help="job ID to use (default: a new one)")
+    parser.add_argument('--txt-dir', help="use the CDC .txt files in this folder instead of running the extract stage")
+    parser.add_argument('--profile', nargs='?', const='profiles', help="write a cProfile dump per stage to this folder")
+    parser.add_argument('--clean', action='store_true', help="delete the root folder before running")
+    args = parser.parse_args()
+
+    stage_names = []
+    for name in args.stages.split(','):
+        if name not in stage_groups and name not in stages:
+            parser.error(f"Unknown stage '{name}'")
+        stage_names += stage_groups.get(name, [name])
+    if args.clean and os.path.isdir(args.root):
+        shutil.rmtree(args.root)
+    run_pipeline(args.root, stage_names, args.job_id, args.txt_dir, args.profile)
+
+if __name__ == "__main__":
+    main()
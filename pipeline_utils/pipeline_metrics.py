@@ -0,0 +1,39 @@
+# Store the telemetry of a flow run in the cdc_data.pipeline_metrics table
+#
+# One row per Cloud Function call, with the measurements returned by telemetry.instrumented and collected by
+# gcf_invoker.collect_telemetry(). The table is declared in the schema registry (partitioned by run_date, clustered by
+# flow and stage), so a week-over-week comparison of a stage only scans the weeks it asks for.
+# Saving is best effort: a flow never fails because its metrics could not be stored.
+
+from datetime import datetime, timezone
+
+from google.cloud import bigquery
+
+project_id = 'ba882-group-10'
+metrics_table_id = f"{project_id}.cdc_data.pipeline_metrics"
+
+metric_fields = ("stage", "function", "endpoint", "status_code", "wall_seconds", "cpu_seconds", "peak_rss_mb",
+                 "python_peak_mb", "rows_in", "rows_out", "bytes_read", "bytes_written")
+
+
+# Helper function - table rows for the telemetry records of one flow run
+def metrics_rows(flow_name, run_id, records, run_at=None):
+    run_at = run_at or datetime.now(timezone.utc)
+    return [{"run_at": run_at.isoformat(), "run_date": run_at.date().isoformat(), "flow": flow_name, "run_id": run_id,
+             **{field: record.get(field) for field in metric_fields}} for record in records if record.get("stage")]
+
+# Insert the telemetry records of a flow run; returns the number of rows stored
+def save_pipeline_metrics(flow_name, run_id, records):
+    rows = metrics_rows(flow_name, run_id, records)
+    if not rows:
+        return 0
+    try:
+        errors = bigquery.Client(project=project_id).insert_rows_json(metrics_table_id, rows)
+    except Exception as e:
+        print(f"Could not store pipeline metrics: {str(e)}")
+        return 0
+    if errors:
+        print(f"Could not store pipeline metrics: {errors}")
+        return 0
+    print(f"Stored {len(rows)} pipeline metrics rows for {flow_name} run {run_id}")
+    return len(rows)
@@ -0,0 +1,44 @@
+# Content-keyed cache of stage results
+#
+# A stage computes a key from the content of its inputs (content hashes, never object names or job IDs) and from the
+# settings that change its output. After a successful run it stores its result and the location of its output under
+# that key, as gs://<bucket>/stage-cache/<stage>/<key>.json. A later request with the same key (a flow rerun after a
+# downstream failure, or a new job whose files are byte-identical) returns the stored result right away, provided the
+# stage's own check that the output is still there and current passes.
+# Responses carry {"cache": {"status": "hit" | "miss" | "bypass", "key": ...}}, which the ETL flow reports per task.
+# {"use_cache": false} in a request bypasses the lookup; the result of that run is stored as usual.
+#
+# The canonical copy lives in pipeline_utils/ at the root of the repository; the deploy scripts copy it into the
+# folders of the functions that use it.
+
+import hashlib
+import json
+from datetime import datetime, timezone
+
+cache_prefix = 'stage-cache'
+
+
+# Deterministic key of a stage's inputs: anything JSON-serialisable, with dict keys sorted
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+# Helper function - object holding the cache entry of a key
+def cache_blob(bucket, stage, key):
+    return bucket.blob(f"{cache_prefix}/{stage}/{key}.json")
+
+# Return the entry stored for a key, or None
+def lookup(bucket, stage, key):
+    blob = cache_blob(bucket, stage, key)
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_text())
+
+# Store the entry of a key; a later run with the same inputs overwrites it with identical content
+def store(bucket, stage, key, entry):
+    entry = {**entry, "stage": stage, "key": key, "stored_at": datetime.now(timezone.utc).isoformat()}
+    cache_blob(bucket, stage, key).upload_from_string(json.dumps(entry), content_type='application/json')
+    return entry
+
+# Helper function - the "cache" member of a response
+def cache_info(status, key):
+    return {"status": status, "key": key}
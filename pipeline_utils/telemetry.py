@@ -0,0 +1,100 @@
+# Per-request telemetry for the Cloud Function entry points
+#
+# @instrumented("<stage>") wraps an HTTP entry point (below @functions_framework.http and @async_job, so polling
+# requests are not measured) and measures every request:
+# - wall_seconds: wall-clock time of the request
+# - cpu_seconds: user + system CPU time of the process and of the child processes it waited for
+# - peak_rss_mb: peak resident memory of the instance (resource.getrusage). It is a high-water mark, so on a warm
+#   instance it can come from an earlier request; python_peak_mb (tracemalloc, only with TELEMETRY_TRACEMALLOC=true
+#   because tracing slows allocations down) is the peak of this request's Python allocations.
+# - rows_in, rows_out, bytes_read, bytes_written: reported by the function itself with record(), since only it
+#   knows what it read and wrote. Values of several record() calls in one request are added up.
+# The measurements are returned with the response, as a "telemetry" member when the body is a JSON object and in
+# the X-Pipeline-Telemetry header for every response (also error messages). The flows collect them through
+# pipeline_utils.gcf_invoker and store them in cdc_data.pipeline_metrics (pipeline_utils/pipeline_metrics.py).
+#
+# The canonical copy lives in pipeline_utils/ at the root of the repository; the deploy scripts copy it into the
+# folders of the functions that use it.
+
+import functools
+import json
+import os
+import resource
+import time
+import tracemalloc
+from contextvars import ContextVar
+
+telemetry_header = 'X-Pipeline-Telemetry'
+trace_python_memory = os.environ.get('TELEMETRY_TRACEMALLOC', 'false').lower() == 'true'
+
+counter_names = ("rows_in", "rows_out", "bytes_read", "bytes_written")
+
+# Counters of the request being handled (None outside an instrumented request)
+_counters = ContextVar('telemetry_counters', default=None)
+
+
+# Add rows/bytes handled by the current request; a no-op outside an instrumented entry point
+def record(**counts):
+    counters = _counters.get()
+    if counters is None:
+        return
+    for name, value in counts.items():
+        if name not in counter_names:
+            raise ValueError(f"Unknown telemetry counter '{name}', expected one of {counter_names}")
+        if value is not None:
+            counters[name] = (counters[name] or 0) + int(value)
+
+# Helper function - CPU seconds used so far by the process and its finished child processes
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+# Helper function - add the telemetry to a Flask-style return value
+def attach_telemetry(response, telemetry):
+    body, rest = (response[0], response[1:]) if isinstance(response, tuple) else (response, ())
+    status_code = rest[0] if rest and isinstance(rest[0], int) else 200
+    headers = dict(rest[-1]) if rest and isinstance(rest[-1], dict) else {}
+    telemetry["status_code"] = status_code
+
+    if isinstance(body, dict):
+        body = {**body, "telemetry": telemetry}
+    elif isinstance(body, str):
+        try:
+            decoded = json.loads(body)
+        except ValueError:
+            decoded = None
+        if isinstance(decoded, dict):
+            body = json.dumps({**decoded, "telemetry": telemetry})
+    headers[telemetry_header] = json.dumps(telemetry)
+    return body, status_code, headers
+
+# Decorator for an HTTP entry point: measures each request as described above
+def instrumented(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(request):
+            counters = dict.fromkeys(counter_names)
+            token = _counters.set(counters)
+            if trace_python_memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+            start_wall, start_cpu = time.perf_counter(), cpu_seconds()
+            try:
+                response = function(request)
+            finally:
+                _counters.reset(token)
+
+            telemetry = {
+                "stage": stage,
+                "function": function.__name__,
+                "wall_seconds": round(time.perf_counter() - start_wall, 3),
+                "cpu_seconds": round(cpu_seconds() - start_cpu, 3),
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "python_peak_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1) if trace_python_memory else None,
+                **counters,
+            }
+            print(f"Telemetry: {json.dumps(telemetry)}")
+            return attach_telemetry(response, telemetry)
+        return wrapper
+    return decorator
@@ -1,21 +1,24 @@
 from prefect import flow, task
-import requests
+import sys
+from pathlib import Path
+
+# The shared Cloud Function invoker lives in pipeline_utils at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_utils.gcf_invoker import invoke_gcf
 
 # Task to call the schema creation cloud function
 @task(retries=2, retry_delay_seconds=60)
 def create_schema():
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/create-symptom-schema"
-    response = requests.post(cloud_function_url)
-    response.raise_for_status()
-    print(f"Schema creation cloud function executed successfully. Response: {response.text}")
+    response = invoke_gcf(cloud_function_url)
+    print(f"Schema creation cloud function executed successfully. Response: {response}")
 
 # Task to call the cloud function that populates the symptom table
 @task(retries=2, retry_delay_seconds=60)
 def populate_symptom_table():
     cloud_function_url = "https://us-central1-ba882-group-10.cloudfunctions.net/populate-symptoms-table"
-    response = requests.post(cloud_function_url)
-    response.raise_for_status()
-    print(f"Symptom table population cloud function executed successfully. Response: {response.text}")
+    response = invoke_gcf(cloud_function_url)
+    print(f"Symptom table population cloud function executed successfully. Response: {response}")
 
 # Define the Prefect flow to create and populate the BigQuery table
 @flow